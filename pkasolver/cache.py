@@ -0,0 +1,205 @@
+import logging
+import os
+import pickle
+import sqlite3
+import time
+
+from rdkit import Chem
+
+from pkasolver.query import QueryModel, States
+
+logger = logging.getLogger(__name__)
+
+# part of every key, increase it if the enumeration changes its results
+CACHE_VERSION = 1
+
+
+class ResultCache:
+    """Persistent cache of calculate_microstate_pka_values results in a SQLite file.
+
+    Results are keyed by the canonical SMILES of the input molecule, the enumeration
+    options and the fingerprint of the QueryModel, so that results of other models
+    (weights, backend or precision) are never returned. The database uses write-ahead
+    logging: any number of processes can read while one of them writes, every process
+    opens its own ResultCache (see get_result_cache).
+    Properties of the molecules are not stored.
+    """
+
+    def __init__(self, file_name: str, timeout: float = 60.0):
+        """
+        Parameters
+        ----------
+        file_name
+            SQLite database, created if it does not exist
+        timeout
+            seconds to wait for the lock of a concurrent writer
+        """
+        self.file_name = file_name
+        self.connection = sqlite3.connect(
+            file_name, timeout=timeout, isolation_level=None
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS results (
+                smiles TEXT NOT NULL,
+                options TEXT NOT NULL,
+                model TEXT NOT NULL,
+                states BLOB NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (smiles, options, model)
+            ) WITHOUT ROWID"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS results_created ON results (created)"
+        )
+
+    @staticmethod
+    def key(
+        mol: Chem.Mol,
+        query_model: QueryModel,
+        only_dimorphite: bool = False,
+        tolerance: float = None,
+        prescreen: bool = False,
+    ) -> tuple:
+        """(canonical SMILES, enumeration options, model fingerprint)"""
+        options = (
+            f"version={CACHE_VERSION};only_dimorphite={bool(only_dimorphite)};"
+            f"tolerance={tolerance}"
+        )
+        if prescreen:
+            options += ";prescreen=True"
+        return Chem.MolToSmiles(mol), options, query_model.fingerprint
+
+    def get_many(self, keys: list) -> list:
+        """returns the cached list of States for each key, None if it is not cached"""
+        results = []
+        for key in keys:
+            row = self.connection.execute(
+                "SELECT states FROM results WHERE smiles = ? AND options = ? AND model = ?",
+                key,
+            ).fetchone()
+            results.append(None if row is None else _loads(row[0]))
+        return results
+
+    def put_many(self, items: list):
+        """stores (key, list of States) items in a single transaction"""
+        created = time.time()
+        rows = [(*key, _dumps(states), created) for key, states in items]
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def evict(
+        self,
+        older_than: float = None,
+        max_entries: int = None,
+        keep_models: int = None,
+    ) -> int:
+        """Removes entries and returns how many were removed.
+
+        Parameters
+        ----------
+        older_than
+            remove entries written more than older_than days ago
+        max_entries
+            remove the oldest entries beyond max_entries
+        keep_models
+            remove the entries of all but the keep_models most recently written models
+        """
+        nr_of_entries = len(self)
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            if older_than is not None:
+                self.connection.execute(
+                    "DELETE FROM results WHERE created < ?",
+                    (time.time() - older_than * 24 * 60 * 60,),
+                )
+            if keep_models is not None:
+                self.connection.execute(
+                    """DELETE FROM results WHERE model NOT IN (
+                        SELECT model FROM results GROUP BY model
+                        ORDER BY MAX(created) DESC LIMIT ?
+                    )""",
+                    (keep_models,),
+                )
+            if max_entries is not None:
+                self.connection.execute(
+                    """DELETE FROM results WHERE (smiles, options, model) NOT IN (
+                        SELECT smiles, options, model FROM results
+                        ORDER BY created DESC LIMIT ?
+                    )""",
+                    (max_entries,),
+                )
+        return nr_of_entries - len(self)
+
+    def compact(self):
+        """Merges the write-ahead log into the database and frees unused pages"""
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.connection.execute("VACUUM")
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def __enter__(self) -> "ResultCache":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _dumps(states: list) -> bytes:
+    """serializes States with atom order preserving binary mols"""
+    if not states:
+        return pickle.dumps((None, []))
+    return pickle.dumps(
+        (
+            states[0].ph7_mol.ToBinary(),
+            [
+                (
+                    state.pka,
+                    state.pka_stddev,
+                    state.protonated_mol.ToBinary(),
+                    state.deprotonated_mol.ToBinary(),
+                    state.reaction_center_idx,
+                    state.nr_of_models,
+                )
+                for state in states
+            ],
+        )
+    )
+
+
+def _loads(data: bytes) -> list:
+    ph7_mol, states = pickle.loads(data)
+    ph7_mol = Chem.Mol(ph7_mol) if ph7_mol is not None else None
+    return [
+        States(
+            pka,
+            pka_stddev,
+            Chem.Mol(protonated_mol),
+            Chem.Mol(deprotonated_mol),
+            reaction_center_idx=idx,
+            ph7_mol=ph7_mol,
+            nr_of_models=nr_of_models,
+        )
+        for pka, pka_stddev, protonated_mol, deprotonated_mol, idx, nr_of_models in states
+    ]
+
+
+_result_caches = {}
+
+
+def get_result_cache(file_name: str) -> ResultCache:
+    """Returns the ResultCache for file_name of this process, opening it on first use.
+    SQLite connections must not be shared with forked processes, so every process
+    gets its own."""
+    key = (os.getpid(), os.path.realpath(file_name))
+    if key not in _result_caches:
+        _result_caches[key] = ResultCache(file_name)
+    return _result_caches[key]
@@ -0,0 +1,476 @@
+import argparse
+import csv
+import gzip
+import logging
+import sys
+from itertools import tee
+from typing import Iterator
+
+from rdkit import Chem
+
+from pkasolver.cache import ResultCache
+from pkasolver.query import MODEL_DIR, NODE_BUDGET, PRECISIONS
+from pkasolver.runner import run_microstate_pka_values
+
+logger = logging.getLogger(__name__)
+
+INPUT_FORMATS = ("smi", "sdf")
+OUTPUT_FORMATS = ("sdf", "csv", "parquet")
+COLUMNS = (
+    "index",
+    "name",
+    "smiles",
+    "state",
+    "pka",
+    "pka_stddev",
+    "nr_of_models",
+    "reaction_center_idx",
+    "protonated_smiles",
+    "deprotonated_smiles",
+    "error",
+)
+# error of the molecules without prediction (states None), not of those without states
+PREDICTION_FAILED = "pKa prediction failed"
+
+
+def _guess_format(path: str, formats: tuple, default: str) -> str:
+    """returns the format from the file extension (ignoring .gz), default for stdin/stdout"""
+    if path == "-":
+        return default
+    suffix = path[:-3] if path.endswith(".gz") else path
+    suffix = suffix.rsplit(".", 1)[-1].lower()
+    if suffix == "smiles":
+        suffix = "smi"
+    if suffix not in formats:
+        raise ValueError(
+            f"Can not guess the format of {path}, use one of {formats} as extension or set it explicitly."
+        )
+    return suffix
+
+
+def _open(path: str, mode: str):
+    """opens path ('-' for stdin/stdout), transparently (de)compressing .gz files"""
+    if path == "-":
+        stream = sys.stdin if "r" in mode else sys.stdout
+        return stream.buffer if "b" in mode else stream
+    if path.endswith(".gz"):
+        return gzip.open(path, mode if "b" in mode else mode + "t")
+    return open(path, mode)
+
+
+def read_molecules(path: str, input_format: str = None) -> Iterator[tuple]:
+    """Lazily reads molecules from a SMILES (one SMILES and an optional name per line)
+    or SD file, both optionally gzipped, or from stdin ('-').
+
+    Returns
+    -------
+    Iterator[tuple]
+        (name, SMILES string or rdkit mol) for each record, the mol is None if the
+        record could not be parsed
+    """
+    input_format = input_format or _guess_format(path, INPUT_FORMATS, "smi")
+    if input_format == "sdf":
+        with _open(path, "rb") as f:
+            for mol in Chem.ForwardSDMolSupplier(f, removeHs=True):
+                name = mol.GetProp("_Name") if mol is not None else ""
+                yield name, mol
+    else:
+        with _open(path, "r") as f:
+            for line in f:
+                fields = line.split(maxsplit=1)
+                if not fields:
+                    continue
+                yield (fields[1].strip() if len(fields) > 1 else ""), fields[0]
+
+
+def _rows(index: int, name: str, smiles: str, states: list) -> list:
+    """returns one row per state, a single row without state for failed/neutral molecules,
+    failed molecules (states None) have an error"""
+    if states is None:
+        return [dict(index=index, name=name, smiles=smiles, error=PREDICTION_FAILED)]
+    if not states:
+        return [dict(index=index, name=name, smiles=smiles)]
+    return [
+        dict(
+            index=index,
+            name=name,
+            smiles=smiles,
+            state=i,
+            pka=state.pka,
+            pka_stddev=state.pka_stddev,
+            nr_of_models=state.nr_of_models,
+            reaction_center_idx=state.reaction_center_idx,
+            protonated_smiles=Chem.MolToSmiles(state.protonated_mol),
+            deprotonated_smiles=Chem.MolToSmiles(state.deprotonated_mol),
+        )
+        for i, state in enumerate(states)
+    ]
+
+
+class SDFWriter:
+    """Writes the pH 7 molecule with the predicted states as SD properties"""
+
+    def __init__(self, path: str):
+        self.file = _open(path, "w")
+        self.writer = Chem.SDWriter(self.file)
+
+    def write(self, index: int, name: str, smiles: str, states: list):
+        if states:
+            mol = Chem.Mol(states[0].ph7_mol)
+        else:
+            mol = Chem.MolFromSmiles(smiles) if smiles else None
+            if mol is None:
+                logger.warning(f"Skipping record {index}, it could not be parsed.")
+                return
+        mol.SetProp("_Name", name)
+        mol.SetIntProp("index", index)
+        if states is None:
+            mol.SetProp("pkasolver_error", PREDICTION_FAILED)
+        else:
+            mol.SetIntProp("nr_of_states", len(states))
+        for row in _rows(index, name, smiles, states) if states else []:
+            i = row["state"]
+            mol.SetDoubleProp(f"pKa_{i}", row["pka"])
+            mol.SetDoubleProp(f"pKa_stddev_{i}", row["pka_stddev"])
+            mol.SetIntProp(f"reaction_center_idx_{i}", row["reaction_center_idx"])
+            mol.SetProp(f"protonated_smiles_{i}", row["protonated_smiles"])
+            mol.SetProp(f"deprotonated_smiles_{i}", row["deprotonated_smiles"])
+        self.writer.write(mol)
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class CSVWriter:
+    """Writes one row per predicted state"""
+
+    def __init__(self, path: str):
+        self.file = _open(path, "w")
+        self.writer = csv.DictWriter(self.file, COLUMNS)
+        self.writer.writeheader()
+
+    def write(self, index: int, name: str, smiles: str, states: list):
+        self.writer.writerows(_rows(index, name, smiles, states))
+
+    def close(self):
+        if self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+
+
+class ParquetWriter:
+    """Writes one row per predicted state, row_group_size rows at a time (needs pyarrow)"""
+
+    def __init__(self, path: str, row_group_size: int = 10_000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema(
+            [
+                ("index", pa.int64()),
+                ("name", pa.string()),
+                ("smiles", pa.string()),
+                ("state", pa.int32()),
+                ("pka", pa.float64()),
+                ("pka_stddev", pa.float64()),
+                ("nr_of_models", pa.int32()),
+                ("reaction_center_idx", pa.int32()),
+                ("protonated_smiles", pa.string()),
+                ("deprotonated_smiles", pa.string()),
+                ("error", pa.string()),
+            ]
+        )
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.row_group_size = row_group_size
+        self.rows = []
+
+    def write(self, index: int, name: str, smiles: str, states: list):
+        self.rows.extend(_rows(index, name, smiles, states))
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            table = self.pa.Table.from_pylist(self.rows, schema=self.schema)
+            self.writer.write_table(table)
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+WRITERS = {"sdf": SDFWriter, "csv": CSVWriter, "parquet": ParquetWriter}
+
+
+def predict(args) -> int:
+    """pkasolver predict: streams molecules from args.input to args.output"""
+    output_format = args.output_format or _guess_format(
+        args.output, OUTPUT_FORMATS, "csv"
+    )
+    if output_format == "parquet" and args.output == "-":
+        raise ValueError("Parquet output can not be written to stdout.")
+    records, inputs = tee(read_molecules(args.input, args.input_format))
+    results = run_microstate_pka_values(
+        (mol for _, mol in inputs),
+        nr_of_workers=args.workers,
+        chunk_size=args.batch_size,
+        tolerance=args.tolerance,
+        node_budget=args.node_budget,
+        model_dir=args.model_dir,
+        precision=args.precision,
+        cache_file=args.cache,
+        prescreen=args.prescreen,
+    )
+    writer = WRITERS[output_format](args.output)
+    nr_of_failures = 0
+    try:
+        for index, ((name, mol), states) in enumerate(zip(records, results)):
+            if isinstance(mol, Chem.Mol):
+                smiles = Chem.MolToSmiles(mol)
+            else:
+                smiles = mol or ""
+            if states is None:
+                nr_of_failures += 1
+            writer.write(index, name, smiles, states)
+    finally:
+        writer.close()
+    if nr_of_failures:
+        logger.warning(f"No prediction for {nr_of_failures} molecule(s).")
+    return 0
+
+
+def cache(args) -> int:
+    """pkasolver cache: maintenance of a persistent result cache"""
+    with ResultCache(args.file) as result_cache:
+        if args.cache_command == "evict":
+            nr_of_entries = result_cache.evict(
+                older_than=args.older_than,
+                max_entries=args.max_entries,
+                keep_models=args.keep_models,
+            )
+            logger.info(f"Removed {nr_of_entries} entries, {len(result_cache)} left.")
+        result_cache.compact()
+        logger.info(f"Compacted {args.file}.")
+    return 0
+
+
+def serve(args) -> int:
+    """pkasolver serve: runs the InferenceServer"""
+    from pkasolver.query import get_query_model
+    from pkasolver.server import serve as run_server
+
+    run_server(
+        host=args.host,
+        port=args.port,
+        query_model=get_query_model(model_dir=args.model_dir, precision=args.precision),
+        node_budget=args.node_budget,
+        batch_window=args.batch_window / 1000,
+        max_queue_size=args.max_queue_size,
+        tolerance=args.tolerance,
+    )
+    return 0
+
+
+def tune(args) -> int:
+    """pkasolver tune: recommends a thread policy for this machine"""
+    from pkasolver.threads import (
+        ENV_INTRA_OP_THREADS,
+        ENV_WORKER_THREADS,
+        ENV_WORKERS,
+        autotune_thread_policy,
+    )
+
+    smiles = None
+    if args.input:
+        smiles = [smi for _, smi in read_molecules(args.input, "smi")]
+    policy, results = autotune_thread_policy(smiles, repeats=args.repeats)
+    print("workers  threads  molecules/s")
+    for result, molecules_per_second in results:
+        threads = result.worker_threads
+        if result.nr_of_workers == 0:
+            threads = result.intra_op_threads
+        print(f"{result.nr_of_workers:7d}  {threads:7d}  {molecules_per_second:11.2f}")
+    print("\nRecommended settings:")
+    print(f"export {ENV_WORKERS}={policy.nr_of_workers}")
+    if policy.nr_of_workers == 0:
+        print(f"export {ENV_INTRA_OP_THREADS}={policy.intra_op_threads}")
+    else:
+        print(f"export {ENV_WORKER_THREADS}={policy.worker_threads}")
+    return 0
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="pkasolver", description="pKa prediction of small molecules"
+    )
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument(
+        "-v", "--verbose", action="store_true", help="also print debug messages"
+    )
+    verbosity.add_argument(
+        "-q", "--quiet", action="store_true", help="only print warnings and errors"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    predict_parser = subparsers.add_parser(
+        "predict",
+        help="predict microstate pKa values",
+        description="Predict microstate pKa values of all molecules of a SMILES or SD file "
+        "(optionally gzipped, '-' reads SMILES from stdin). Molecules are read and results "
+        "are written as they are processed, so memory use does not grow with the input size.",
+    )
+    predict_parser.add_argument(
+        "input", help="input file, .smi, .sdf, .smi.gz, .sdf.gz or '-'"
+    )
+    predict_parser.add_argument(
+        "-o",
+        "--output",
+        default="-",
+        help="output file, .sdf, .csv or .parquet; defaults to CSV on stdout",
+    )
+    predict_parser.add_argument("--input_format", choices=INPUT_FORMATS)
+    predict_parser.add_argument("--output_format", choices=OUTPUT_FORMATS)
+    predict_parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=32,
+        help="molecules enumerated together (and sent to a worker at once)",
+    )
+    predict_parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of worker processes, 0 runs in this process; "
+        "defaults to $PKASOLVER_NUM_WORKERS or the number of available cpus",
+    )
+    predict_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=None,
+        help="stop the ensemble evaluation early at this standard error of the mean",
+    )
+    predict_parser.add_argument(
+        "--prescreen",
+        action="store_true",
+        help="skip the ensemble evaluation of reaction centers that the first members "
+        "rule out in an iteration",
+    )
+    predict_parser.add_argument(
+        "--node_budget",
+        type=int,
+        default=NODE_BUDGET,
+        help="maximum number of nodes per forward pass",
+    )
+    predict_parser.add_argument(
+        "--model_dir", default=MODEL_DIR, help="directory containing the trained models"
+    )
+    predict_parser.add_argument("--precision", choices=PRECISIONS, default="fp32")
+    predict_parser.add_argument(
+        "--cache",
+        default=None,
+        help="SQLite file in which results are cached across runs (see pkasolver cache)",
+    )
+    predict_parser.set_defaults(func=predict)
+
+    cache_parser = subparsers.add_parser(
+        "cache", help="maintain a result cache written by pkasolver predict --cache"
+    )
+    cache_subparsers = cache_parser.add_subparsers(dest="cache_command", required=True)
+    compact_parser = cache_subparsers.add_parser(
+        "compact", help="merge the write-ahead log and free unused space"
+    )
+    compact_parser.add_argument("file", help="cache file")
+    evict_parser = cache_subparsers.add_parser(
+        "evict", help="remove entries, then compact the cache"
+    )
+    evict_parser.add_argument("file", help="cache file")
+    evict_parser.add_argument(
+        "--older_than", type=float, help="remove entries older than this many days"
+    )
+    evict_parser.add_argument(
+        "--max_entries", type=int, help="keep at most this many (most recent) entries"
+    )
+    evict_parser.add_argument(
+        "--keep_models",
+        type=int,
+        help="remove the entries of all but this many most recently used models",
+    )
+    cache_parser.set_defaults(func=cache)
+
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="run a local HTTP prediction service",
+        description="Load the ensemble once and answer JSON requests: GET /health, "
+        "POST /microstates and POST /pairs (see pkasolver.server.InferenceServer).",
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument(
+        "--batch_window",
+        type=float,
+        default=5.0,
+        help="milliseconds to wait for more requests before predicting a batch",
+    )
+    serve_parser.add_argument(
+        "--max_queue_size",
+        type=int,
+        default=1024,
+        help="maximum number of waiting molecules and pairs, more are rejected (503)",
+    )
+    serve_parser.add_argument(
+        "--node_budget",
+        type=int,
+        default=NODE_BUDGET,
+        help="maximum number of nodes per batch",
+    )
+    serve_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=None,
+        help="stop the ensemble evaluation early at this standard error of the mean",
+    )
+    serve_parser.add_argument(
+        "--model_dir", default=MODEL_DIR, help="directory containing the trained models"
+    )
+    serve_parser.add_argument("--precision", choices=PRECISIONS, default="fp32")
+    serve_parser.set_defaults(func=serve)
+
+    tune_parser = subparsers.add_parser(
+        "tune",
+        help="benchmark worker processes and threads on this machine",
+        description="Measure the throughput of pkasolver predict with different numbers of "
+        "worker processes and torch threads and print the recommended PKASOLVER_NUM_* "
+        "environment variables (see pkasolver.threads).",
+    )
+    tune_parser.add_argument(
+        "--input",
+        default=None,
+        help="SMILES file of representative molecules, defaults to a small built-in set",
+    )
+    tune_parser.add_argument(
+        "--repeats", type=int, default=1, help="best of this many runs per setting"
+    )
+    tune_parser.set_defaults(func=tune)
+    return parser
+
+
+def main(argv: list = None) -> int:
+    args = get_parser().parse_args(argv)
+    level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
+    elif args.quiet:
+        level = logging.WARNING
+    # messages go to stderr, stdout may be the output file
+    logging.basicConfig(level=level)
+    logging.getLogger().setLevel(level)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
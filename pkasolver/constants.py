@@ -7,9 +7,11 @@ logger = logging.getLogger(__name__)
 
 import torch
 
-NUM_THREADS = 1
-torch.set_num_threads(NUM_THREADS)
-logger.debug(f"Setting num threads to {NUM_THREADS}")
+from pkasolver.threads import set_thread_policy_from_environment
+
+# torch threads are left alone unless PKASOLVER_NUM_THREADS etc. are set,
+# see pkasolver.threads.set_thread_policy
+set_thread_policy_from_environment()
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 SEED = 42
@@ -1,7 +1,8 @@
 # Imports
 
+from collections import OrderedDict
 from copy import deepcopy
-from typing import Tuple
+from typing import NamedTuple, Tuple
 
 from rdkit import Chem
 from rdkit.Chem import PandasTools, PropertyMol
@@ -22,8 +23,11 @@ from pkasolver.constants import (
     DEVICE,
     EDGE_FEATURES,
     NODE_FEATURES,
+    amide,
     edge_feat_values,
     node_feat_values,
+    rotatable_bond,
+    smarts_dict,
 )
 
 
@@ -239,15 +243,15 @@ class PairData(Data):
     def __init__(
         self,
         # NOTE: everything for protonated
-        edge_index_p,
-        edge_attr_p,
-        x_p,
-        charge_p,
+        edge_index_p=None,
+        edge_attr_p=None,
+        x_p=None,
+        charge_p=None,
         # everything for deprotonated
-        edge_index_d,
-        edge_attr_d,
-        x_d,
-        charge_d,
+        edge_index_d=None,
+        edge_attr_d=None,
+        x_d=None,
+        charge_d=None,
     ):
         super(PairData, self).__init__()
         self.edge_index_p = edge_index_p
@@ -484,6 +488,255 @@ def mol_to_paired_mol_data(
     return data
 
 
+# features that only depend on the atom (bond) itself
+LOCAL_NODE_FEATURES = [
+    "element",
+    "formal_charge",
+    "is_in_ring",
+    "hybridization",
+    "total_num_Hs",
+    "aromatic_tag",
+    "total_valence",
+    "total_degree",
+]
+LOCAL_EDGE_FEATURES = ["bond_type", "is_conjugated"]
+# features that are defined by the atoms (bonds) matched by groups of smarts patterns
+SMARTS_NODE_FEATURES = {
+    "smarts": list(smarts_dict.values()),
+    "amide_center_atom": [[amide]],
+}
+SMARTS_EDGE_FEATURES = {"rotatable": [rotatable_bond]}
+
+
+def _atom_signature(atom: Chem.rdchem.Atom) -> tuple:
+    return (
+        atom.GetAtomicNum(),
+        atom.GetFormalCharge(),
+        atom.GetTotalNumHs(),
+        atom.GetNumExplicitHs(),
+        atom.GetNoImplicit(),
+        int(atom.GetHybridization()),
+        atom.GetIsAromatic(),
+        atom.GetTotalValence(),
+        atom.GetTotalDegree(),
+        atom.IsInRing(),
+        atom.GetIsotope(),
+        atom.GetNumRadicalElectrons(),
+        int(atom.GetChiralTag()),
+    )
+
+
+def _bond_signature(bond: Chem.rdchem.Bond) -> tuple:
+    return (
+        bond.GetBeginAtomIdx(),
+        bond.GetEndAtomIdx(),
+        int(bond.GetBondType()),
+        bond.GetIsConjugated(),
+        bond.GetIsAromatic(),
+        bond.IsInRing(),
+        int(bond.GetStereo()),
+    )
+
+
+class _StateFeatures(NamedTuple):
+    atom_signatures: tuple
+    bond_signatures: tuple
+    nodes: np.ndarray  # without the reaction center
+    edge_index: torch.Tensor
+    edge_attr: torch.Tensor
+    bond_attr: np.ndarray  # one row per bond
+    charge: int
+
+
+class IncrementalFeaturizer:
+    """Creates the same PairData as mol_to_paired_mol_data, but reuses the features of
+    the protonation states it has already seen. The enumeration of microstates
+    featurizes many pairs that share a state or differ from a previous state only in
+    the charge and hydrogens of a few atoms:
+
+    * identical states (same atoms, bonds and all their properties) are featurized once
+    * a new state of a known skeleton copies the rows of the previous state and only
+      recomputes the atom (bond) features of the atoms (bonds) that changed
+    * the smarts features are matched once per state and pattern instead of once
+      per atom, so their membership is always exact
+    * the reaction center is set per pair
+
+    Only the features of NODE_FEATURES and EDGE_FEATURES are supported.
+    A featurizer keeps the max_states most recently used states, use one per group
+    of molecules.
+    """
+
+    def __init__(self, n_features: dict, e_features: dict, max_states: int = 4096):
+        """
+        Parameters
+        ----------
+        n_features
+            dictionary of node features
+        e_features
+            dictionary of edge features
+        max_states
+            maximum number of states (and of skeletons) whose features are kept,
+            the least recently used are dropped first
+        """
+        self.n_features = n_features
+        self.e_features = e_features
+        self.max_states = max_states
+        self.nr_of_hits = 0  # states that were already featurized
+        self.nr_of_updates = 0  # states that were derived from a previous state
+        self._states = OrderedDict()
+        self._last_state = OrderedDict()  # skeleton -> last featurized state
+        self._local_nodes, self._smarts_nodes = [], []
+        self._reaction_center = None
+        start = 0
+        for name, feat in n_features.items():
+            if feat is not NODE_FEATURES.get(name):
+                raise ValueError(f"Unknown node feature {name}")
+            columns = slice(start, start + len(node_feat_values[name]))
+            start = columns.stop
+            if name in LOCAL_NODE_FEATURES:
+                self._local_nodes.append((columns, feat))
+            elif name in SMARTS_NODE_FEATURES:
+                for column, group in zip(
+                    range(columns.start, columns.stop), SMARTS_NODE_FEATURES[name]
+                ):
+                    patterns = [Chem.MolFromSmarts(smarts) for smarts in group]
+                    self._smarts_nodes.append((column, patterns))
+            elif name == "reaction_center":
+                self._reaction_center = columns.start
+            else:
+                raise ValueError(f"Node feature {name} can not be reused")
+        self._nr_of_node_features = start
+        self._local_edges, self._smarts_edges = [], []
+        start = 0
+        for name, feat in e_features.items():
+            if feat is not EDGE_FEATURES.get(name):
+                raise ValueError(f"Unknown edge feature {name}")
+            columns = slice(start, start + len(edge_feat_values[name]))
+            start = columns.stop
+            if name in LOCAL_EDGE_FEATURES:
+                self._local_edges.append((columns, feat))
+            elif name in SMARTS_EDGE_FEATURES:
+                patterns = [Chem.MolFromSmarts(s) for s in SMARTS_EDGE_FEATURES[name]]
+                self._smarts_edges.append((columns.start, patterns))
+            else:
+                raise ValueError(f"Edge feature {name} can not be reused")
+        self._nr_of_edge_features = start
+
+    def _state(self, mol: Chem.rdchem.Mol) -> _StateFeatures:
+        atoms, bonds = list(mol.GetAtoms()), list(mol.GetBonds())
+        atom_signatures = tuple(_atom_signature(atom) for atom in atoms)
+        bond_signatures = tuple(_bond_signature(bond) for bond in bonds)
+        key = (atom_signatures, bond_signatures)
+        state = self._states.get(key)
+        if state is not None:
+            self.nr_of_hits += 1
+            self._states.move_to_end(key)
+            return state
+        skeleton = (
+            tuple(signature[0] for signature in atom_signatures),
+            tuple(signature[:2] for signature in bond_signatures),
+        )
+        previous = self._last_state.get(skeleton)
+        if previous is None:
+            nodes = np.zeros((len(atoms), self._nr_of_node_features), dtype=np.float32)
+            bond_attr = np.zeros(
+                (len(bonds), self._nr_of_edge_features), dtype=np.float32
+            )
+            changed_atoms, changed_bonds = atoms, bonds
+        else:
+            self.nr_of_updates += 1
+            nodes, bond_attr = previous.nodes.copy(), previous.bond_attr.copy()
+            changed_atoms = [
+                atom
+                for atom, signature, previous_signature in zip(
+                    atoms, atom_signatures, previous.atom_signatures
+                )
+                if signature != previous_signature
+            ]
+            changed_bonds = [
+                bond
+                for bond, signature, previous_signature in zip(
+                    bonds, bond_signatures, previous.bond_signatures
+                )
+                if signature != previous_signature
+            ]
+
+        for atom in changed_atoms:
+            for columns, feat in self._local_nodes:
+                nodes[atom.GetIdx(), columns] = feat(atom, None)
+        for column, patterns in self._smarts_nodes:
+            matched = set()
+            for pattern in patterns:
+                for match in mol.GetSubstructMatches(pattern):
+                    matched.update(match)
+            nodes[:, column] = 0
+            nodes[list(matched), column] = 1
+
+        for bond in changed_bonds:
+            for columns, feat in self._local_edges:
+                bond_attr[bond.GetIdx(), columns] = feat(bond)
+        for column, patterns in self._smarts_edges:
+            matched = set()
+            for pattern in patterns:
+                matched.update(
+                    frozenset(match) for match in mol.GetSubstructMatches(pattern)
+                )
+            for bond, (begin, end, *_) in zip(bonds, bond_signatures):
+                bond_attr[bond.GetIdx(), column] = frozenset((begin, end)) in matched
+
+        if not bonds:
+            edge_index, edge_attr = make_edges_and_attr(mol, self.e_features)
+        else:
+            if previous is not None:
+                edge_index = previous.edge_index
+            else:
+                ends = np.array([signature[:2] for signature in bond_signatures])
+                edge_index = torch.tensor(
+                    np.stack([ends.reshape(-1), ends[:, ::-1].reshape(-1)]),
+                    dtype=torch.long,
+                )
+            edge_attr = torch.from_numpy(np.repeat(bond_attr, 2, axis=0))
+        charge = np.sum([atom.GetFormalCharge() for atom in atoms])
+
+        state = _StateFeatures(
+            atom_signatures,
+            bond_signatures,
+            nodes,
+            edge_index,
+            edge_attr,
+            bond_attr,
+            charge,
+        )
+        self._states[key] = self._last_state[skeleton] = state
+        self._last_state.move_to_end(skeleton)
+        for states in (self._states, self._last_state):
+            if len(states) > self.max_states:
+                states.popitem(last=False)
+        return state
+
+    def _nodes(self, state: _StateFeatures, atom_idx: int) -> torch.Tensor:
+        nodes = state.nodes.copy()
+        if self._reaction_center is not None and 0 <= int(atom_idx) < len(nodes):
+            nodes[int(atom_idx), self._reaction_center] = 1
+        return torch.from_numpy(nodes)
+
+    def mol_to_paired_mol_data(
+        self, prot: Chem.rdchem.Mol, deprot: Chem.rdchem.Mol, atom_idx: int
+    ) -> PairData:
+        """see mol_to_paired_mol_data"""
+        state_p, state_d = self._state(prot), self._state(deprot)
+        return PairData(
+            edge_index_p=state_p.edge_index,
+            edge_attr_p=state_p.edge_attr,
+            x_p=self._nodes(state_p, atom_idx),
+            charge_p=state_p.charge,
+            edge_index_d=state_d.edge_index,
+            edge_attr_d=state_d.edge_attr,
+            x_d=self._nodes(state_d, atom_idx),
+            charge_d=state_d.charge,
+        )
+
+
 def mol_to_single_mol_data(
     mol: Chem.rdchem.Mol,
     atom_idx: int,
@@ -22,6 +22,8 @@ import copy
 import os
 import argparse
 import sys
+import threading
+from collections import OrderedDict
 
 try:
     # Python2
@@ -51,7 +53,7 @@ try:
     from rdkit.Chem import AllChem
 
     # Disable the unnecessary RDKit warnings
-    from rdkit import RDLogger
+    from rdkit import RDLogger, rdBase
 
     RDLogger.DisableLog("rdApp.*")
 except:
@@ -271,6 +273,9 @@ class UtilFuncs:
     """A namespace to store functions for manipulating mol objects. To keep
     things organized."""
 
+    # The substructures and reactions of neutralize_mol.
+    _neutralization_rxn_data = None
+
     @staticmethod
     def neutralize_mol(mol):
         """All molecules should be neuralized to the extent possible. The user
@@ -313,10 +318,14 @@ class UtilFuncs:
             # be R-N=[N+]=N
         ]
 
-        # Add substructures and reactions (initially none)
-        for i, rxn_datum in enumerate(rxn_data):
-            rxn_data[i].append(Chem.MolFromSmarts(rxn_datum[0]))
-            rxn_data[i].append(None)
+        # Add substructures and reactions (initially none). They are compiled
+        # only once per process.
+        if UtilFuncs._neutralization_rxn_data is None:
+            for i, rxn_datum in enumerate(rxn_data):
+                rxn_data[i].append(Chem.MolFromSmarts(rxn_datum[0]))
+                rxn_data[i].append(None)
+            UtilFuncs._neutralization_rxn_data = rxn_data
+        rxn_data = UtilFuncs._neutralization_rxn_data
 
         # Add hydrogens (respects valence, so incomplete).
         mol.UpdatePropertyCache(strict=False)
@@ -337,6 +346,8 @@ class UtilFuncs:
                     if rxn_placeholder is None:
                         current_rxn_str = reactant_smarts + ">>" + product_smarts
                         current_rxn = AllChem.ReactionFromSmarts(current_rxn_str)
+                        # Initialized before it is shared with other threads.
+                        current_rxn.Initialize()
                         rxn_data[i][3] = current_rxn  # Update the placeholder.
                     else:
                         current_rxn = rxn_data[i][3]
@@ -380,21 +391,11 @@ class UtilFuncs:
         smiles_str = smiles_str.replace("N=N=N", "N=[N+]=N")
         smiles_str = smiles_str.replace("NN#N", "N=[N+]=N")
 
-        # Now convert to a mol object. Note the trick that is necessary to
-        # capture RDKit error/warning messages. See
-        # https://stackoverflow.com/questions/24277488/in-python-how-to-capture-the-stdout-from-a-c-shared-library-to-a-variable
-        stderr_fileno = sys.stderr.fileno()
-        stderr_save = os.dup(stderr_fileno)
-        stderr_pipe = os.pipe()
-        os.dup2(stderr_pipe[1], stderr_fileno)
-        os.close(stderr_pipe[1])
-
-        mol = Chem.MolFromSmiles(smiles_str)
-
-        os.close(stderr_fileno)
-        os.close(stderr_pipe[0])
-        os.dup2(stderr_save, stderr_fileno)
-        os.close(stderr_save)
+        # Now convert to a mol object. RDKit's error/warning messages are
+        # blocked with RDKit's logging API, which (unlike redirecting the
+        # stderr file descriptor) leaves the other threads alone.
+        with rdBase.BlockLogs():
+            mol = Chem.MolFromSmiles(smiles_str)
 
         # Check that there are None type errors Chem.MolFromSmiles has
         # sanitize on which means if there is even a small error in the SMILES
@@ -404,6 +405,128 @@ class UtilFuncs:
         # cautious.
         return None if mol is None else mol
 
+    @staticmethod
+    def standardize_smiles(smiles_str):
+        """Converts a SMILES string to a neutralized, canonical SMILES string
+        without explicit hydrogens.
+
+        :param string smiles_str: The SMILES string.
+        :return: The standardized SMILES string, or None if it is poorly formed.
+        """
+
+        mol = UtilFuncs.convert_smiles_str_to_mol(smiles_str)
+        if mol is None:
+            return None
+
+        # Handle nuetralizing the molecules.
+        mol = UtilFuncs.neutralize_mol(mol)
+        if mol is None:
+            return None
+
+        # Remove the hydrogens.
+        try:
+            mol = Chem.RemoveHs(mol)
+        except:
+            return None
+        if mol is None:
+            return None
+
+        # Regenerate the smiles string (to standardize).
+        return Chem.MolToSmiles(mol, isomericSmiles=True)
+
+    @staticmethod
+    def standardize_mol(mol):
+        """Like standardize_smiles(), but without the SMILES round trip: returns
+        a neutralized copy of the Mol object without explicit hydrogens,
+        conformers and properties, with its atoms in the order of its canonical
+        SMILES string.
+
+        :param rdkit.Chem.rdchem.Mol mol: The Mol object, it is not modified.
+        :return: The standardized Mol object, or None if it is poorly formed.
+        """
+
+        mol = Chem.Mol(mol)
+        mol.RemoveAllConformers()
+        for prop in mol.GetPropNames(includePrivate=True, includeComputed=True):
+            mol.ClearProp(prop)
+
+        # Handle nuetralizing the molecules.
+        mol = UtilFuncs.neutralize_mol(mol)
+        if mol is None:
+            return None
+
+        # Remove the hydrogens.
+        try:
+            mol = Chem.RemoveHs(mol)
+        except:
+            return None
+
+        # Like parsing the SMILES string, drop the chiral tags of atoms that
+        # are no stereocenters (anymore), e.g. of the neutralized [N@H+].
+        Chem.AssignStereochemistry(mol, cleanIt=True, force=True)
+
+        return UtilFuncs.renumber_atoms_canonically(mol)[1]
+
+    @staticmethod
+    def finalize_mol(mol, smiles_str):
+        """Returns a sanitized copy of a protonated Mol object, with its atoms in
+        the order of its canonical SMILES string. This is the equivalent of
+        convert_smiles_str_to_mol(smiles_str), without parsing the SMILES string.
+
+        :param rdkit.Chem.rdchem.Mol mol: The protonated Mol object.
+        :param string smiles_str: Its canonical SMILES string.
+        :return: A rdkit.Chem.rdchem.Mol object, or None if it is not valid.
+        """
+
+        mol = Chem.Mol(mol)
+        sanitize_string = Chem.SanitizeMol(mol, catchErrors=True)
+        if sanitize_string.name == "SANITIZE_NONE":
+            smiles, mol = UtilFuncs.renumber_atoms_canonically(mol)
+            if smiles == smiles_str:
+                return mol
+
+        # Rare, the sanitization changed the molecule. Parse the SMILES string
+        # to be on the safe side.
+        return UtilFuncs.convert_smiles_str_to_mol(smiles_str)
+
+    @staticmethod
+    def renumber_atoms_canonically(mol):
+        """Renumbers the atoms in the order of the canonical SMILES string, i.e.,
+        as if the Mol object were parsed from it.
+
+        :param rdkit.Chem.rdchem.Mol mol: The Mol object.
+        :return: The canonical SMILES string and the renumbered Mol object.
+        """
+
+        smiles = Chem.MolToSmiles(mol, isomericSmiles=True)
+        order = mol.GetProp("_smilesAtomOutputOrder")
+        order = [int(i) for i in order.strip("[]").split(",") if i != ""]
+        return smiles, Chem.RenumberAtoms(mol, order)
+
+    @staticmethod
+    def set_props(mol, props):
+        """Sets the properties of a Mol object, keeping their types.
+
+        :param rdkit.Chem.rdchem.Mol mol: The Mol object.
+        :param dict props: The properties, e.g. from another mol.GetPropsAsDict().
+        """
+
+        for prop, val in props.items():
+            if type(val) is int:
+                mol.SetIntProp(prop, val)
+            elif type(val) is float:
+                mol.SetDoubleProp(prop, val)
+            elif type(val) is bool:
+                mol.SetBoolProp(prop, val)
+            else:
+                mol.SetProp(prop, str(val))
+
+    @staticmethod
+    def smiles_for_message(smi):
+        """Returns a SMILES string (or Mol object) as SMILES string for messages."""
+
+        return smi if isinstance(smi, str) else Chem.MolToSmiles(smi)
+
     @staticmethod
     def eprint(*args, **kwargs):
         """Error messages should be printed to STDERR. See
@@ -479,43 +602,14 @@ class LoadSMIFile(object):
             # Convert from SMILES string to RDKIT Mol. This series of tests is
             # to make sure the SMILES string is properly formed and to get it
             # into a canonical form. Filter if failed.
-            mol = UtilFuncs.convert_smiles_str_to_mol(smiles_str)
-            if mol is None:
-                if "silent" in self.args and not self.args["silent"]:
-                    UtilFuncs.eprint(
-                        "WARNING: Skipping poorly formed SMILES string: " + line
-                    )
-                return self.next()
-
-            # Handle nuetralizing the molecules. Filter if failed.
-            mol = UtilFuncs.neutralize_mol(mol)
-            if mol is None:
+            new_mol_string = UtilFuncs.standardize_smiles(smiles_str)
+            if new_mol_string is None:
                 if "silent" in self.args and not self.args["silent"]:
                     UtilFuncs.eprint(
                         "WARNING: Skipping poorly formed SMILES string: " + line
                     )
                 return self.next()
 
-            # Remove the hydrogens.
-            try:
-                mol = Chem.RemoveHs(mol)
-            except:
-                if "silent" in self.args and not self.args["silent"]:
-                    UtilFuncs.eprint(
-                        "WARNING: Skipping poorly formed SMILES string: " + line
-                    )
-                return self.next()
-
-            if mol is None:
-                if "silent" in self.args and not self.args["silent"]:
-                    UtilFuncs.eprint(
-                        "WARNING: Skipping poorly formed SMILES string: " + line
-                    )
-                return self.next()
-
-            # Regenerate the smiles string (to standardize).
-            new_mol_string = Chem.MolToSmiles(mol, isomericSmiles=True)
-
             return {"smiles": new_mol_string, "data": splits[1:]}
         else:
             # Blank line? Go to next one.
@@ -542,9 +636,6 @@ class Protonate(object):
         # Clean and normalize the args
         self.args = ArgParseFuncs.clean_args(args)
 
-        # Make sure functions in ProtSubstructFuncs have access to the args.
-        ProtSubstructFuncs.args = args
-
         # Load the substructures that can be protonated.
         self.subs = ProtSubstructFuncs.load_protonation_substructs_calc_state_for_ph(
             self.args["min_ph"], self.args["max_ph"], self.args["pka_precision"]
@@ -599,11 +690,6 @@ class Protonate(object):
         # protonation process, etc.
         orig_smi = smile_and_datum["smiles"]
 
-        # Dimorphite-DL may protonate some sites in ways that produce invalid
-        # SMILES. We need to keep track of all smiles so we can "rewind" to
-        # the last valid one, should things go south.
-        properly_formed_smi_found = [orig_smi]
-
         # Everything on SMILES line but the SMILES string itself (e.g., the
         # molecule name).
         data = smile_and_datum["data"]
@@ -612,77 +698,10 @@ class Protonate(object):
         # name).
         tag = " ".join(data)
 
-        # sites is a list of (atom index, "PROTONATED|DEPROTONATED|BOTH",
-        # reaction name, mol). Note that the second entry indicates what state
-        # the site SHOULD be in (not the one it IS in per the SMILES string).
-        # It's calculated based on the probablistic distributions obtained
-        # during training.
-        (
-            sites,
-            mol_used_to_idx_sites,
-        ) = ProtSubstructFuncs.get_prot_sites_and_target_states(orig_smi, self.subs)
-
-        new_mols = [mol_used_to_idx_sites]
-        if len(sites) > 0:
-            for site in sites:
-                # Make a new smiles with the correct protonation state. Note that
-                # new_smis is a growing list. This is how multiple protonation
-                # sites are handled.
-                new_mols = ProtSubstructFuncs.protonate_site(new_mols, site)
-                if len(new_mols) > self.args["max_variants"]:
-                    new_mols = new_mols[: self.args["max_variants"]]
-                    if "silent" in self.args and not self.args["silent"]:
-                        UtilFuncs.eprint(
-                            "WARNING: Limited number of variants to "
-                            + str(self.args["max_variants"])
-                            + ": "
-                            + orig_smi
-                        )
-
-                # Go through each of these new molecules and add them to the
-                # properly_formed_smi_found, in case you generate a poorly
-                # formed SMILES in the future and have to "rewind."
-                properly_formed_smi_found += [Chem.MolToSmiles(m) for m in new_mols]
-        else:
-            # Deprotonate the mols (because protonate_site never called to do
-            # it).
-            mol_used_to_idx_sites = Chem.RemoveHs(mol_used_to_idx_sites)
-            new_mols = [mol_used_to_idx_sites]
-
-            # Go through each of these new molecules and add them to the
-            # properly_formed_smi_found, in case you generate a poorly formed
-            # SMILES in the future and have to "rewind."
-            properly_formed_smi_found.append(Chem.MolToSmiles(mol_used_to_idx_sites))
-
-        # In some cases, the script might generate redundant molecules.
-        # Phosphonates, when the pH is between the two pKa values and the
-        # stdev value is big enough, for example, will generate two identical
-        # BOTH states. Let's remove this redundancy.
-        new_smis = list(
-            set(
-                [
-                    Chem.MolToSmiles(m, isomericSmiles=True, canonical=True)
-                    for m in new_mols
-                ]
-            )
+        new_mols, sites = ProtSubstructFuncs.protonate_mol(
+            UtilFuncs.convert_smiles_str_to_mol(orig_smi), self.subs, self.args
         )
-
-        # Sometimes Dimorphite-DL generates molecules that aren't actually
-        # possible. Simply convert these to mol objects to eliminate the bad
-        # ones (that are None).
-        new_smis = [
-            s for s in new_smis if UtilFuncs.convert_smiles_str_to_mol(s) is not None
-        ]
-
-        # If there are no smi left, return the input one at the very least.
-        # All generated forms have apparently been judged
-        # inappropriate/malformed.
-        if len(new_smis) == 0:
-            properly_formed_smi_found.reverse()
-            for smi in properly_formed_smi_found:
-                if UtilFuncs.convert_smiles_str_to_mol(smi) is not None:
-                    new_smis = [smi]
-                    break
+        new_smis = [Chem.MolToSmiles(m, isomericSmiles=True) for m in new_mols]
 
         # If the user wants to see the target states, add those to the ends of
         # each line.
@@ -701,7 +720,12 @@ class ProtSubstructFuncs:
     """A namespace to store functions for loading the substructures that can
     be protonated. To keep things organized."""
 
-    args = {}
+    # The compiled substructures and the state tables per (min_ph, max_ph,
+    # pka_std_range), see load_protonation_substructs_calc_state_for_ph. The
+    # lock guards the compilation, both are only read afterwards.
+    _lock = threading.Lock()
+    _compiled_subs = None
+    _subs_for_ph = {}
 
     @staticmethod
     def load_substructre_smarts_file():
@@ -722,6 +746,32 @@ class ProtSubstructFuncs:
 
         return lines
 
+    @staticmethod
+    def load_compiled_substructs():
+        """Loads the substructure smarts file and compiles the SMARTS, only
+        once per process.
+
+        :return: A list of (name, SMARTS string, compiled SMARTS, pKa ranges)
+                 of the protonation substructures.
+        """
+
+        with ProtSubstructFuncs._lock:
+            if ProtSubstructFuncs._compiled_subs is None:
+                compiled_subs = []
+                for line in ProtSubstructFuncs.load_substructre_smarts_file():
+                    line = line.strip()
+                    if line != "":
+                        splits = line.split()
+                        name, smart = splits[0], splits[1]
+                        pka_ranges = [
+                            splits[i : i + 3] for i in range(2, len(splits) - 1, 3)
+                        ]
+                        compiled_subs.append(
+                            (name, smart, Chem.MolFromSmarts(smart), pka_ranges)
+                        )
+                ProtSubstructFuncs._compiled_subs = compiled_subs
+            return ProtSubstructFuncs._compiled_subs
+
     @staticmethod
     def load_protonation_substructs_calc_state_for_ph(
         min_ph=6.4, max_ph=8.4, pka_std_range=1
@@ -737,33 +787,37 @@ class ProtSubstructFuncs:
                  range.
         """
 
+        # The state tables only depend on the parameters, they are computed once.
+        key = (min_ph, max_ph, pka_std_range)
+        if key in ProtSubstructFuncs._subs_for_ph:
+            return ProtSubstructFuncs._subs_for_ph[key]
+
         subs = []
+        compiled_subs = ProtSubstructFuncs.load_compiled_substructs()
 
-        for line in ProtSubstructFuncs.load_substructre_smarts_file():
-            line = line.strip()
+        for name, smart, mol, pka_ranges in compiled_subs:
             sub = {}
-            if line is not "":
-                splits = line.split()
-                sub["name"] = splits[0]
-                sub["smart"] = splits[1]
-                sub["mol"] = Chem.MolFromSmarts(sub["smart"])
-
-                pka_ranges = [splits[i : i + 3] for i in range(2, len(splits) - 1, 3)]
-
-                prot = []
-                for pka_range in pka_ranges:
-                    site = pka_range[0]
-                    std = float(pka_range[2]) * pka_std_range
-                    mean = float(pka_range[1])
-                    protonation_state = ProtSubstructFuncs.define_protonation_state(
-                        mean, std, min_ph, max_ph
-                    )
+            sub["name"] = name
+            sub["smart"] = smart
+            sub["mol"] = mol
+
+            prot = []
+            for pka_range in pka_ranges:
+                site = pka_range[0]
+                std = float(pka_range[2]) * pka_std_range
+                mean = float(pka_range[1])
+                protonation_state = ProtSubstructFuncs.define_protonation_state(
+                    mean, std, min_ph, max_ph
+                )
+
+                prot.append([site, protonation_state])
 
-                    prot.append([site, protonation_state])
+            sub["prot_states_for_pH"] = prot
+            subs.append(sub)
 
-                sub["prot_states_for_pH"] = prot
-                subs.append(sub)
-        return subs
+        # Concurrent callers may both compute the tables, but all of them get
+        # the one that is stored first.
+        return ProtSubstructFuncs._subs_for_ph.setdefault(key, subs)
 
     @staticmethod
     def define_protonation_state(mean, std, min_ph, max_ph):
@@ -798,7 +852,9 @@ class ProtSubstructFuncs:
         R-group list, subs. Items that are higher on the list will be matched
         first, to the exclusion of later items.
 
-        :param string smi: A SMILES string.
+        :param smi: A SMILES string, or a (standardized) Mol object, which is not
+            modified.
+        :type smi: str or rdkit.Chem.rdchem.Mol
         :param list subs: Substructure information.
         :return: A list of protonation sites (atom index), pKa bin.
             ('PROTONATED', 'BOTH', or  'DEPROTONATED'), and reaction name.
@@ -806,7 +862,10 @@ class ProtSubstructFuncs:
         """
 
         # Convert the Smiles string (smi) to an RDKit Mol Obj
-        mol_used_to_idx_sites = UtilFuncs.convert_smiles_str_to_mol(smi)
+        if isinstance(smi, str):
+            mol_used_to_idx_sites = UtilFuncs.convert_smiles_str_to_mol(smi)
+        else:
+            mol_used_to_idx_sites = smi
 
         # Check Conversion worked
         if mol_used_to_idx_sites is None:
@@ -817,12 +876,12 @@ class ProtSubstructFuncs:
         try:
             mol_used_to_idx_sites = Chem.AddHs(mol_used_to_idx_sites)
         except:
-            UtilFuncs.eprint("ERROR:   ", smi)
+            UtilFuncs.eprint("ERROR:   ", UtilFuncs.smiles_for_message(smi))
             return []
 
         # Check adding Hs worked
         if mol_used_to_idx_sites is None:
-            UtilFuncs.eprint("ERROR:   ", smi)
+            UtilFuncs.eprint("ERROR:   ", UtilFuncs.smiles_for_message(smi))
             return []
 
         ProtectUnprotectFuncs.unprotect_molecule(mol_used_to_idx_sites)
@@ -852,12 +911,113 @@ class ProtSubstructFuncs:
         return protonation_sites, mol_used_to_idx_sites
 
     @staticmethod
-    def protonate_site(mols, site):
+    def protonate_mol(mol, subs, args):
+        """Protonates a single (standardized) molecule.
+
+        :param rdkit.Chem.rdchem.Mol mol: The Mol object, see
+            UtilFuncs.standardize_mol. It is not modified.
+        :param list subs: Substructure information, see
+            load_protonation_substructs_calc_state_for_ph.
+        :param dict args: A dictionary containing the arguments.
+        :return: A list of the protonated Mol objects, with their atoms in the
+            order of their canonical SMILES strings (as if they were parsed from
+            them), and the list of protonation sites (see
+            get_prot_sites_and_target_states).
+        """
+
+        # Dimorphite-DL may protonate some sites in ways that produce invalid
+        # SMILES. We need to keep track of all mols so we can "rewind" to
+        # the last valid one, should things go south.
+        properly_formed_mol_found = [mol]
+
+        # sites is a list of (atom index, "PROTONATED|DEPROTONATED|BOTH",
+        # reaction name, mol). Note that the second entry indicates what state
+        # the site SHOULD be in (not the one it IS in per the SMILES string).
+        # It's calculated based on the probablistic distributions obtained
+        # during training.
+        (
+            sites,
+            mol_used_to_idx_sites,
+        ) = ProtSubstructFuncs.get_prot_sites_and_target_states(mol, subs)
+
+        # The atoms of the protonated molecules do not need to be protected.
+        for atom in mol_used_to_idx_sites.GetAtoms():
+            atom.ClearProp("_protected")
+
+        new_mols = [mol_used_to_idx_sites]
+        if len(sites) > 0:
+            for site in sites:
+                # Make a new smiles with the correct protonation state. Note that
+                # new_smis is a growing list. This is how multiple protonation
+                # sites are handled.
+                new_mols = ProtSubstructFuncs.protonate_site(new_mols, site, args)
+                if len(new_mols) > args["max_variants"]:
+                    new_mols = new_mols[: args["max_variants"]]
+                    if "silent" in args and not args["silent"]:
+                        UtilFuncs.eprint(
+                            "WARNING: Limited number of variants to "
+                            + str(args["max_variants"])
+                            + ": "
+                            + Chem.MolToSmiles(mol, isomericSmiles=True)
+                        )
+
+                # Go through each of these new molecules and add them to the
+                # properly_formed_mol_found, in case you generate a poorly
+                # formed SMILES in the future and have to "rewind."
+                properly_formed_mol_found += new_mols
+        else:
+            # Deprotonate the mols (because protonate_site never called to do
+            # it).
+            mol_used_to_idx_sites = Chem.RemoveHs(mol_used_to_idx_sites)
+            new_mols = [mol_used_to_idx_sites]
+
+            # Go through each of these new molecules and add them to the
+            # properly_formed_mol_found, in case you generate a poorly formed
+            # SMILES in the future and have to "rewind."
+            properly_formed_mol_found.append(mol_used_to_idx_sites)
+
+        # In some cases, the script might generate redundant molecules.
+        # Phosphonates, when the pH is between the two pKa values and the
+        # stdev value is big enough, for example, will generate two identical
+        # BOTH states. Let's remove this redundancy.
+        all_smis = [
+            Chem.MolToSmiles(m, isomericSmiles=True, canonical=True) for m in new_mols
+        ]
+        mols_by_smi = {}
+        for smi, m in zip(all_smis, new_mols):
+            mols_by_smi.setdefault(smi, m)
+        new_smis = list(set(all_smis))
+
+        # Sometimes Dimorphite-DL generates molecules that aren't actually
+        # possible. Eliminate the bad ones (that are None).
+        new_mols = []
+        for smi in new_smis:
+            new_mol = UtilFuncs.finalize_mol(mols_by_smi[smi], smi)
+            if new_mol is not None:
+                new_mols.append(new_mol)
+
+        # If there are no smi left, return the input one at the very least.
+        # All generated forms have apparently been judged
+        # inappropriate/malformed.
+        if len(new_mols) == 0:
+            properly_formed_mol_found.reverse()
+            for m in properly_formed_mol_found:
+                new_mol = UtilFuncs.convert_smiles_str_to_mol(Chem.MolToSmiles(m))
+                if new_mol is not None:
+                    new_mols = [new_mol]
+                    break
+
+        return new_mols, sites
+
+    @staticmethod
+    def protonate_site(mols, site, args=None):
         """Given a list of molecule objects, we protonate the site.
 
         :param list mols:  The list of molecule objects.
         :param tuple site: Information about the protonation site.
                            (idx, target_prot_state, prot_site_name)
+        :param dict args:  The arguments (warnings are printed unless
+                           args["silent"]), defaults to None.
         :return: A list of the appropriately protonated molecule objects.
         """
 
@@ -871,13 +1031,13 @@ class ProtSubstructFuncs:
 
         # Now make the actual smiles match the target protonation state.
         output_mols = ProtSubstructFuncs.set_protonation_charge(
-            mols, idx, charges, prot_site_name
+            mols, idx, charges, prot_site_name, args
         )
 
         return output_mols
 
     @staticmethod
-    def set_protonation_charge(mols, idx, charges, prot_site_name):
+    def set_protonation_charge(mols, idx, charges, prot_site_name, args=None):
         """Sets the atomic charge on a particular site for a set of SMILES.
 
         :param list mols:                  A list of the input molecule
@@ -886,6 +1046,9 @@ class ProtSubstructFuncs:
         :param list charges:               A list of the charges (ints) to
                                            assign at this site.
         :param string prot_site_name:      The name of the protonation site.
+        :param dict args:                  The arguments (warnings are printed
+                                           unless args["silent"]), defaults to
+                                           None.
         :return: A list of the processed (protonated/deprotonated) molecule
                  objects.
         """
@@ -914,7 +1077,7 @@ class ProtSubstructFuncs:
                 try:
                     mol_copy = Chem.RemoveHs(mol_copy)
                 except:
-                    if "silent" in ProtSubstructFuncs.args and not ProtSubstructFuncs.args["silent"]:
+                    if args and "silent" in args and not args["silent"]:
                         UtilFuncs.eprint(
                             "WARNING: Skipping poorly formed SMILES string: "
                             + Chem.MolToSmiles(mol_copy)
@@ -1363,6 +1526,158 @@ class TestFuncs:
         )
 
 
+class Protonator(object):
+    """A reusable protonation engine for RDKit Mol objects. The substructures and
+    the state tables of the pH range are prepared once, the molecules are
+    protonated without converting them to SMILES strings and back, and the
+    results of the most recent molecules are kept. A protonator can be shared
+    between threads, see protonate_many.
+
+    Example::
+
+        protonator = Protonator(min_ph=6.4, max_ph=8.4)
+        mols = protonator.protonate(Chem.MolFromSmiles("CC(=O)O"))
+    """
+
+    def __init__(
+        self,
+        min_ph=6.4,
+        max_ph=8.4,
+        pka_precision=1.0,
+        max_variants=128,
+        label_states=False,
+        silent=False,
+        cache_size=1024,
+    ):
+        """Initializes the protonator.
+
+        :param float min_ph: The minimum pH to consider, defaults to 6.4.
+        :param float max_ph: The maximum pH to consider, defaults to 8.4.
+        :param float pka_precision: The pKa precision factor (number of
+            standard deviations), defaults to 1.0.
+        :param int max_variants: The limit of variants per input compound,
+            defaults to 128.
+        :param bool label_states: Label the protonated Mol objects with the
+            target states of their sites (i.e., "DEPROTONATED", "PROTONATED",
+            or "BOTH", tab-separated) in the "target_states" property, like the
+            --label_states option labels the protonated SMILES. Defaults to
+            False.
+        :param bool silent: Do not print warnings, defaults to False.
+        :param int cache_size: The number of molecules whose results are kept
+            (by canonical SMILES), 0 disables the cache. Defaults to 1024.
+        """
+
+        self.args = {
+            "min_ph": min_ph,
+            "max_ph": max_ph,
+            "pka_precision": pka_precision,
+            "max_variants": max_variants,
+            "label_states": label_states,
+            "silent": silent,
+        }
+        self.subs = ProtSubstructFuncs.load_protonation_substructs_calc_state_for_ph(
+            min_ph, max_ph, pka_precision
+        )
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits, self.misses = 0, 0
+        self._lock = threading.Lock()
+
+    def protonate_smiles(self, smiles_str):
+        """Protonates a SMILES string.
+
+        :param string smiles_str: The SMILES string.
+        :return: A list of the protonated SMILES strings (empty if the SMILES
+            string is poorly formed).
+        :rtype: list
+        """
+
+        mol = UtilFuncs.convert_smiles_str_to_mol(smiles_str)
+        if mol is None:
+            if not self.args["silent"]:
+                UtilFuncs.eprint(
+                    "WARNING: Skipping poorly formed SMILES string: " + smiles_str
+                )
+            return []
+        return [Chem.MolToSmiles(m) for m in self.protonate(mol)]
+
+    def protonate(self, mol):
+        """Protonates an RDKit Mol object, like run_with_mol_list([mol]).
+
+        :param rdkit.Chem.rdchem.Mol mol: The molecule.
+        :return: A list of the protonated rdkit.Chem.rdchem.Mol objects, with the
+            properties of mol and their atoms in the order of their canonical
+            SMILES strings.
+        :rtype: list
+        """
+
+        key = Chem.MolToSmiles(mol, isomericSmiles=True)
+        with self._lock:
+            mols = self.cache.get(key)
+            if mols is not None:
+                self.hits += 1
+                self.cache.move_to_end(key)
+            else:
+                self.misses += 1
+        if mols is None:
+            # Not locked, other threads protonate their molecules meanwhile.
+            mols = self._protonate(mol, key)
+            if self.cache_size > 0:
+                with self._lock:
+                    self.cache[key] = mols
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+
+        props = mol.GetPropsAsDict()
+        protonated_mols = []
+        for m in mols:
+            # a copy, the cached molecule must not be modified
+            m = Chem.Mol(m)
+            UtilFuncs.set_props(m, props)
+            protonated_mols.append(m)
+        return protonated_mols
+
+    def protonate_many(self, mols, nr_of_threads=None):
+        """Protonates a list of RDKit Mol objects in a pool of threads. RDKit
+        releases the GIL during the substructure matching, so the molecules are
+        (partly) protonated concurrently.
+
+        :param list mols: The rdkit.Chem.rdchem.Mol objects.
+        :param int nr_of_threads: The number of threads, defaults to the number
+            of cpus.
+        :return: A list of the protonated molecules (see protonate) of each
+            molecule, in the order of mols.
+        :rtype: list
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(nr_of_threads or os.cpu_count()) as executor:
+            return list(executor.map(self.protonate, mols))
+
+    def _protonate(self, mol, smiles_str):
+        """Returns the protonated Mol objects of a molecule and its SMILES string."""
+
+        # Nothing to protonate in a molecule without atoms.
+        if mol.GetNumAtoms() == 0:
+            return []
+
+        mol = UtilFuncs.standardize_mol(mol)
+        if mol is None:
+            if not self.args["silent"]:
+                UtilFuncs.eprint(
+                    "WARNING: Skipping poorly formed SMILES string: " + smiles_str
+                )
+            return []
+
+        mols, sites = ProtSubstructFuncs.protonate_mol(mol, self.subs, self.args)
+        if self.args["label_states"]:
+            states = "\t".join([x[1] for x in sites])
+            for m in mols:
+                m.SetProp("target_states", states)
+        return mols
+
+
 def run(**kwargs):
     """A helpful, importable function for those who want to call Dimorphite-DL
     from another Python script rather than the command line. Note that this
@@ -1388,8 +1703,11 @@ def run_with_mol_list(mol_lst, **kwargs):
 
     :param mol_lst: A list of rdkit.Chem.rdchem.Mol objects.
     :type mol_lst: list
+    :param **kwargs: The options of Protonator (min_ph, max_ph,
+        pka_precision, max_variants, label_states and silent).
     :raises Exception: If the **kwargs includes "smiles", "smiles_file",
                        "output_file", or "test" parameters.
+    :raises TypeError: If the **kwargs includes any other unknown parameter.
     :return: A list of properly protonated rdkit.Chem.rdchem.Mol objects.
     :rtype: list
     """
@@ -1407,44 +1725,32 @@ def run_with_mol_list(mol_lst, **kwargs):
             UtilFuncs.eprint(msg)
             raise Exception(msg)
 
-    # Set the return_as_list flag so main() will return the protonated smiles
-    # as a list.
-    kwargs["return_as_list"] = True
-
-    # Having reviewed the code, it will be very difficult to rewrite it so
-    # that a list of Mol objects can be used directly. Intead, convert this
-    # list of mols to smiles and pass that. Not efficient, but it will work.
-    protonated_smiles_and_props = []
-    for m in mol_lst:
-        props = m.GetPropsAsDict()
-        kwargs["smiles"] = Chem.MolToSmiles(m, isomericSmiles=True)
-        protonated_smiles_and_props.extend(
-            [(s.split("\t")[0], props) for s in main(kwargs)]
-        )
+    # The molecules are protonated directly, without converting them to SMILES
+    # strings and back.
+    options = [
+        "min_ph",
+        "max_ph",
+        "pka_precision",
+        "max_variants",
+        "label_states",
+        "silent",
+    ]
+    for arg in kwargs:
+        if arg not in options:
+            msg = (
+                "You're using Dimorphite-DL's run_with_mol_list(mol_lst, "
+                + '**kwargs) function, but "'
+                + arg
+                + '" is not one of its parameters: '
+                + ", ".join(options)
+            )
+            UtilFuncs.eprint(msg)
+            raise TypeError(msg)
 
-    # Now convert the list of protonated smiles strings back to RDKit Mol
-    # objects. Also, add back in the properties from the original mol objects.
+    protonator = Protonator(cache_size=0, **kwargs)
     mols = []
-    for s, props in protonated_smiles_and_props:
-        m = Chem.MolFromSmiles(s)
-        if m:
-            for prop, val in props.items():
-                if type(val) is int:
-                    m.SetIntProp(prop, val)
-                elif type(val) is float:
-                    m.SetDoubleProp(prop, val)
-                elif type(val) is bool:
-                    m.SetBoolProp(prop, val)
-                else:
-                    m.SetProp(prop, str(val))
-            mols.append(m)
-        else:
-            UtilFuncs.eprint(
-                "WARNING: Could not process molecule with SMILES string "
-                + s
-                + " and properties "
-                + str(props)
-            )
+    for m in mol_lst:
+        mols.extend(protonator.protonate(m))
 
     return mols
 
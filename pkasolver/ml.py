@@ -1,6 +1,8 @@
+from dataclasses import dataclass, fields, replace
 from typing import Tuple
 
 import numpy as np
+import torch
 from torch_geometric.loader import DataLoader
 
 from pkasolver.constants import DEVICE
@@ -28,6 +30,84 @@ def dataset_to_dataloader(
     )
 
 
+@dataclass
+class PairBatch:
+    """Collated PairData for inference, see collate_pairs.
+    Holds the same tensors the models read from a torch_geometric Batch
+    created with follow_batch=["x_p", "x_d"]."""
+
+    x_p: torch.Tensor
+    x_d: torch.Tensor
+    edge_index_p: torch.Tensor
+    edge_index_d: torch.Tensor
+    edge_attr_p: torch.Tensor
+    edge_attr_d: torch.Tensor
+    x_p_batch: torch.Tensor
+    x_d_batch: torch.Tensor
+    num_graphs: int
+
+    def to(self, device) -> "PairBatch":
+        """returns a PairBatch with all tensors on device, self is not modified"""
+        return replace(
+            self,
+            **{
+                field.name: getattr(self, field.name).to(device)
+                for field in fields(self)
+                if isinstance(getattr(self, field.name), torch.Tensor)
+            },
+        )
+
+    def slice_graphs(self, start: int, end: int) -> "PairBatch":
+        """returns a PairBatch of the graphs start to end (exclusive)"""
+        tensors = {}
+        for state in ["p", "d"]:
+            x_batch = getattr(self, f"x_{state}_batch")
+            edge_index = getattr(self, f"edge_index_{state}")
+            # the nodes of each graph are stored contiguously, in graph order
+            bounds = torch.tensor([start, end], device=x_batch.device)
+            first, last = torch.searchsorted(x_batch, bounds).tolist()
+            edges = (edge_index[0] >= first) & (edge_index[0] < last)
+            tensors[f"x_{state}"] = getattr(self, f"x_{state}")[first:last]
+            tensors[f"edge_index_{state}"] = edge_index[:, edges] - first
+            tensors[f"edge_attr_{state}"] = getattr(self, f"edge_attr_{state}")[edges]
+            tensors[f"x_{state}_batch"] = x_batch[first:last] - start
+        return PairBatch(num_graphs=end - start, **tensors)
+
+
+def collate_pairs(pairs: list) -> PairBatch:
+    """Collates a list of PairData into a PairBatch in the given order.
+    A lightweight alternative to dataset_to_dataloader for inference: every output
+    tensor is allocated once and filled with a single concatenation, the edge indices
+    are offset and the x_p_batch/x_d_batch vectors are built with vectorized operations.
+    ----------
+    pairs
+        non-empty list of PyG Paired Data
+    Returns
+    -------
+    PairBatch
+        tensors equal to those of the corresponding torch_geometric Batch
+    """
+    num_graphs = len(pairs)
+    graph_idx = torch.arange(num_graphs)
+    tensors = {}
+    for state in ["p", "d"]:
+        xs = [getattr(m, f"x_{state}") for m in pairs]
+        edge_indices = [getattr(m, f"edge_index_{state}") for m in pairs]
+        num_nodes = torch.tensor([x.size(0) for x in xs])
+        num_edges = torch.tensor([edge_index.size(1) for edge_index in edge_indices])
+        # edge indices of each graph are shifted by the number of nodes before it
+        node_offsets = torch.cumsum(num_nodes, 0) - num_nodes
+        edge_index = torch.cat(edge_indices, dim=1)
+        edge_index += node_offsets.repeat_interleave(num_edges)
+        tensors[f"x_{state}"] = torch.cat(xs)
+        tensors[f"edge_index_{state}"] = edge_index
+        tensors[f"edge_attr_{state}"] = torch.cat(
+            [getattr(m, f"edge_attr_{state}") for m in pairs]
+        )
+        tensors[f"x_{state}_batch"] = graph_idx.repeat_interleave(num_nodes)
+    return PairBatch(num_graphs=num_graphs, **tensors)
+
+
 def calculate_performance_of_model_on_data(
     model, loader: DataLoader
 ) -> Tuple[np.ndarray, np.ndarray]:
@@ -677,8 +677,8 @@ class GINPairV1(GCN):
             # run through linear layer
             return x
 
-        x_p_batch = data.x_p_batch.to(device=DEVICE)
-        x_d_batch = data.x_d_batch.to(device=DEVICE)
+        x_p_batch = data.x_p_batch.to(device=x_p.device)
+        x_d_batch = data.x_d_batch.to(device=x_d.device)
 
         x_p = _forward(x_p, data.edge_index_p, x_p_batch, self.GIN_p.forward)
         x_d = _forward(x_d, data.edge_index_d, x_d_batch, self.GIN_d.forward)
@@ -688,6 +688,40 @@ class GINPairV1(GCN):
         return self.final_lin(F.relu(x))
 
 
+class GINPairV1Student(GINPairV1):
+    """GINPairV1 with a second output for the standard deviation of an ensemble,
+    trained on the mean/std predictions of a GINPairV1 ensemble (knowledge distillation).
+    Returns a tensor of shape [nr_of_graphs, 2] with the predicted mean and std,
+    so reference_value of each PairData has to be [mean, std].
+    """
+
+    def __init__(
+        self,
+        num_node_features: int,
+        num_edge_features: int,
+        hidden_channels: int = 32,
+        num_layers: int = 4,
+        out_channels=32,
+        dropout=0.5,
+        attention=False,
+    ):
+        super().__init__(
+            num_node_features,
+            num_edge_features,
+            hidden_channels=hidden_channels,
+            num_layers=num_layers,
+            out_channels=out_channels,
+            dropout=dropout,
+            attention=attention,
+        )
+        self.final_lin = Linear(hidden_channels, 2, device=DEVICE)
+
+    def forward(self, x_p, x_d, edge_attr_p, edge_attr_d, data):
+        x = super().forward(x_p, x_d, edge_attr_p, edge_attr_d, data)
+        # the standard deviation has to be positive
+        return torch.stack([x[:, 0], F.softplus(x[:, 1])], dim=1)
+
+
 class GINPairV3(GCN):
     def __init__(
         self,
@@ -1038,6 +1072,214 @@ class NNConvPair(NNConvPairArchitecture, NNConvPairForward):
         return self._forward(x_p, x_d, edge_attr_p, edge_attr_d, data)
 
 
+#####################################
+#####################################
+# Fused ensemble of GINPairV1 models
+# (inference only)
+#####################################
+#####################################
+
+
+class StackedLinear(torch.nn.Module):
+    """Linear layer of M ensemble members with weights stacked along a leading member dimension.
+    Input is either shared by all members [N, in] or per member [M, N, in], output is [M, N, out].
+    Only the members `start` to `end` (exclusive, -1 for all) are evaluated.
+    """
+
+    def __init__(self, layer: list):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.stack([w.t() for w, _ in layer]), False)
+        self.bias = torch.nn.Parameter(torch.stack([b for _, b in layer]).unsqueeze(1), False)
+        self.nr_of_models = len(layer)
+
+    def forward(self, x, start: int = 0, end: int = -1):
+        if end < 0:
+            end = self.nr_of_models
+        weight, bias = self.weight[start:end], self.bias[start:end]
+        if x.dim() == 2:
+            # input is shared by all members: one GEMM for the whole ensemble
+            m, n_in, n_out = weight.shape
+            x = torch.mm(x, weight.transpose(0, 1).reshape(n_in, m * n_out))
+            return x.view(-1, m, n_out).transpose(0, 1) + bias
+        return torch.baddbmm(bias, x, weight)
+
+
+class StackedMLP(torch.nn.Module):
+    """StackedLinear layers with ReLU between them and, if `act_last` is set, after the last one."""
+
+    def __init__(self, linears: list, act_last: bool = False):
+        super().__init__()
+        self.lins = ModuleList([StackedLinear(layer) for layer in linears])
+        self.nr_of_layers = len(linears)
+        self.act_last = act_last
+
+    def forward(self, x, start: int = 0, end: int = -1):
+        for i, lin in enumerate(self.lins):
+            x = lin(x, start, end)
+            if i < self.nr_of_layers - 1 or self.act_last:
+                x = F.relu(x)
+        return x
+
+
+class StackedGINConv(torch.nn.Module):
+    """GINConv of M ensemble members: MLP((1 + eps) * x_i + sum_j x_j)."""
+
+    def __init__(self, eps: list, linears: list, act_last: bool):
+        super().__init__()
+        eps = torch.stack([e.reshape(1) for e in eps]).reshape(-1, 1, 1)
+        self.register_buffer("eps", eps)
+        self.has_eps = bool((eps != 0.0).any())
+        self.mlp = StackedMLP(linears, act_last)
+
+    def forward(self, x, edge_index, start: int = 0, end: int = -1):
+        node_dim = x.dim() - 2
+        messages = x.index_select(node_dim, edge_index[0])
+        out = torch.zeros_like(x).index_add_(node_dim, edge_index[1], messages)
+        if self.has_eps:
+            eps = self.eps[start:] if end < 0 else self.eps[start:end]
+            out = out + (1 + eps) * x
+        else:
+            out = out + x
+        return self.mlp(out, start, end)
+
+
+def _linear_params(lin: Linear) -> tuple:
+    return lin.weight.detach(), lin.bias.detach()
+
+
+def _fold_batch_norm(lin: tuple, norm) -> tuple:
+    """Folds an eval-mode BatchNorm1d into the preceding linear layer."""
+    norm = getattr(norm, "module", norm)  # torch_geometric BatchNorm wraps torch's
+    weight, bias = lin
+    scale = norm.weight.detach() / torch.sqrt(norm.running_var + norm.eps)
+    return (
+        weight * scale.unsqueeze(1),
+        (bias - norm.running_mean) * scale + norm.bias.detach(),
+    )
+
+
+def _is_identity(module) -> bool:
+    return module is None or isinstance(module, torch.nn.Identity)
+
+
+def _is_relu(act) -> bool:
+    return isinstance(act, ReLU) or act is F.relu or act == "relu"
+
+
+def _mlp_to_linears(mlp) -> list:
+    """Returns the (weight, bias) pairs of an MLP that alternates Linear (+ BatchNorm) and ReLU,
+    as built by torch_geometric's GIN (Sequential in older, MLP in newer releases)."""
+    if isinstance(mlp, Sequential):
+        layers = [l for l in mlp if not isinstance(l, torch.nn.Dropout)]
+        linears = []
+        for i, layer in enumerate(layers):
+            previous = layers[i - 1] if i > 0 else None
+            if isinstance(layer, Linear) and (i == 0 or _is_relu(previous)):
+                linears.append(_linear_params(layer))
+            elif isinstance(layer, torch.nn.BatchNorm1d) and isinstance(
+                previous, Linear
+            ):
+                linears[-1] = _fold_batch_norm(linears[-1], layer)
+            elif _is_relu(layer) and 0 < i < len(layers) - 1:
+                continue
+            else:
+                raise NotImplementedError(f"Unsupported GIN layer: {layer}")
+        return linears
+    # torch_geometric.nn.MLP
+    if getattr(mlp, "act_first", False) or not _is_relu(mlp.act):
+        raise NotImplementedError(f"Unsupported GIN MLP: {mlp}")
+    linears = [_linear_params(lin) for lin in mlp.lins]
+    for i, norm in enumerate(mlp.norms):
+        if not _is_identity(norm):
+            linears[i] = _fold_batch_norm(linears[i], norm)
+    return linears
+
+
+class StackedGINEncoder(torch.nn.Module):
+    """GIN encoder of M ensemble members followed by global mean pooling."""
+
+    def __init__(self, gins: list):
+        super().__init__()
+        gin = gins[0]
+        if getattr(gin, "jk", None) is not None or not _is_relu(gin.act):
+            raise NotImplementedError(f"Unsupported GIN configuration: {gin}")
+        # newer torch_geometric releases skip the activation after the last layer
+        # (and have no final linear layer), older ones apply both
+        act_after_last = getattr(gin, "jk_mode", "last") is not None
+        has_lin = getattr(gin, "lin", None) is not None
+
+        convs = []
+        for layer in range(gin.num_layers):
+            members = [m.convs[layer] for m in gins]
+            linears = [_mlp_to_linears(conv.nn) for conv in members]
+            norms = [getattr(m, "norms", None) for m in gins]
+            if norms[0] is not None and not _is_identity(norms[0][layer]):
+                linears = [
+                    l[:-1] + [_fold_batch_norm(l[-1], n[layer])]
+                    for l, n in zip(linears, norms)
+                ]
+            convs.append(
+                StackedGINConv(
+                    [conv.eps.detach() for conv in members],
+                    list(zip(*linears)),
+                    act_last=layer < gin.num_layers - 1 or act_after_last,
+                )
+            )
+        self.convs = ModuleList(convs)
+        self.lin = ModuleList(
+            [StackedMLP([[_linear_params(m.lin) for m in gins]])] if has_lin else []
+        )
+
+    def forward(
+        self, x, edge_index, batch, num_graphs: int, start: int = 0, end: int = -1
+    ):
+        for conv in self.convs:
+            x = conv(x, edge_index, start, end)
+        for lin in self.lin:
+            x = lin(x, start, end)
+        # global mean pooling for all members at once
+        out = x.new_zeros((x.size(0), num_graphs, x.size(2)))
+        out.index_add_(1, batch, x)
+        count = x.new_zeros(num_graphs).index_add_(0, batch, x.new_ones(batch.size(0)))
+        return out / count.clamp(min=1).view(1, -1, 1)
+
+
+class GINPairV1Ensemble(torch.nn.Module):
+    """Evaluates a list of trained GINPairV1 models in a single batched forward pass.
+    The weights of all members are stacked, so that the GIN_p/GIN_d encoders and the
+    `lins`/`final_lin` heads run once for the whole ensemble.
+    Returns a tensor of shape [nr_of_models, nr_of_graphs], or only the rows of the
+    members `start` to `end` (exclusive, -1 for all) if a subset is requested.
+    """
+
+    def __init__(self, models: list):
+        super().__init__()
+        self.GIN_p = StackedGINEncoder([m.GIN_p for m in models])
+        self.GIN_d = StackedGINEncoder([m.GIN_d for m in models])
+        head = [[_linear_params(lin) for lin in m.lins] for m in models]
+        for layers, m in zip(head, models):
+            layers.append(_linear_params(m.final_lin))
+        self.lins = StackedMLP(list(zip(*head)))
+        self.nr_of_models = len(models)
+
+    def forward(
+        self,
+        x_p,
+        x_d,
+        edge_index_p,
+        edge_index_d,
+        x_p_batch,
+        x_d_batch,
+        num_graphs: int,
+        start: int = 0,
+        end: int = -1,
+    ):
+        x_p = self.GIN_p(x_p, edge_index_p, x_p_batch, num_graphs, start, end)
+        x_d = self.GIN_d(x_d, edge_index_d, x_d_batch, num_graphs, start, end)
+        x = torch.cat([x_p, x_d], dim=2)
+        return self.lins(x, start, end).squeeze(2)
+
+
 #####################################
 #####################################
 #####################################
@@ -1181,7 +1423,7 @@ def gcn_full_training(
     results["training-set"] = []
     results["validation-set"] = []
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(
-        optimizer, patience=150, verbose=True, factor=0.5
+        optimizer, patience=150, factor=0.5
     )
 
     for epoch in pbar:
@@ -1,6 +1,11 @@
 # imports
+import hashlib
 import logging
+import os
+import threading
+from collections import OrderedDict
 from copy import deepcopy
+from itertools import islice
 from dataclasses import dataclass
 from operator import attrgetter
 from os import path
@@ -11,19 +16,21 @@ import svgutils.transform as sg
 import torch
 from rdkit import Chem, RDLogger
 from rdkit.Chem import Draw
+from torch_geometric.data import Batch
 from torch_geometric.loader import DataLoader
 
 from pkasolver.chem import create_conjugate
 from pkasolver.constants import DEVICE, EDGE_FEATURES, NODE_FEATURES
 from pkasolver.data import (
+    IncrementalFeaturizer,
     calculate_nr_of_features,
     make_features_dicts,
     mol_to_paired_mol_data,
 )
-from pkasolver.ml import dataset_to_dataloader
-from pkasolver.ml_architecture import GINPairV1
+from pkasolver.ml import PairBatch, collate_pairs
+from pkasolver.ml_architecture import GINPairV1, GINPairV1Ensemble, GINPairV1Student
 
-from dimorphite_dl.dimorphite_dl import run_with_mol_list
+from dimorphite_dl.dimorphite_dl import Protonator
 
 @dataclass
 class States:
@@ -33,6 +40,7 @@ class States:
     deprotonated_mol: Chem.Mol
     reaction_center_idx: int
     ph7_mol: Chem.Mol
+    nr_of_models: int = None  # ensemble members used for the pka prediction
 
 
 logger = logging.getLogger(__name__)
@@ -61,69 +69,801 @@ selected_node_features = make_features_dicts(NODE_FEATURES, node_feat_list)
 selected_edge_features = make_features_dicts(EDGE_FEATURES, edge_feat_list)
 
 
-class QueryModel:
-    def __init__(self):
+MODEL_DIR = path.join(path.dirname(__file__), "trained_model_without_epik")
+INFERENCE_BUNDLE = "ensemble.pt"
+ONNX_MODEL = "ensemble.onnx"
+STUDENT_MODEL = "student_best_model.pt"
+ONNX_INPUTS = ("x_p", "x_d", "edge_index_p", "edge_index_d", "x_p_batch", "x_d_batch")
+BACKENDS = ("torch", "onnx")
+NODE_BUDGET = 4096
+NR_OF_MODELS = 25
+PAIR_CACHE_SIZE = 65_536
+# the pre-screen estimates pKa values with the first PRESCREEN_MODELS members,
+# the full ensemble mean deviated at most 1.6 pKa units from it on the test sets
+PRESCREEN_MODELS = 5
+PRESCREEN_MARGIN = 2.5
+PRECISIONS = ("fp32", "bf16", "int8")
+COMPILED_CACHE_DIR = os.environ.get(
+    "PKASOLVER_CACHE_DIR", path.join(path.expanduser("~"), ".cache", "pkasolver")
+)
 
-        self.models = []
 
-        for i in range(25):
-            model_name, model_class = "GINPair", GINPairV1
-            model = model_class(
-                num_node_features, num_edge_features, hidden_channels=96
-            )
-            base_path = path.dirname(__file__)
-            if torch.cuda.is_available() == False:  # If only CPU is available
-                checkpoint = torch.load(
-                    f"{base_path}/trained_model_without_epik/best_model_{i}.pt",
-                    map_location=torch.device("cpu"),
-                )
+def _torch_load(file_name: str, device: torch.device, mmap: bool = False) -> dict:
+    """torch.load on device, memory-mapped and restricted to weights if torch supports it"""
+    try:
+        return torch.load(
+            file_name, map_location=device, weights_only=True, mmap=mmap
+        )
+    except TypeError:  # torch < 2.1 has no mmap (and < 1.13 no weights_only)
+        return torch.load(file_name, map_location=device)
+
+
+def export_inference_bundle(
+    model_dir: str = MODEL_DIR,
+    bundle_path: str = "",
+    nr_of_models: int = NR_OF_MODELS,
+    hidden_channels: int = 96,
+) -> str:
+    """Writes the model weights of all ensemble members into a single weights-only file
+    that can be memory-mapped by QueryModel (optimizer states are dropped).
+    The file also stores a digest of the weights, so that QueryModel does not have to
+    read all weights to compute its fingerprint.
+
+    Parameters
+    ----------
+    model_dir
+        directory containing the best_model_{i}.pt checkpoints
+    bundle_path
+        output file, defaults to {model_dir}/ensemble.pt
+    nr_of_models
+        number of ensemble members
+    hidden_channels
+        hidden_channels of the GINPairV1 members
+
+    Returns
+    -------
+    str
+        path of the written bundle
+    """
+    if not bundle_path:
+        bundle_path = path.join(model_dir, INFERENCE_BUNDLE)
+    model_state_dicts = []
+    for i in range(nr_of_models):
+        checkpoint = torch.load(
+            f"{model_dir}/best_model_{i}.pt", map_location=torch.device("cpu")
+        )
+        model_state_dicts.append(
+            {k: v.clone() for k, v in checkpoint["model_state_dict"].items()}
+        )
+    # write to a temporary file first, so that concurrent processes never see partial files
+    tmp_bundle_path = f"{bundle_path}.{os.getpid()}.tmp"
+    torch.save(
+        {
+            "model_class": "GINPairV1",
+            "hidden_channels": hidden_channels,
+            "num_node_features": num_node_features,
+            "num_edge_features": num_edge_features,
+            "weights_digest": _weights_digest(model_state_dicts),
+            "model_state_dicts": model_state_dicts,
+        },
+        tmp_bundle_path,
+    )
+    os.replace(tmp_bundle_path, bundle_path)
+    logger.info(f"Wrote {nr_of_models} models to {bundle_path}")
+    return bundle_path
+
+
+def _cached_inference_bundle(model_dir: str, cache_dir: str) -> str:
+    """Path of the inference bundle of the checkpoints in model_dir in cache_dir,
+    it is exported on first use. The file name is a hash of the path, size and
+    modification time of the checkpoints. Returns "" if the bundle can not be used."""
+    checkpoints = [f"{model_dir}/best_model_{i}.pt" for i in range(NR_OF_MODELS)]
+    if not cache_dir or not all(path.isfile(c) for c in checkpoints):
+        return ""
+    key = hashlib.sha256()
+    for checkpoint in checkpoints:
+        stat = os.stat(checkpoint)
+        key.update(path.realpath(checkpoint).encode())
+        key.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    bundle_path = path.join(cache_dir, f"bundle_{key.hexdigest()[:24]}.pt")
+    if path.isfile(bundle_path):
+        return bundle_path
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        return export_inference_bundle(model_dir, bundle_path)
+    except OSError as e:
+        logger.warning(f"Could not write {bundle_path}, loading the checkpoints: {e!r}")
+        return ""
+
+
+def _update_fingerprint(fingerprint, state_dict: dict):
+    """adds the names and values of all tensors of state_dict to a hashlib hash"""
+    for name, tensor in state_dict.items():
+        fingerprint.update(name.encode())
+        fingerprint.update(tensor.detach().cpu().numpy().tobytes())
+
+
+def _weights_digest(model_state_dicts) -> str:
+    """hash of the weights of all ensemble members (see export_inference_bundle)"""
+    digest = hashlib.sha256()
+    for model_state_dict in model_state_dicts:
+        _update_fingerprint(digest, model_state_dict)
+    return digest.hexdigest()
+
+
+def compile_ensemble(
+    ensemble: GINPairV1Ensemble, cache_dir: str = COMPILED_CACHE_DIR, device=None
+) -> torch.jit.ScriptModule:
+    """Compiles a GINPairV1Ensemble with TorchScript.
+    The compiled module is cached in cache_dir under a hash of the ensemble weights and
+    the torch version, so that later processes load it instead of compiling it again.
+
+    Parameters
+    ----------
+    ensemble
+        fused ensemble in eval mode
+    cache_dir
+        directory of the cached compiled modules, no caching if empty
+    device
+        torch device the compiled module is loaded on, defaults to pkasolver.constants.DEVICE
+
+    Returns
+    -------
+    torch.jit.ScriptModule
+        compiled ensemble taking the same (plain tensor) arguments as GINPairV1Ensemble
+    """
+    device = device or DEVICE
+    if not cache_dir:
+        return torch.jit.script(ensemble)
+
+    fingerprint = hashlib.sha256(torch.__version__.encode())
+    _update_fingerprint(fingerprint, ensemble.state_dict())
+    file_name = path.join(cache_dir, f"ensemble_{fingerprint.hexdigest()[:24]}.pt")
+    if path.isfile(file_name):
+        try:
+            return torch.jit.load(file_name, map_location=device)
+        except RuntimeError:
+            logger.warning(f"Could not load {file_name}, compiling again")
+
+    compiled = torch.jit.script(ensemble)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first, so that concurrent processes never see partial files
+    tmp_file_name = f"{file_name}.{os.getpid()}.tmp"
+    torch.jit.save(compiled, tmp_file_name)
+    os.replace(tmp_file_name, file_name)
+    logger.info(f"Cached compiled ensemble in {file_name}")
+    return compiled
+
+
+class _ONNXEnsemble(torch.nn.Module):
+    """GINPairV1Ensemble that derives the number of graphs from the batch vector,
+    so that the exported graph only takes tensors (see ONNX_INPUTS)"""
+
+    def __init__(self, ensemble: GINPairV1Ensemble):
+        super().__init__()
+        self.ensemble = ensemble
+
+    def forward(self, x_p, x_d, edge_index_p, edge_index_d, x_p_batch, x_d_batch):
+        num_graphs = int(x_p_batch.max()) + 1
+        return self.ensemble(
+            x_p, x_d, edge_index_p, edge_index_d, x_p_batch, x_d_batch, num_graphs
+        )
+
+
+def export_onnx(model_dir: str = MODEL_DIR, onnx_path: str = "") -> str:
+    """Exports the fused ensemble to ONNX with dynamic numbers of nodes, edges and graphs,
+    to be used with QueryModel(backend="onnx"). Needs torch >= 2.5 and onnxscript.
+    Only the forward pass runs in onnxruntime, pkasolver still needs torch and
+    torch_geometric for featurization, so this is not a torch-free deployment.
+
+    Parameters
+    ----------
+    model_dir
+        directory containing the trained models
+    onnx_path
+        output file, defaults to {model_dir}/ensemble.onnx
+
+    Returns
+    -------
+    str
+        path of the written ONNX model
+    """
+    from torch.export import Dim
+
+    if not onnx_path:
+        onnx_path = path.join(model_dir, ONNX_MODEL)
+    ensemble = QueryModel(model_dir=model_dir, device="cpu").ensemble
+
+    # two example pairs, so that nothing is specialized on a single graph
+    pairs = [
+        (Chem.MolFromSmiles("CC(=O)O"), Chem.MolFromSmiles("CC(=O)[O-]"), 3),
+        (Chem.MolFromSmiles("C[NH3+]"), Chem.MolFromSmiles("CN"), 1),
+    ]
+    dataset = [
+        mol_to_paired_mol_data(
+            *pair, selected_node_features, selected_edge_features
+        )
+        for pair in pairs
+    ]
+    data = collate_pairs(dataset)
+
+    nodes_p, nodes_d = Dim("nodes_p"), Dim("nodes_d")
+    dynamic_shapes = {
+        "x_p": {0: nodes_p},
+        "x_d": {0: nodes_d},
+        "edge_index_p": {1: Dim("edges_p")},
+        "edge_index_d": {1: Dim("edges_d")},
+        "x_p_batch": {0: nodes_p},
+        "x_d_batch": {0: nodes_d},
+    }
+    torch.onnx.export(
+        _ONNXEnsemble(ensemble),
+        tuple(getattr(data, name) for name in ONNX_INPUTS),
+        onnx_path,
+        input_names=list(ONNX_INPUTS),
+        output_names=["pka"],
+        dynamic_shapes=dynamic_shapes,
+        dynamo=True,
+        external_data=False,
+    )
+    logger.info(f"Wrote ONNX model to {onnx_path}")
+    return onnx_path
+
+
+def _batches(pairs, node_budget: int = NODE_BUDGET):
+    """Collates PairData into batches (see pkasolver.ml.collate_pairs) of at most
+    node_budget nodes (x_p and x_d); a single pair that exceeds the budget gets a batch
+    of its own. A pre-collated Batch or PairBatch within the budget is passed on as is,
+    larger ones are split."""
+    if isinstance(pairs, PairBatch):
+        sizes = torch.bincount(pairs.x_p_batch, minlength=pairs.num_graphs)
+        sizes += torch.bincount(pairs.x_d_batch, minlength=pairs.num_graphs)
+        start, nr_of_nodes = 0, 0
+        for i, n in enumerate(sizes.tolist()):
+            if i > start and nr_of_nodes + n > node_budget:
+                yield pairs.slice_graphs(start, i)
+                start, nr_of_nodes = i, 0
+            nr_of_nodes += n
+        yield pairs if start == 0 else pairs.slice_graphs(start, pairs.num_graphs)
+        return
+    if isinstance(pairs, Batch):
+        if pairs.x_p.size(0) + pairs.x_d.size(0) <= node_budget:
+            yield pairs
+            return
+        pairs = pairs.to_data_list()
+    batch, nr_of_nodes = [], 0
+    for m in pairs:
+        n = m.x_p.size(0) + m.x_d.size(0)
+        if batch and nr_of_nodes + n > node_budget:
+            yield collate_pairs(batch)
+            batch, nr_of_nodes = [], 0
+        batch.append(m)
+        nr_of_nodes += n
+    if batch:
+        yield collate_pairs(batch)
+
+
+class PairCache:
+    """Bounded LRU cache of (pka, pka_stddev, nr of used members) predictions of
+    protonated/deprotonated pairs, with hit and miss counters."""
+
+    def __init__(self, maxsize: int = PAIR_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits, self.misses = 0, 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(
+        protonated_mol: Chem.Mol,
+        deprotonated_mol: Chem.Mol,
+        reaction_center_idx: int,
+        tolerance: float = None,
+    ) -> tuple:
+        """canonical SMILES of both states, the canonical rank of the reaction center
+        (symmetry-equivalent centers share a rank) and the tolerance of the prediction"""
+        rank = Chem.CanonicalRankAtoms(protonated_mol, breakTies=False)
+        return (
+            Chem.MolToSmiles(protonated_mol),
+            Chem.MolToSmiles(deprotonated_mol),
+            rank[reaction_center_idx],
+            tolerance,
+        )
+
+    def peek(self, key: tuple):
+        """like get, but without counting and without marking the entry as used"""
+        with self._lock:
+            return self._entries.get(key)
+
+    def get(self, key: tuple):
+        """returns the cached prediction for key, None if there is none"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
             else:
-                checkpoint = torch.load(
-                    f"{base_path}/trained_model_without_epik/best_model_{i}.pt"
-                )
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: tuple, value: tuple):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """removes all entries and resets the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits, self.misses = 0, 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __getstate__(self) -> dict:
+        # worker processes start with an empty cache of their own
+        return {"maxsize": self.maxsize}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state["maxsize"])
+
+
+@dataclass
+class PrescreenStatistics:
+    """Counters of the pre-screen of calculate_microstate_pka_values(prescreen=True)"""
+
+    nr_of_screened: int = 0  # candidates whose pKa was estimated by the first members
+    nr_of_skipped: int = 0  # of these, candidates dropped without evaluating the ensemble
+
+
+class QueryModel:
+    def __init__(
+        self,
+        model_dir: str = MODEL_DIR,
+        device: str = None,
+        precision: str = "fp32",
+        fused: bool = True,
+        compiled: bool = False,
+        cache_dir: str = COMPILED_CACHE_DIR,
+        backend: str = "torch",
+        fast: bool = False,
+        pair_cache_size: int = PAIR_CACHE_SIZE,
+    ):
+        """Loads the ensemble of trained GINPairV1 models.
+        All members are memory-mapped from a single inference bundle
+        (see export_inference_bundle): {model_dir}/ensemble.pt if it exists, otherwise one
+        that is exported from the best_model_{i}.pt checkpoints into cache_dir on first use.
+        Without cache_dir, the checkpoints are loaded directly.
+        Use get_query_model() to share one loaded ensemble within a process.
+
+        Parameters
+        ----------
+        model_dir
+            directory containing the trained models
+        device
+            torch device the models are placed on, defaults to pkasolver.constants.DEVICE
+        precision
+            numerical precision used for inference, one of PRECISIONS:
+            "fp32" (default), "bf16" (bfloat16 autocast) or
+            "int8" (dynamic int8 quantization of all Linear layers, CPU only)
+        fused
+            if True, the weights of all members are stacked into a single GINPairV1Ensemble
+            that predicts with the whole ensemble in one forward pass,
+            if False the members are evaluated one after another
+            (int8 always evaluates the quantized members one after another)
+        compiled
+            if True, the fused ensemble is compiled with TorchScript (see compile_ensemble),
+            which removes most of the python overhead per call
+        cache_dir
+            directory in which inference bundles and compiled ensembles are cached,
+            defaults to $PKASOLVER_CACHE_DIR or ~/.cache/pkasolver
+        backend
+            "torch" or "onnx", which runs {model_dir}/ensemble.onnx (see export_onnx)
+            with onnxruntime on cpu (fp32 only, the other options are ignored);
+            it only replaces the torch forward pass and loads faster, featurization
+            still builds torch tensors, so torch and torch_geometric remain required
+        fast
+            if True, {model_dir}/student_best_model.pt (see scripts/distill_ensemble.py)
+            is loaded instead of the ensemble: a single GINPairV1Student that predicts
+            the ensemble mean and standard deviation in one pass
+        pair_cache_size
+            maximum number of pair predictions kept in self.pair_cache (see PairCache),
+            which calculate_microstate_pka_values uses to skip pairs it has seen before;
+            0 disables the cache
+
+        The attribute fingerprint identifies the loaded weights, backend and precision,
+        it is part of the keys of the persistent ResultCache (see pkasolver.cache).
+        """
 
-            model.load_state_dict(checkpoint["model_state_dict"])
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {PRECISIONS}, got {precision}")
+        if backend not in BACKENDS:
+            raise ValueError(f"backend must be one of {BACKENDS}, got {backend}")
+        self.precision = precision
+        self.device = torch.device(device) if device else DEVICE
+        if precision == "int8" and self.device.type != "cpu":
+            raise ValueError("int8 quantization is only supported on cpu")
+        self.model_dir = model_dir
+        self.models, self.ensemble, self.session, self.student = [], None, None, None
+        self.pair_cache = PairCache(pair_cache_size)
+        self.prescreen_statistics = PrescreenStatistics()
+        fingerprint = hashlib.sha256(f"{backend}:{fast}:{precision}".encode())
+
+        if backend == "onnx":
+            import onnxruntime
+
+            if precision != "fp32":
+                raise ValueError("the onnx backend only supports fp32")
+            self.device = torch.device("cpu")
+            onnx_path = path.join(model_dir, ONNX_MODEL)
+            self.session = onnxruntime.InferenceSession(
+                onnx_path, providers=["CPUExecutionProvider"]
+            )
+            self.nr_of_models = self.session.get_outputs()[0].shape[0]
+            with open(onnx_path, "rb") as f:
+                fingerprint.update(f.read())
+            self.fingerprint = fingerprint.hexdigest()[:24]
+            return
+
+        if fast:
+            model_state_dict = _torch_load(
+                path.join(model_dir, STUDENT_MODEL), self.device
+            )["model_state_dict"]
+            _update_fingerprint(fingerprint, model_state_dict)
+            self.fingerprint = fingerprint.hexdigest()[:24]
+            self.student = GINPairV1Student(
+                num_node_features,
+                num_edge_features,
+                hidden_channels=model_state_dict["final_lin.weight"].shape[1],
+            )
+            self.student.load_state_dict(model_state_dict)
+            self.student.eval()
+            self.student.to(device=self.device)
+            if precision == "int8":
+                self.student = torch.quantization.quantize_dynamic(
+                    self.student, {torch.nn.Linear}, dtype=torch.qint8
+                )
+            self.nr_of_models = 1
+            return
+
+        bundle_path = path.join(model_dir, INFERENCE_BUNDLE)
+        if not path.isfile(bundle_path):
+            bundle_path = _cached_inference_bundle(model_dir, cache_dir)
+        if bundle_path:
+            bundle = _torch_load(bundle_path, self.device, mmap=True)
+            assert bundle["num_node_features"] == num_node_features
+            assert bundle["num_edge_features"] == num_edge_features
+            hidden_channels = bundle["hidden_channels"]
+            model_state_dicts = bundle["model_state_dicts"]
+            # reading the stored digest leaves the memory-mapped weights untouched
+            weights_digest = bundle.get("weights_digest")
+        else:
+            hidden_channels = 96
+            model_state_dicts = [
+                _torch_load(f"{model_dir}/best_model_{i}.pt", self.device)[
+                    "model_state_dict"
+                ]
+                for i in range(NR_OF_MODELS)
+            ]
+            weights_digest = None
+        if weights_digest is None:
+            weights_digest = _weights_digest(model_state_dicts)
+        fingerprint.update(weights_digest.encode())
+
+        for model_state_dict in model_state_dicts:
+            model = GINPairV1(
+                num_node_features, num_edge_features, hidden_channels=hidden_channels
+            )
+            model.load_state_dict(model_state_dict)
             model.eval()
-            model.to(device=DEVICE)
+            model.to(device=self.device)
+            if precision == "int8":
+                model = torch.quantization.quantize_dynamic(
+                    model, {torch.nn.Linear}, dtype=torch.qint8
+                )
             self.models.append(model)
+        self.nr_of_models = len(self.models)
+        self.fingerprint = fingerprint.hexdigest()[:24]
+
+        if fused and precision == "int8":
+            logger.info("int8 quantized members are evaluated one after another")
+        elif fused:
+            self.ensemble = GINPairV1Ensemble(self.models)
+            self.ensemble.eval()
+            self.ensemble.to(device=self.device)
+            if compiled:
+                self.ensemble = compile_ensemble(self.ensemble, cache_dir, self.device)
+        elif compiled:
+            logger.info("Only the fused ensemble can be compiled")
+
+    def share_memory(self) -> "QueryModel":
+        """Moves the parameters and buffers of all models into shared memory.
+        Worker processes that receive this QueryModel (forked, or through
+        torch.multiprocessing, see init_worker) then use the weights of the parent
+        instead of holding their own copies. Returns self.
+        """
+        for module in self.models + [self.ensemble, self.student]:
+            if module is not None:
+                module.share_memory()
+        return self
+
+    def _predict_members(self, data, start: int = 0, end: int = -1) -> torch.Tensor:
+        """Returns the predictions of the members start to end (exclusive, -1 for all)
+        for a collated batch of PairData, shape [nr_of_members, nr_of_graphs]"""
+        if self.session is not None:
+            # the exported graph always evaluates the whole ensemble
+            inputs = {name: getattr(data, name).numpy() for name in ONNX_INPUTS}
+            predictions = torch.from_numpy(self.session.run(None, inputs)[0])
+            return predictions[start:] if end < 0 else predictions[start:end]
+        with torch.no_grad(), torch.autocast(
+            self.device.type, dtype=torch.bfloat16, enabled=self.precision == "bf16"
+        ):
+            if self.ensemble is not None:
+                return self.ensemble(
+                    x_p=data.x_p,
+                    x_d=data.x_d,
+                    edge_index_p=data.edge_index_p,
+                    edge_index_d=data.edge_index_d,
+                    x_p_batch=data.x_p_batch,
+                    x_d_batch=data.x_d_batch,
+                    num_graphs=data.num_graphs,
+                    start=start,
+                    end=end,
+                )
+            models = self.models[start:] if end < 0 else self.models[start:end]
+            return torch.stack(
+                [
+                    model(
+                        x_p=data.x_p,
+                        x_d=data.x_d,
+                        edge_attr_p=data.edge_attr_p,
+                        edge_attr_d=data.edge_attr_d,
+                        data=data,
+                    ).reshape(-1)
+                    for model in models
+                ]
+            )
+
+    def predict(
+        self,
+        data,
+        tolerance: float = None,
+        min_models: int = 5,
+        first_predictions: torch.Tensor = None,
+    ) -> tuple:
+        """Predicts pKa values for a collated batch of PairData.
+        If a tolerance is given, the members are evaluated in their fixed order in steps of
+        min_models and, for each pair, the evaluation stops as soon as the standard error
+        of the mean (std / sqrt(n)) is at most tolerance.
+
+        Parameters
+        ----------
+        data
+            collated batch of PairData
+        tolerance
+            standard error of the mean (in pKa units) at which the ensemble evaluation
+            is stopped, if None all members are used
+        min_models
+            number of members evaluated before the first convergence check and
+            number of members added per step
+        first_predictions
+            already evaluated predictions of the first members,
+            shape [nr_of_members, nr_of_graphs], the evaluation continues after them
 
-    def predict_pka_value(self, loader: DataLoader) -> np.ndarray:
+        Returns
+        -------
+        tuple
+            arrays of predicted pKa values, their standard deviation and the number of
+            members used for each pair
+        """
+        # a PairBatch is copied, a torch_geometric Batch is moved in place (Batch.to)
+        data = data.to(device=self.device)
+        if self.student is not None:
+            # the student predicts mean and std directly, tolerance does not apply
+            with torch.no_grad(), torch.autocast(
+                self.device.type, dtype=torch.bfloat16, enabled=self.precision == "bf16"
+            ):
+                out = self.student(
+                    x_p=data.x_p,
+                    x_d=data.x_d,
+                    edge_attr_p=data.edge_attr_p,
+                    edge_attr_d=data.edge_attr_d,
+                    data=data,
+                )
+            out = out.double().cpu().numpy()
+            return out[:, 0], out[:, 1], np.ones(data.num_graphs, dtype=int)
+        nr_of_models = self.nr_of_models
+        nr_of_used_models = torch.full(
+            (data.num_graphs,), nr_of_models, dtype=torch.long
+        )
+        if first_predictions is None:
+            first_predictions = torch.zeros((0, data.num_graphs), dtype=torch.double)
+        predictions = first_predictions.double().to(self.device)
+        if tolerance is None:
+            if predictions.size(0) < nr_of_models:
+                more = self._predict_members(data, predictions.size(0))
+                predictions = torch.cat([predictions, more.double()])
+        else:
+            if self.session is not None:
+                # the exported graph always evaluates all members, only slice its output
+                all_predictions = self._predict_members(data)
+                members = lambda start, end: all_predictions[start:end]
+            else:
+                members = lambda start, end: self._predict_members(data, start, end)
+            step = max(min_models, 2)  # a standard error needs two members
+            if predictions.size(0) < min(step, nr_of_models):
+                more = members(predictions.size(0), min(step, nr_of_models))
+                predictions = torch.cat([predictions, more.double()])
+            converged = torch.zeros(data.num_graphs, dtype=torch.bool)
+            while True:
+                n = predictions.size(0)
+                sem = predictions.std(dim=0, unbiased=True).cpu() / np.sqrt(n)
+                newly_converged = ~converged & (sem <= tolerance)
+                nr_of_used_models[newly_converged] = n
+                converged |= newly_converged
+                if n >= nr_of_models or bool(converged.all()):
+                    break
+                # converged pairs are carried along, but ignore the added members
+                more = members(n, min(n + step, nr_of_models))
+                predictions = torch.cat([predictions, more.double()])
+        # mean and (population) standard deviation over the members used for each pair
+        used = nr_of_used_models.to(predictions.device)
+        mask = torch.arange(predictions.size(0), device=predictions.device).unsqueeze(1)
+        mask = (mask < used).double()
+        mean = (predictions * mask).sum(dim=0) / used
+        std = torch.sqrt((((predictions - mean) * mask) ** 2).sum(dim=0) / used)
+        return mean.cpu().numpy(), std.cpu().numpy(), nr_of_used_models.numpy()
+
+    def predict_pka_values(
+        self, pairs, node_budget: int = NODE_BUDGET, tolerance: float = None
+    ) -> tuple:
+        """Predicts pKa values for any number of pairs.
+
+        Parameters
+        ----------
+        pairs
+            list of PairData or a collated Batch of PairData
+        node_budget
+            maximum number of nodes (x_p and x_d) per forward pass,
+            larger inputs are split into several batches
+        tolerance
+            see QueryModel.predict
+
+        Returns
+        -------
+        tuple
+            arrays of predicted pKa values and their standard deviation, in the order of pairs
+        """
+        pka, pka_std, _ = self._predict_all(pairs, node_budget, tolerance)
+        return pka, pka_std
+
+    def _predict_all(
+        self,
+        pairs,
+        node_budget: int = NODE_BUDGET,
+        tolerance: float = None,
+        first_predictions: np.ndarray = None,
+    ) -> tuple:
+        """like predict_pka_values, but also returns the number of used members,
+        first_predictions (shape [nr_of_members, nr_of_pairs]) see QueryModel.predict"""
+        results = [np.zeros(0)], [np.zeros(0)], [np.zeros(0, dtype=int)]
+        offset = 0
+        for data in _batches(pairs, node_budget):
+            first = None
+            if first_predictions is not None:
+                first = first_predictions[:, offset : offset + data.num_graphs]
+                first = torch.from_numpy(first)
+                offset += data.num_graphs
+            for result, values in zip(results, self.predict(data, tolerance, 5, first)):
+                result.append(values)
+        return tuple(np.concatenate(result) for result in results)
+
+    def _predict_first_members(
+        self, pairs, nr_of_models: int, node_budget: int = NODE_BUDGET
+    ) -> np.ndarray:
+        """predictions of the first nr_of_models members, shape [nr_of_models, nr_of_pairs]"""
+        predictions = [np.zeros((nr_of_models, 0))]
+        for data in _batches(pairs, node_budget):
+            data = data.to(device=self.device)
+            members = self._predict_members(data, 0, nr_of_models)
+            predictions.append(members.double().cpu().numpy())
+        return np.concatenate(predictions, axis=1)
+
+    def predict_pka_value(self, loader: DataLoader, tolerance: float = None) -> list:
         """
         ----------
         loader
             data to be predicted
+        tolerance
+            see QueryModel.predict
         Returns
         -------
-        np.array
-            list of predicted pKa values
+        list
+            predicted pKa value and its standard deviation
         """
 
         results = []
         assert len(loader) == 1
         for data in loader:  # Iterate in batches over the training dataset.
-            data.to(device=DEVICE)
-            consensus_r = []
-            for model in self.models:
-                y_pred = (
-                    model(
-                        x_p=data.x_p,
-                        x_d=data.x_d,
-                        edge_attr_p=data.edge_attr_p,
-                        edge_attr_d=data.edge_attr_d,
-                        data=data,
-                    )
-                    .reshape(-1)
-                    .detach()
-                )
+            mean, std, _ = self.predict(data, tolerance)
+            results.extend((float(mean[0]), float(std[0])))
+        return results
 
-                consensus_r.append(y_pred.tolist())
-            results.extend(
-                (
-                    float(np.average(consensus_r, axis=0)),
-                    float(np.std(consensus_r, axis=0)),
-                )
+
+_query_models = {}
+_query_models_lock = threading.Lock()
+
+
+def _device_key(device) -> str:
+    """the device as a string that is the same for all names of the device:
+    "cpu" for the cpu, "type:index" with the current index if there is none (e.g. "cuda")"""
+    device = torch.device(device) if device else torch.device(DEVICE)
+    if device.type == "cpu":
+        return "cpu"
+    if device.index is None:
+        module = getattr(torch, device.type, None)
+        index = 0
+        if module is not None and module.is_available():
+            index = module.current_device()
+        device = torch.device(device.type, index)
+    return str(device)
+
+
+def _query_model_key(model_dir: str, device: str, precision: str) -> tuple:
+    return (path.realpath(model_dir), _device_key(device), precision)
+
+
+def get_query_model(
+    model_dir: str = MODEL_DIR, device: str = None, precision: str = "fp32"
+) -> QueryModel:
+    """Returns the QueryModel for model_dir/device/precision, loading it on first use.
+    All callers in a process share the same loaded ensemble; this function is thread-safe.
+    """
+    key = _query_model_key(model_dir, device, precision)
+    with _query_models_lock:
+        if key not in _query_models:
+            logger.debug(f"Loading QueryModel for {key}")
+            _query_models[key] = QueryModel(
+                model_dir=model_dir, device=device, precision=precision
             )
-        return results
+        return _query_models[key]
+
+
+def init_worker(query_model: QueryModel):
+    """Initializer for process pools, e.g.
+    Pool(initializer=init_worker, initargs=(get_query_model().share_memory(),)).
+    Registers the QueryModel of the parent, so that get_query_model() in the worker
+    returns it instead of loading the checkpoints again.
+    """
+    key = _query_model_key(
+        query_model.model_dir, str(query_model.device), query_model.precision
+    )
+    with _query_models_lock:
+        _query_models[key] = query_model
+
+
+def release_query_model(
+    model_dir: str = None, device: str = None, precision: str = None
+) -> int:
+    """Removes QueryModels from the registry so that they can be garbage collected.
+    Arguments that are None match every entry, i.e. release_query_model() releases all of them.
+    Returns the number of released models.
+    """
+    with _query_models_lock:
+        released = [
+            key
+            for key in _query_models
+            if (model_dir is None or key[0] == path.realpath(model_dir))
+            and (device is None or key[1] == _device_key(device))
+            and (precision is None or key[2] == precision)
+        ]
+        for key in released:
+            del _query_models[key]
+    return len(released)
 
 
 def _get_ionization_indices(mol_list: list, compare_to: Chem.Mol) -> list:
@@ -174,17 +914,26 @@ def _parse_dimorphite_dl_output():
     return mols
 
 
+_protonators = {}
+_protonators_lock = threading.Lock()
+
+
+def _get_protonator(min_ph: float, max_ph: float, pka_precision: float) -> Protonator:
+    """Returns the dimorphite_dl Protonator for the pH range, created on first use"""
+    key = (min_ph, max_ph, pka_precision)
+    with _protonators_lock:
+        if key not in _protonators:
+            _protonators[key] = Protonator(
+                min_ph=min_ph, max_ph=max_ph, pka_precision=pka_precision
+            )
+        return _protonators[key]
+
+
 def _call_dimorphite_dl(
     mol: Chem.Mol, min_ph: float, max_ph: float, pka_precision: float = 1.0
 ):
     """calls  dimorphite_dl with parameters"""
-    mols = run_with_mol_list(
-        [mol],
-        min_ph=min_ph,
-        max_ph=max_ph,
-        pka_precision=pka_precision,
-    )
-    return mols
+    return _get_protonator(min_ph, max_ph, pka_precision).protonate(mol)
 
 
 def _sort_conj(mols: list):
@@ -215,16 +964,343 @@ def _check_for_duplicates(states: list):
     return sorted([all_r[k] for k in all_r], key=attrgetter("pka"))
 
 
+def enumerate_protonation_pairs(mols: list, query_model: QueryModel = None) -> list:
+    """Returns the PairData of all protonation state pairs that
+    calculate_microstate_pka_values finds for the (unlabeled) molecules in mols."""
+    dataset = []
+    for mol in mols:
+        for state in calculate_microstate_pka_values(mol, query_model=query_model):
+            dataset.append(
+                mol_to_paired_mol_data(
+                    state.protonated_mol,
+                    state.deprotonated_mol,
+                    state.reaction_center_idx,
+                    selected_node_features,
+                    selected_edge_features,
+                )
+            )
+    return dataset
+
+
+def label_with_ensemble(
+    dataset: list, query_model: QueryModel = None, batch_size: int = 64
+) -> list:
+    """Sets reference_value of each PairData in dataset to the [mean, std] predicted
+    by the ensemble, the training targets of GINPairV1Student."""
+    if query_model is None:
+        query_model = get_query_model()
+    targets = []
+    for i in range(0, len(dataset), batch_size):
+        pka, pka_std, _ = query_model.predict(collate_pairs(dataset[i : i + batch_size]))
+        targets.extend(zip(pka, pka_std))
+    for m, target in zip(dataset, targets):
+        m.reference_value = torch.tensor(target, dtype=torch.float32)
+    return dataset
+
+
+def _to_states(candidates: list, predictions: list, ph7_mol) -> list:
+    """Returns the (protonated mol, deprotonated mol, reaction center idx) candidates
+    with their (pka, pka_stddev, nr of used members) predictions as States"""
+    return [
+        States(
+            float(pka),
+            float(pka_std),
+            protonated_mol,
+            deprotonated_mol,
+            reaction_center_idx=idx,
+            ph7_mol=ph7_mol,
+            nr_of_models=int(nr_of_models),
+        )
+        for (protonated_mol, deprotonated_mol, idx), (pka, pka_std, nr_of_models) in zip(
+            candidates, predictions
+        )
+    ]
+
+
+class _Screen(list):
+    """Candidates yielded by _enumerate_microstates that only need (lower, upper)
+    bounds of their pKa values, see _screen_candidates"""
+
+
+def _predict_candidates(
+    candidates: list,
+    query_model: QueryModel,
+    featurizer: IncrementalFeaturizer,
+    tolerance: float,
+    node_budget: int,
+    prefixes: dict,
+) -> list:
+    """(pka, pka_stddev, nr of used members) of each candidate, the evaluation of
+    screened pairs continues after the first members in prefixes (see _screen_candidates)"""
+    keys = [query_model.pair_cache.key(*c, tolerance) for c in candidates]
+    cached = [query_model.pair_cache.get(key) for key in keys]
+    # featurize and predict each pair that is not cached only once
+    missing = {}
+    for key, candidate, prediction in zip(keys, candidates, cached):
+        if prediction is None:
+            missing.setdefault(key, candidate)
+    computed = {}
+    screened = [key for key in missing if key in prefixes]
+    for group in [[key for key in missing if key not in prefixes], screened]:
+        if not group:
+            continue
+        dataset = [featurizer.mol_to_paired_mol_data(*missing[key]) for key in group]
+        first_predictions = None
+        if group is screened:
+            first_predictions = np.stack([prefixes.pop(key) for key in group], axis=1)
+        predicted = query_model._predict_all(
+            dataset, node_budget, tolerance, first_predictions
+        )
+        for key, (pka, pka_std, nr_of_models) in zip(group, zip(*predicted)):
+            computed[key] = (float(pka), float(pka_std), int(nr_of_models))
+            query_model.pair_cache.put(key, computed[key])
+    return [
+        prediction if prediction is not None else computed[key]
+        for key, prediction in zip(keys, cached)
+    ]
+
+
+def _screen_candidates(
+    candidates: list,
+    query_model: QueryModel,
+    featurizer: IncrementalFeaturizer,
+    tolerance: float,
+    node_budget: int,
+    prefixes: dict,
+) -> list:
+    """(lower, upper) bounds of the pKa value of each candidate: the cached prediction,
+    or the mean of the first PRESCREEN_MODELS members +- PRESCREEN_MARGIN.
+    The predictions of the first members are kept in prefixes (by pair cache key)."""
+    bounds = [None] * len(candidates)
+    missing = {}  # key -> indices of the candidates
+    for j, candidate in enumerate(candidates):
+        key = query_model.pair_cache.key(*candidate, tolerance)
+        prediction = query_model.pair_cache.peek(key)
+        if prediction is None:
+            missing.setdefault(key, []).append(j)
+        else:
+            bounds[j] = (prediction[0], prediction[0])
+    todo = [key for key in missing if key not in prefixes]
+    if todo:
+        first_predictions = query_model._predict_first_members(
+            [featurizer.mol_to_paired_mol_data(*candidates[missing[key][0]]) for key in todo],
+            min(PRESCREEN_MODELS, query_model.nr_of_models),
+            node_budget,
+        )
+        for key, predictions in zip(todo, first_predictions.T):
+            prefixes[key] = predictions
+    for key, js in missing.items():
+        mean = float(prefixes[key].mean())
+        for j in js:
+            bounds[j] = (mean - PRESCREEN_MARGIN, mean + PRESCREEN_MARGIN)
+    return bounds
+
+
+def _run_microstate_enumerations(
+    enumerations: list,
+    query_model: QueryModel,
+    tolerance: float = None,
+    node_budget: int = NODE_BUDGET,
+) -> list:
+    """Advances the _enumerate_microstates generators in lockstep: the candidates that all
+    of them yield in a step are predicted (or screened, see _Screen) together, then each
+    generator receives its predictions. Returns the protonation states of each generator."""
+    results = [None] * len(enumerations)
+    pending = {}  # generator idx -> candidates waiting for predictions
+    # successive states share most of their features
+    featurizer = IncrementalFeaturizer(selected_node_features, selected_edge_features)
+    # pair cache key -> predictions of the first members of screened pairs
+    prefixes = {}
+    for i, enumeration in enumerate(enumerations):
+        try:
+            pending[i] = next(enumeration)
+        except StopIteration as finished:
+            results[i] = finished.value
+
+    while pending:
+        answers = {}
+        for screen, function in [(False, _predict_candidates), (True, _screen_candidates)]:
+            candidates = [
+                c
+                for candidates in pending.values()
+                if isinstance(candidates, _Screen) == screen
+                for c in candidates
+            ]
+            answers[screen] = iter(
+                function(
+                    candidates, query_model, featurizer, tolerance, node_budget, prefixes
+                )
+                if candidates
+                else []
+            )
+        next_pending = {}
+        for i, candidates in pending.items():
+            answer = answers[isinstance(candidates, _Screen)]
+            try:
+                next_pending[i] = enumerations[i].send(
+                    list(islice(answer, len(candidates)))
+                )
+            except StopIteration as finished:
+                results[i] = finished.value
+        pending = next_pending
+    return results
+
+
+def _prescreen(
+    candidates: list,
+    bounds: list,
+    acid: bool,
+    previous_pka: float,
+    statistics: PrescreenStatistics,
+) -> list:
+    """Drops the candidates that can not be selected in this iteration of the acid pass
+    (the highest pKa of at least 0.5 and below previous_pka) or the base pass
+    (the lowest pKa of at most 13.5 and above previous_pka), given (lower, upper)
+    bounds of their pKa values"""
+    if acid:
+        sign, limit = 1, 0.5
+    else:
+        # the base pass is the acid pass of the negated pKa values
+        sign, limit = -1, -13.5
+        bounds = [(-upper, -lower) for lower, upper in bounds]
+    if previous_pka is None:
+        previous_pka = np.inf
+    else:
+        previous_pka = sign * previous_pka
+    # the candidates that are certainly valid, the best of them is a lower bound of the winner
+    best = max(
+        [lower for lower, upper in bounds if lower >= limit and upper < previous_pka],
+        default=-np.inf,
+    )
+    selected = []
+    for candidate, (lower, upper) in zip(candidates, bounds):
+        if upper >= limit and lower < previous_pka and upper >= best:
+            selected.append(candidate)
+        elif lower < upper:  # not answered by the pair cache
+            statistics.nr_of_skipped += 1
+    statistics.nr_of_screened += sum(lower < upper for lower, upper in bounds)
+    return selected
+
+
+def _calculate_microstate_pka_values(
+    mols: list,
+    only_dimorphite: bool,
+    query_model: QueryModel,
+    tolerance: float,
+    node_budget: int,
+    cache,
+    prescreen: bool = False,
+) -> list:
+    """Enumerates the molecules that are not in the (persistent) cache and stores them"""
+    if prescreen and not query_model.models:
+        logger.debug("The pre-screen needs the ensemble members, it is not used")
+        prescreen = False
+    if cache is None:
+        todo, results = range(len(mols)), [None] * len(mols)
+    else:
+        keys = [
+            cache.key(mol, query_model, only_dimorphite, tolerance, prescreen)
+            for mol in mols
+        ]
+        results = cache.get_many(keys)
+        todo = [i for i, states in enumerate(results) if states is None]
+    statistics = PrescreenStatistics() if prescreen else None
+    computed = _run_microstate_enumerations(
+        [_enumerate_microstates(mols[i], only_dimorphite, statistics) for i in todo],
+        query_model,
+        tolerance,
+        node_budget,
+    )
+    if statistics is not None:
+        logger.info(
+            f"Pre-screen skipped {statistics.nr_of_skipped} of "
+            f"{statistics.nr_of_screened} ensemble evaluations"
+        )
+        query_model.prescreen_statistics.nr_of_screened += statistics.nr_of_screened
+        query_model.prescreen_statistics.nr_of_skipped += statistics.nr_of_skipped
+    for i, states in zip(todo, computed):
+        results[i] = states
+    if cache is not None and todo:
+        cache.put_many([(keys[i], results[i]) for i in todo])
+    return results
+
+
 def calculate_microstate_pka_values(
-    mol: Chem.rdchem.Mol, only_dimorphite: bool = False, query_model=None
+    mol: Chem.rdchem.Mol,
+    only_dimorphite: bool = False,
+    query_model=None,
+    tolerance: float = None,
+    cache=None,
+    prescreen: bool = False,
 ):
-    """Enumerate protonation states using a rdkit mol as input"""
+    """Enumerate protonation states using a rdkit mol as input.
+    If tolerance is set, the ensemble evaluation of each pKa value stops early once the
+    standard error of the mean is at most tolerance (see QueryModel.predict).
+    If cache (a pkasolver.cache.ResultCache) is set, results are looked up in and
+    stored to it.
+    If prescreen is set, the pKa values of the candidate reaction centers of each
+    iteration are first estimated with the first members of the ensemble, and centers
+    that can not be selected in this iteration (even if the estimate is off by
+    PRESCREEN_MARGIN) are not evaluated with the whole ensemble. The skipped
+    evaluations are counted in query_model.prescreen_statistics. Ignored for the
+    student and the onnx backend."""
+
+    if query_model is None:
+        query_model = get_query_model()
+    return _calculate_microstate_pka_values(
+        [mol], only_dimorphite, query_model, tolerance, NODE_BUDGET, cache, prescreen
+    )[0]
+
+
+def calculate_microstate_pka_values_batch(
+    mols: list,
+    only_dimorphite: bool = False,
+    query_model=None,
+    tolerance: float = None,
+    node_budget: int = NODE_BUDGET,
+    cache=None,
+    prescreen: bool = False,
+) -> list:
+    """Enumerate protonation states of many molecules. The greedy acid/base enumeration
+    of all molecules is advanced in lockstep and the candidate pairs of all molecules
+    are predicted together in batches of at most node_budget nodes.
+
+    Parameters
+    ----------
+    mols
+        list of rdkit mols
+    only_dimorphite, query_model, tolerance, cache, prescreen
+        see calculate_microstate_pka_values
+    node_budget
+        maximum number of nodes per forward pass
+
+    Returns
+    -------
+    list
+        list of States for each molecule, in the order of mols
+    """
+
+    if query_model is None:
+        query_model = get_query_model()
+    return _calculate_microstate_pka_values(
+        mols, only_dimorphite, query_model, tolerance, node_budget, cache, prescreen
+    )
 
-    if query_model == None:
-        query_model = QueryModel()
+
+def _enumerate_microstates(
+    mol: Chem.rdchem.Mol,
+    only_dimorphite: bool = False,
+    prescreen: PrescreenStatistics = None,
+):
+    """Generator that enumerates the protonation states of mol: it yields lists of
+    (protonated mol, deprotonated mol, reaction center idx) candidates, expects their
+    (pka, pka_stddev, nr of used members) predictions to be sent back
+    and returns the list of States (see _run_microstate_enumerations).
+    If prescreen is set, the candidates of each iteration are screened first (see _Screen)
+    and those that can not be selected are dropped (and counted in prescreen)."""
 
     if only_dimorphite:
-        print(
+        logger.warning(
             "BEWARE! This is experimental and might generate wrong protonation states."
         )
         logger.debug("Using dimorphite-dl to enumerate protonation states.")
@@ -242,36 +1318,16 @@ def calculate_microstate_pka_values(
 
         reaction_center_atom_idxs = _get_ionization_indices(mols_sorted, mols_sorted[0])
         # return only mol pairs
-        mols = []
+        candidates = []
         for nr_of_states, idx in enumerate(reaction_center_atom_idxs):
             logger.debug(Chem.MolToSmiles(mols_sorted[nr_of_states]))
             logger.debug(Chem.MolToSmiles(mols_sorted[nr_of_states + 1]))
-
-            # generated paired data structure
-            m = mol_to_paired_mol_data(
-                mols_sorted[nr_of_states],
-                mols_sorted[nr_of_states + 1],
-                idx,
-                selected_node_features,
-                selected_edge_features,
-            )
-            loader = dataset_to_dataloader([m], 1)
-            pka, pka_std = query_model.predict_pka_value(loader)
-            pair = States(
-                pka,
-                pka_std,
-                mols_sorted[nr_of_states],
-                mols_sorted[nr_of_states + 1],
-                idx,
-                ph7_mol=mol_at_ph_7,
+            candidates.append(
+                (mols_sorted[nr_of_states], mols_sorted[nr_of_states + 1], idx)
             )
-            logger.debug(
-                pka,
-                Chem.MolToSmiles(mols_sorted[nr_of_states]),
-                Chem.MolToSmiles(mols_sorted[nr_of_states + 1]),
-            )
-
-            mols.append(pair)
+        # calc pka values of all pairs in a single batch
+        predictions = yield candidates
+        mols = _to_states(candidates, predictions, mol_at_ph_7)
         logger.debug(mols)
 
     else:
@@ -296,6 +1352,7 @@ def calculate_microstate_pka_values(
         # for each possible protonation state
         for _ in reaction_center_atom_idxs:
             states_per_iteration = []
+            candidates = []
             # for each possible reaction center
             for i in used_reaction_center_atom_idxs:
                 try:
@@ -309,26 +1366,19 @@ def calculate_microstate_pka_values(
 
                 # sort mols (protonated/deprotonated)
                 sorted_mols = _sort_conj([conj, mol_at_state])
+                candidates.append((sorted_mols[0], sorted_mols[1], i))
 
-                m = mol_to_paired_mol_data(
-                    sorted_mols[0],
-                    sorted_mols[1],
-                    i,
-                    selected_node_features,
-                    selected_edge_features,
-                )
-                # calc pka value
-                loader = dataset_to_dataloader([m], 1)
-                pka, pka_std = query_model.predict_pka_value(loader)
-                pair = States(
-                    pka,
-                    pka_std,
-                    sorted_mols[0],
-                    sorted_mols[1],
-                    reaction_center_idx=i,
-                    ph7_mol=mol_at_ph_7,
+            if prescreen is not None:
+                bounds = yield _Screen(candidates)
+                previous_pka = acids[-1].pka if acids else None
+                candidates = _prescreen(
+                    candidates, bounds, True, previous_pka, prescreen
                 )
 
+            # calc pka values of all candidates in a single batch
+            predictions = yield candidates
+            for pair in _to_states(candidates, predictions, mol_at_ph_7):
+                pka = pair.pka
                 # test if pka is inside pH range
                 if pka < 0.5:
                     logger.debug("Too low pKa value!")
@@ -338,8 +1388,8 @@ def calculate_microstate_pka_values(
                 logger.debug(
                     "acid: ",
                     pka,
-                    Chem.MolToSmiles(conj),
-                    i,
+                    Chem.MolToSmiles(pair.protonated_mol),
+                    pair.reaction_center_idx,
                     Chem.MolToSmiles(mol_at_state),
                 )
 
@@ -377,6 +1427,7 @@ def calculate_microstate_pka_values(
         # for each possible protonation state
         for _ in reaction_center_atom_idxs:
             states_per_iteration = []
+            candidates = []
             # for each possible reaction center
             for i in used_reaction_center_atom_idxs:
                 try:
@@ -386,25 +1437,19 @@ def calculate_microstate_pka_values(
                 except:
                     continue
                 sorted_mols = _sort_conj([conj, mol_at_state])
-                m = mol_to_paired_mol_data(
-                    sorted_mols[0],
-                    sorted_mols[1],
-                    i,
-                    selected_node_features,
-                    selected_edge_features,
-                )
-                # calc pka values
-                loader = dataset_to_dataloader([m], 1)
-                pka, pka_std = query_model.predict_pka_value(loader)
-                pair = States(
-                    pka,
-                    pka_std,
-                    sorted_mols[0],
-                    sorted_mols[1],
-                    reaction_center_idx=i,
-                    ph7_mol=mol_at_ph_7,
+                candidates.append((sorted_mols[0], sorted_mols[1], i))
+
+            if prescreen is not None:
+                bounds = yield _Screen(candidates)
+                previous_pka = bases[-1].pka if bases else None
+                candidates = _prescreen(
+                    candidates, bounds, False, previous_pka, prescreen
                 )
 
+            # calc pka values of all candidates in a single batch
+            predictions = yield candidates
+            for pair in _to_states(candidates, predictions, mol_at_ph_7):
+                pka = pair.pka
                 # check if pka is within pH range
                 if pka > 13.5:
                     logger.debug("Too high pKa value!")
@@ -413,8 +1458,8 @@ def calculate_microstate_pka_values(
                 logger.debug(
                     "base",
                     pka,
-                    Chem.MolToSmiles(conj),
-                    i,
+                    Chem.MolToSmiles(pair.deprotonated_mol),
+                    pair.reaction_center_idx,
                     Chem.MolToSmiles(mol_at_state),
                 )
                 # if bases already present
@@ -442,9 +1487,7 @@ def calculate_microstate_pka_values(
         mols = _check_for_duplicates(mols)
 
     if len(mols) == 0:
-        print("#########################")
-        print("Could not identify any ionizable group. Aborting.")
-        print("#########################")
+        logger.warning("Could not identify any ionizable group. Aborting.")
 
     return mols
 
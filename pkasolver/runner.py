@@ -0,0 +1,177 @@
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import Iterable, Iterator
+
+import torch
+from rdkit import Chem
+
+from pkasolver.cache import get_result_cache
+from pkasolver.query import (
+    MODEL_DIR,
+    NODE_BUDGET,
+    calculate_microstate_pka_values,
+    calculate_microstate_pka_values_batch,
+    get_query_model,
+    init_worker,
+)
+from pkasolver.threads import get_thread_policy
+
+logger = logging.getLogger(__name__)
+
+
+def _to_mol(mol):
+    """returns mol for rdkit mols and SMILES strings, None if the SMILES can not be parsed"""
+    if isinstance(mol, str):
+        return Chem.MolFromSmiles(mol)
+    return mol
+
+
+def _chunks(iterable: Iterable, chunk_size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _init_worker(query_model, nr_of_threads: int):
+    torch.set_num_threads(nr_of_threads)
+    init_worker(query_model)
+
+
+def _process_chunk(
+    chunk: list,
+    only_dimorphite: bool = False,
+    tolerance: float = None,
+    node_budget: int = NODE_BUDGET,
+    model_dir: str = MODEL_DIR,
+    precision: str = "fp32",
+    cache_file: str = None,
+    prescreen: bool = False,
+) -> list:
+    """Returns the list of States for each molecule of the chunk, None for molecules
+    that could not be parsed or processed."""
+    query_model = get_query_model(model_dir=model_dir, precision=precision)
+    cache = get_result_cache(cache_file) if cache_file else None
+    mols = [_to_mol(mol) for mol in chunk]
+    valid = [i for i, mol in enumerate(mols) if mol is not None]
+    results = [None] * len(mols)
+    try:
+        states = calculate_microstate_pka_values_batch(
+            [mols[i] for i in valid],
+            only_dimorphite=only_dimorphite,
+            query_model=query_model,
+            tolerance=tolerance,
+            node_budget=node_budget,
+            cache=cache,
+            prescreen=prescreen,
+        )
+        for i, mol_states in zip(valid, states):
+            results[i] = mol_states
+    except Exception:
+        # find the failing molecule(s), all others still get their results
+        for i in valid:
+            try:
+                results[i] = calculate_microstate_pka_values(
+                    mols[i],
+                    only_dimorphite=only_dimorphite,
+                    query_model=query_model,
+                    tolerance=tolerance,
+                    cache=cache,
+                    prescreen=prescreen,
+                )
+            except Exception as e:
+                logger.warning(f"Failed for {Chem.MolToSmiles(mols[i])}: {e!r}")
+    return results
+
+
+def run_microstate_pka_values(
+    mols: Iterable,
+    nr_of_workers: int = None,
+    chunk_size: int = 32,
+    only_dimorphite: bool = False,
+    tolerance: float = None,
+    node_budget: int = NODE_BUDGET,
+    model_dir: str = MODEL_DIR,
+    precision: str = "fp32",
+    cache_file: str = None,
+    worker_threads: int = None,
+    mp_context=None,
+    prescreen: bool = False,
+) -> Iterator[list]:
+    """Runs calculate_microstate_pka_values for a (possibly very large) iterable of molecules
+    on a pool of worker processes. The QueryModel is loaded once in this process and
+    shared with all workers (see QueryModel.share_memory). Molecules are sent to the workers
+    in chunks, each chunk is enumerated with calculate_microstate_pka_values_batch.
+    Only a bounded number of chunks is in flight, so the input is consumed lazily.
+
+    Parameters
+    ----------
+    mols
+        iterable of rdkit mols or SMILES strings
+    nr_of_workers
+        number of worker processes, 0 runs in this process,
+        defaults to the ThreadPolicy (see pkasolver.threads.set_thread_policy)
+    chunk_size
+        number of molecules sent to a worker at once
+    only_dimorphite, tolerance
+        see calculate_microstate_pka_values
+    node_budget
+        maximum number of nodes per forward pass, see calculate_microstate_pka_values_batch
+    model_dir, precision
+        see QueryModel
+    cache_file
+        SQLite file of a persistent ResultCache (see pkasolver.cache) that is shared
+        by all workers, molecules found in it are not enumerated again
+    worker_threads
+        torch intra-op threads of each worker, defaults to the ThreadPolicy
+    mp_context
+        multiprocessing context of the workers, e.g. multiprocessing.get_context("spawn")
+    prescreen
+        see calculate_microstate_pka_values
+
+    Returns
+    -------
+    Iterator[list]
+        list of States for each input molecule, in input order;
+        None for molecules that could not be parsed or failed
+    """
+    process_chunk = partial(
+        _process_chunk,
+        only_dimorphite=only_dimorphite,
+        tolerance=tolerance,
+        node_budget=node_budget,
+        model_dir=model_dir,
+        precision=precision,
+        cache_file=cache_file,
+        prescreen=prescreen,
+    )
+    query_model = get_query_model(model_dir=model_dir, precision=precision)
+    policy = get_thread_policy()
+    if nr_of_workers is None:
+        nr_of_workers = policy.workers()
+    if nr_of_workers == 0:
+        for chunk in _chunks(mols, chunk_size):
+            yield from process_chunk(chunk)
+        return
+
+    if worker_threads is None:
+        worker_threads = policy.threads_per_worker(nr_of_workers)
+    with ProcessPoolExecutor(
+        nr_of_workers,
+        mp_context=mp_context,
+        initializer=_init_worker,
+        initargs=(query_model.share_memory(), worker_threads),
+    ) as executor:
+        pending = deque()
+        for chunk in _chunks(mols, chunk_size):
+            pending.append(executor.submit(process_chunk, chunk))
+            # keep the workers busy, but do not read ahead further than that
+            if len(pending) >= 2 * nr_of_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
@@ -0,0 +1,77 @@
+import argparse
+import random
+
+import torch
+from rdkit import Chem
+
+from pkasolver.constants import DEVICE
+from pkasolver.ml import dataset_to_dataloader
+from pkasolver.ml_architecture import GINPairV1Student, gcn_full_training
+from pkasolver.query import (
+    MODEL_DIR,
+    enumerate_protonation_pairs,
+    get_query_model,
+    label_with_ensemble,
+    num_edge_features,
+    num_node_features,
+)
+
+parser = argparse.ArgumentParser(
+    description="Distill the GINPairV1 ensemble into a single GINPairV1Student (mean and std output) "
+    "that QueryModel(fast=True) loads from {model_dir}/student_best_model.pt."
+)
+parser.add_argument(
+    "--input", help="unlabeled molecules, type: .sdf or .smi (one SMILES per line)"
+)
+parser.add_argument(
+    "--model_dir", default=MODEL_DIR, help="directory containing the ensemble"
+)
+parser.add_argument(
+    "--output",
+    default=".",
+    help="directory the student checkpoints are written to, defaults to the current directory; "
+    "copy student_best_model.pt to the model directory to use it",
+)
+parser.add_argument("--epochs", type=int, default=1_000, help="number of epochs")
+parser.add_argument("--batch_size", type=int, default=64, help="pairs per batch")
+parser.add_argument(
+    "--validation_fraction",
+    type=float,
+    default=0.1,
+    help="fraction of pairs used for validation",
+)
+parser.add_argument("--hidden_channels", type=int, default=96)
+args = parser.parse_args()
+
+if args.input.endswith(".sdf"):
+    mols = [mol for mol in Chem.SDMolSupplier(args.input, removeHs=True) if mol]
+else:
+    with open(args.input) as f:
+        mols = [Chem.MolFromSmiles(line.split()[0]) for line in f if line.strip()]
+    mols = [mol for mol in mols if mol]
+
+# enumerate protonation state pairs and label them with ensemble mean/std
+query_model = get_query_model(model_dir=args.model_dir)
+dataset = enumerate_protonation_pairs(mols, query_model)
+dataset = label_with_ensemble(dataset, query_model, args.batch_size)
+print(f"{len(dataset)} pairs of {len(mols)} molecules")
+
+random.seed(42)
+random.shuffle(dataset)
+nr_of_validation_pairs = max(1, int(len(dataset) * args.validation_fraction))
+val_loader = dataset_to_dataloader(dataset[:nr_of_validation_pairs], args.batch_size)
+train_loader = dataset_to_dataloader(dataset[nr_of_validation_pairs:], args.batch_size)
+
+model = GINPairV1Student(
+    num_node_features, num_edge_features, hidden_channels=args.hidden_channels
+).to(device=DEVICE)
+optimizer = torch.optim.AdamW(model.parameters(), lr=0.001)
+gcn_full_training(
+    model,
+    train_loader,
+    val_loader,
+    optimizer,
+    path=args.output,
+    NUM_EPOCHS=args.epochs,
+    prefix="student_",
+)
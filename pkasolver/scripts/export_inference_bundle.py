@@ -0,0 +1,21 @@
+import argparse
+
+from pkasolver.query import MODEL_DIR, NR_OF_MODELS, export_inference_bundle
+
+parser = argparse.ArgumentParser(
+    description="Combine the best_model_{i}.pt checkpoints into a single weights-only ensemble file."
+)
+parser.add_argument(
+    "--model_dir", default=MODEL_DIR, help="directory containing the checkpoints"
+)
+parser.add_argument(
+    "--output", default="", help="bundle filename, default: {model_dir}/ensemble.pt"
+)
+parser.add_argument(
+    "--nr_of_models", type=int, default=NR_OF_MODELS, help="number of ensemble members"
+)
+args = parser.parse_args()
+
+export_inference_bundle(
+    model_dir=args.model_dir, bundle_path=args.output, nr_of_models=args.nr_of_models
+)
@@ -0,0 +1,18 @@
+import argparse
+
+from pkasolver.query import MODEL_DIR, export_onnx
+
+parser = argparse.ArgumentParser(
+    description="Export the ensemble to ONNX for QueryModel(backend='onnx'). "
+    "The backend runs the forward pass with onnxruntime, "
+    "featurization still needs torch and torch_geometric."
+)
+parser.add_argument(
+    "--model_dir", default=MODEL_DIR, help="directory containing the trained models"
+)
+parser.add_argument(
+    "--output", default="", help="ONNX filename, default: {model_dir}/ensemble.onnx"
+)
+args = parser.parse_args()
+
+export_onnx(model_dir=args.model_dir, onnx_path=args.output)
@@ -0,0 +1,90 @@
+import argparse
+import platform
+import time
+
+import numpy as np
+import rdkit
+import torch
+import torch_geometric
+
+from pkasolver.data import load_data, make_pyg_dataset_from_dataframe, preprocess
+from pkasolver.ml import dataset_to_dataloader
+from pkasolver.query import (
+    MODEL_DIR,
+    PRECISIONS,
+    QueryModel,
+    edge_feat_list,
+    node_feat_list,
+)
+
+parser = argparse.ArgumentParser(
+    description="Compare reduced-precision predictions of the ensemble against fp32 on the Novartis and Literature test sets."
+)
+parser.add_argument(
+    "--data_dir", default="data/Baltruschat", help="directory containing the test sets"
+)
+parser.add_argument(
+    "--model_dir", default=MODEL_DIR, help="directory containing the trained models"
+)
+parser.add_argument(
+    "--precisions",
+    nargs="+",
+    default=list(PRECISIONS),
+    help="precisions to compare, fp32 is always included as reference",
+)
+parser.add_argument("--batch_size", type=int, default=64, help="pairs per batch")
+parser.add_argument("--output", default="", help="write the report (markdown) to file")
+args = parser.parse_args()
+
+
+def predict(query_model: QueryModel, dataset: list) -> tuple:
+    """returns predicted pKa values and the time per pair in ms"""
+    loader = dataset_to_dataloader(dataset, args.batch_size, shuffle=False)
+    query_model.predict(next(iter(loader)))  # warm-up
+    pka = []
+    t = time.perf_counter()
+    for data in loader:
+        pka.extend(query_model.predict(data)[0])
+    return np.array(pka), 1000 * (time.perf_counter() - t) / len(dataset)
+
+
+precisions = ["fp32"] + [p for p in args.precisions if p != "fp32"]
+query_models = {
+    p: QueryModel(model_dir=args.model_dir, device="cpu", precision=p)
+    for p in precisions
+}
+sd_files = load_data(args.data_dir)
+
+report = [
+    f"Predictions of the {query_models['fp32'].nr_of_models} member ensemble "
+    f"({torch.get_num_threads()} thread(s), batch size {args.batch_size})",
+    "",
+    f"Environment: python {platform.python_version()}, torch {torch.__version__}, "
+    f"torch_geometric {torch_geometric.__version__}, rdkit {rdkit.__version__}, "
+    f"numpy {np.__version__}",
+    "",
+    "| data set | precision | MAE | RMSE | mean abs. delta to fp32 | max abs. delta to fp32 | ms per pair |",
+    "|---|---|---|---|---|---|---|",
+]
+for name in ["Novartis", "Literature"]:
+    df = preprocess(sd_files[name])
+    dataset = make_pyg_dataset_from_dataframe(
+        df, node_feat_list, edge_feat_list, paired=True
+    )
+    reference = np.array([float(d.reference_value) for d in dataset])
+    fp32 = None
+    for precision in precisions:
+        pka, ms_per_pair = predict(query_models[precision], dataset)
+        if fp32 is None:
+            fp32 = pka
+        error, delta = pka - reference, np.abs(pka - fp32)
+        report.append(
+            f"| {name} ({len(dataset)}) | {precision} | {np.mean(np.abs(error)):.3f} "
+            f"| {np.sqrt(np.mean(error ** 2)):.3f} | {np.mean(delta):.4f} "
+            f"| {np.max(delta):.4f} | {ms_per_pair:.2f} |"
+        )
+
+print("\n".join(report))
+if args.output:
+    with open(args.output, "w") as f:
+        f.write("\n".join(report) + "\n")
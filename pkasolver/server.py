@@ -0,0 +1,370 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from rdkit import Chem
+
+from pkasolver.data import mol_to_paired_mol_data
+from pkasolver.query import (
+    NODE_BUDGET,
+    QueryModel,
+    calculate_microstate_pka_values,
+    calculate_microstate_pka_values_batch,
+    get_query_model,
+    selected_edge_features,
+    selected_node_features,
+)
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+
+class _Job:
+    """A molecule or pair waiting in the queue of the InferenceServer"""
+
+    def __init__(self, kind: str, payload, nr_of_nodes: int):
+        self.kind = kind  # "molecule" or "pair"
+        self.payload = payload
+        self.nr_of_nodes = nr_of_nodes
+        self.future = asyncio.get_running_loop().create_future()
+        self.result, self.error = None, None
+
+
+class _RequestError(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _states_to_json(states: list) -> list:
+    return [
+        {
+            "pka": state.pka,
+            "pka_stddev": state.pka_stddev,
+            "nr_of_models": state.nr_of_models,
+            "reaction_center_idx": state.reaction_center_idx,
+            "protonated_smiles": Chem.MolToSmiles(state.protonated_mol),
+            "deprotonated_smiles": Chem.MolToSmiles(state.deprotonated_mol),
+        }
+        for state in states
+    ]
+
+
+class InferenceServer:
+    """Small HTTP/JSON service around a QueryModel that is loaded once.
+
+    Requests are handled concurrently. Every molecule and pair becomes a job in a
+    bounded queue, requests are rejected with 503 if it is full. A single batcher
+    collects the jobs arriving within batch_window seconds (up to node_budget nodes)
+    and predicts them together in a worker thread, so the event loop stays responsive.
+
+    Endpoints
+    ---------
+    GET /health
+        status, model fingerprint, queue size and number of predicted batches
+    POST /microstates
+        {"smiles": [...]} -> {"results": [{"smiles", "states"} or {"smiles", "error"}]},
+        see calculate_microstate_pka_values
+    POST /pairs
+        {"pairs": [{"protonated", "deprotonated", "reaction_center_idx"}]}
+        -> {"results": [{"pka", "pka_stddev"} or {"error"}]}
+    """
+
+    def __init__(
+        self,
+        query_model: QueryModel = None,
+        node_budget: int = NODE_BUDGET,
+        batch_window: float = 0.005,
+        max_queue_size: int = 1024,
+        tolerance: float = None,
+    ):
+        """
+        Parameters
+        ----------
+        query_model
+            defaults to get_query_model()
+        node_budget
+            maximum number of nodes of the jobs that are batched together and
+            of a single forward pass
+        batch_window
+            seconds the batcher waits for more jobs after the first one arrived
+        max_queue_size
+            maximum number of waiting molecules and pairs
+        tolerance
+            see calculate_microstate_pka_values
+        """
+        self.query_model = query_model or get_query_model()
+        self.node_budget = node_budget
+        self.batch_window = batch_window
+        self.max_queue_size = max_queue_size
+        self.tolerance = tolerance
+        self.nr_of_batches = 0
+        self.queue = None
+        self.executor = None
+        self._batcher_task = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8000):
+        """Starts the batcher and listens on host:port, returns the asyncio.Server.
+        Call stop() after closing the server."""
+        self.queue = asyncio.Queue(self.max_queue_size)
+        # a single thread, the QueryModel is not shared between threads
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="pkasolver")
+        self._batcher_task = asyncio.create_task(self._batcher())
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        for socket in server.sockets:
+            logger.info(f"Serving on {socket.getsockname()}")
+        return server
+
+    async def stop(self):
+        """Stops the batcher and shuts down the worker thread,
+        waiting for a batch that is being predicted"""
+        if self._batcher_task is not None:
+            self._batcher_task.cancel()
+            try:
+                await self._batcher_task
+            except asyncio.CancelledError:
+                pass
+            self._batcher_task = None
+        if self.executor is not None:
+            # shutdown blocks until the running batch is done, not in the event loop
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.executor.shutdown
+            )
+            self.executor = None
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await self.queue.get()]
+            nr_of_nodes = jobs[0].nr_of_nodes
+            deadline = loop.time() + self.batch_window
+            while nr_of_nodes < self.node_budget:
+                timeout = deadline - loop.time()
+                try:
+                    if timeout > 0:
+                        job = await asyncio.wait_for(self.queue.get(), timeout)
+                    else:
+                        job = self.queue.get_nowait()
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+                jobs.append(job)
+                nr_of_nodes += job.nr_of_nodes
+            await loop.run_in_executor(self.executor, self._run_batch, jobs)
+            self.nr_of_batches += 1
+            for job in jobs:
+                if job.future.done():  # the client went away
+                    continue
+                if job.error is not None:
+                    job.future.set_exception(job.error)
+                else:
+                    job.future.set_result(job.result)
+
+    def _run_batch(self, jobs: list):
+        """Predicts all jobs, runs in the worker thread"""
+        molecule_jobs = [job for job in jobs if job.kind == "molecule"]
+        pair_jobs = [job for job in jobs if job.kind == "pair"]
+        if molecule_jobs:
+            try:
+                results = calculate_microstate_pka_values_batch(
+                    [job.payload for job in molecule_jobs],
+                    query_model=self.query_model,
+                    tolerance=self.tolerance,
+                    node_budget=self.node_budget,
+                )
+                for job, states in zip(molecule_jobs, results):
+                    job.result = states
+            except Exception:
+                # find the failing molecule(s), all others still get their results
+                for job in molecule_jobs:
+                    try:
+                        job.result = calculate_microstate_pka_values(
+                            job.payload,
+                            query_model=self.query_model,
+                            tolerance=self.tolerance,
+                        )
+                    except Exception as e:
+                        job.error = e
+        if pair_jobs:
+            for job in pair_jobs:
+                try:
+                    job.result = mol_to_paired_mol_data(
+                        *job.payload, selected_node_features, selected_edge_features
+                    )
+                except Exception as e:
+                    job.error = e
+            pair_jobs = [job for job in pair_jobs if job.error is None]
+            try:
+                pka, pka_std = self.query_model.predict_pka_values(
+                    [job.result for job in pair_jobs],
+                    node_budget=self.node_budget,
+                    tolerance=self.tolerance,
+                )
+                for job, value, std in zip(pair_jobs, pka, pka_std):
+                    job.result = (float(value), float(std))
+            except Exception as e:
+                for job in pair_jobs:
+                    job.error = e
+
+    async def _submit(self, jobs: list) -> list:
+        """Queues all jobs (or none of them) and waits for their results,
+        returns the results and exceptions in the order of jobs"""
+        if self.queue.maxsize - self.queue.qsize() < len(jobs):
+            raise _RequestError(HTTPStatus.SERVICE_UNAVAILABLE, "queue is full")
+        for job in jobs:
+            self.queue.put_nowait(job)
+        return await asyncio.gather(
+            *(job.future for job in jobs), return_exceptions=True
+        )
+
+    async def _microstates(self, request: dict) -> dict:
+        smiles = request.get("smiles")
+        if isinstance(smiles, str):
+            smiles = [smiles]
+        if not isinstance(smiles, list) or not smiles:
+            raise _RequestError(HTTPStatus.BAD_REQUEST, "expected smiles")
+        results, jobs = [], []
+        for smi in smiles:
+            mol = Chem.MolFromSmiles(smi) if isinstance(smi, str) else None
+            if mol is None:
+                results.append({"smiles": smi, "error": f"invalid SMILES {smi}"})
+            else:
+                results.append({"smiles": smi})
+                jobs.append(_Job("molecule", mol, 2 * mol.GetNumAtoms()))
+        valid = [result for result in results if "error" not in result]
+        for result, states in zip(valid, await self._submit(jobs)):
+            if isinstance(states, Exception):
+                result["error"] = repr(states)
+            else:
+                result["states"] = _states_to_json(states)
+        return {"results": results}
+
+    async def _pairs(self, request: dict) -> dict:
+        pairs = request.get("pairs")
+        if not isinstance(pairs, list) or not pairs:
+            raise _RequestError(HTTPStatus.BAD_REQUEST, "expected pairs")
+        jobs = []
+        for pair in pairs:
+            try:
+                protonated_mol = Chem.MolFromSmiles(pair["protonated"])
+                deprotonated_mol = Chem.MolFromSmiles(pair["deprotonated"])
+                idx = int(pair["reaction_center_idx"])
+                assert protonated_mol is not None and deprotonated_mol is not None
+                assert 0 <= idx < protonated_mol.GetNumAtoms()
+            except Exception:
+                raise _RequestError(HTTPStatus.BAD_REQUEST, f"invalid pair {pair}")
+            nr_of_nodes = protonated_mol.GetNumAtoms() + deprotonated_mol.GetNumAtoms()
+            jobs.append(
+                _Job("pair", (protonated_mol, deprotonated_mol, idx), nr_of_nodes)
+            )
+        results = []
+        for result in await self._submit(jobs):
+            if isinstance(result, Exception):
+                results.append({"error": repr(result)})
+            else:
+                results.append({"pka": result[0], "pka_stddev": result[1]})
+        return {"results": results}
+
+    def _health(self) -> dict:
+        return {
+            "status": "ok",
+            "model": self.query_model.fingerprint,
+            "nr_of_models": self.query_model.nr_of_models,
+            "queue_size": self.queue.qsize(),
+            "max_queue_size": self.max_queue_size,
+            "nr_of_batches": self.nr_of_batches,
+        }
+
+    async def _handle_request(self, method: str, target: str, body: bytes) -> tuple:
+        routes = {
+            ("GET", "/health"): None,
+            ("POST", "/microstates"): self._microstates,
+            ("POST", "/pairs"): self._pairs,
+        }
+        target = target.split("?", 1)[0]
+        if (method, target) not in routes:
+            if target in {t for _, t in routes}:
+                return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "method not allowed"}
+            return HTTPStatus.NOT_FOUND, {"error": f"no endpoint {target}"}
+        if target == "/health":
+            return HTTPStatus.OK, self._health()
+        try:
+            request = json.loads(body or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST, {"error": "expected a JSON object"}
+        try:
+            return HTTPStatus.OK, await routes[method, target](request)
+        except _RequestError as e:
+            return e.status, {"error": str(e)}
+
+    async def _handle_connection(self, reader, writer):
+        """minimal HTTP/1.1 with keep-alive, JSON bodies with Content-Length"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                content_length = int(headers.get("content-length", 0))
+                if content_length > MAX_BODY_SIZE:
+                    status, response = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {
+                        "error": "request too large"
+                    }
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(content_length)
+                    status, response = await self._handle_request(method, target, body)
+                    connection = headers.get("connection", "").lower()
+                    keep_alive = (
+                        connection != "close"
+                        if version == "HTTP/1.1"
+                        else connection == "keep-alive"
+                    )
+                data = json.dumps(response).encode()
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                        "Content-Type: application/json\r\n"
+                        f"Content-Length: {len(data)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                        + ("Retry-After: 1\r\n" if status == 503 else "")
+                        + "\r\n"
+                    ).encode("latin-1")
+                    + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.debug(f"Dropping connection: {e!r}")
+        finally:
+            writer.close()
+
+
+def serve(host: str = "127.0.0.1", port: int = 8000, **kwargs):
+    """Runs an InferenceServer until it is interrupted, kwargs are passed to InferenceServer"""
+
+    async def main():
+        inference_server = InferenceServer(**kwargs)
+        server = await inference_server.start(host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await inference_server.stop()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
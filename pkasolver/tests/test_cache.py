@@ -0,0 +1,64 @@
+import os
+import time
+
+import pytest
+from rdkit import Chem
+
+smiles = ["CC(=O)O", "c1ccccc1", "NCC(=O)O", "OC(=O)CC(O)(CC(=O)O)C(=O)O"]
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_result_cache(tmp_path):
+    from pkasolver.cache import ResultCache
+    from pkasolver.query import (
+        calculate_microstate_pka_values,
+        calculate_microstate_pka_values_batch,
+        get_query_model,
+    )
+
+    query_model = get_query_model()
+    mols = [Chem.MolFromSmiles(smi) for smi in smiles]
+    cache = ResultCache(str(tmp_path / "cache.db"))
+    results = calculate_microstate_pka_values_batch(
+        mols, query_model=query_model, cache=cache
+    )
+    assert len(cache) == len(mols)
+
+    # cached results are returned without predicting again
+    query_model.pair_cache.clear()
+    cached_results = calculate_microstate_pka_values_batch(
+        mols, query_model=query_model, cache=ResultCache(str(tmp_path / "cache.db"))
+    )
+    assert query_model.pair_cache.misses == 0
+    for states, cached_states in zip(results, cached_results):
+        assert len(states) == len(cached_states)
+        for state, cached_state in zip(states, cached_states):
+            assert state.pka == cached_state.pka
+            assert state.pka_stddev == cached_state.pka_stddev
+            assert state.reaction_center_idx == cached_state.reaction_center_idx
+            for attr in ["protonated_mol", "deprotonated_mol", "ph7_mol"]:
+                # same atom order
+                assert Chem.MolToSmiles(getattr(state, attr), canonical=False) == (
+                    Chem.MolToSmiles(getattr(cached_state, attr), canonical=False)
+                )
+    # other options or models are different entries
+    calculate_microstate_pka_values(
+        mols[0], query_model=query_model, tolerance=0.1, cache=cache
+    )
+    assert len(cache) == len(mols) + 1
+    key = ResultCache.key(mols[0], query_model)
+    assert cache.get_many([key, key[:2] + ("other model",)])[1] is None
+
+    # eviction
+    cache.put_many([(key[:2] + ("other model",), [])])
+    assert cache.evict(keep_models=1) == len(mols) + 1
+    assert cache.get_many([key[:2] + ("other model",)]) == [[]]
+    time.sleep(0.01)
+    cache.put_many([(key, results[0])])
+    assert cache.evict(max_entries=1) == 1
+    assert cache.get_many([key])[0][0].pka == results[0][0].pka
+    assert cache.evict(older_than=0) == 1
+    cache.compact()
+    assert len(cache) == 0
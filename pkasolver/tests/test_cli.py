@@ -0,0 +1,109 @@
+import csv
+import gzip
+import os
+
+import pytest
+from rdkit import Chem
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_predict_smiles_to_csv(tmp_path):
+    from pkasolver.cli import main
+
+    input_file = tmp_path / "input.smi"
+    input_file.write_text(
+        "CC(=O)O acetic acid\nnot_a_smiles invalid\n\nNCC(=O)O glycine\n"
+    )
+    output_file = tmp_path / "output.csv"
+    args = ["predict", str(input_file), "-o", str(output_file), "--batch_size", "2"]
+    assert main(args) == 0
+
+    with open(output_file) as f:
+        rows = list(csv.DictReader(f))
+    # one row per state, a single empty row for the invalid SMILES
+    names = [row["name"] for row in rows]
+    assert names == ["acetic acid", "invalid", "glycine", "glycine"]
+    assert [row["state"] for row in rows] == ["0", "", "0", "1"]
+    assert [row["error"] for row in rows] == ["", "pKa prediction failed", "", ""]
+    assert round(float(rows[0]["pka"]), 1) == 4.2
+    assert rows[0]["protonated_smiles"] == "CC(=O)O"
+    assert rows[0]["deprotonated_smiles"] == "CC(=O)[O-]"
+    assert float(rows[2]["pka"]) < float(rows[3]["pka"])
+
+
+def test_failed_molecules_have_an_error(tmp_path):
+    from pkasolver.cli import PREDICTION_FAILED, CSVWriter
+
+    # a failed prediction (None) is not written like a molecule without states ([])
+    writer = CSVWriter(str(tmp_path / "output.csv"))
+    writer.write(0, "failed", "CC(=O)O", None)
+    writer.write(1, "benzene", "c1ccccc1", [])
+    writer.close()
+    with open(tmp_path / "output.csv") as f:
+        rows = list(csv.DictReader(f))
+    assert [(row["name"], row["error"]) for row in rows] == [
+        ("failed", PREDICTION_FAILED),
+        ("benzene", ""),
+    ]
+
+
+def test_failed_molecules_have_an_error_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    from pkasolver.cli import PREDICTION_FAILED, ParquetWriter
+
+    writer = ParquetWriter(str(tmp_path / "output.parquet"))
+    writer.write(0, "failed", "CC(=O)O", None)
+    writer.write(1, "benzene", "c1ccccc1", [])
+    writer.close()
+    table = pq.read_table(tmp_path / "output.parquet")
+    assert table.column("error").to_pylist() == [PREDICTION_FAILED, None]
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_predict_gzipped_sdf_to_sdf(tmp_path):
+    from pkasolver.cli import main
+
+    input_file = tmp_path / "input.sdf.gz"
+    with gzip.open(input_file, "wt") as f:
+        writer = Chem.SDWriter(f)
+        for smi, name in [("CC(=O)O", "acetic acid"), ("c1ccccc1", "benzene")]:
+            mol = Chem.MolFromSmiles(smi)
+            mol.SetProp("_Name", name)
+            writer.write(mol)
+        writer.close()
+    output_file = tmp_path / "output.sdf"
+    assert main(["predict", str(input_file), "-o", str(output_file)]) == 0
+
+    acetic_acid, benzene = list(Chem.SDMolSupplier(str(output_file)))
+    # pH 7 molecule with the states as SD properties
+    assert acetic_acid.GetProp("_Name") == "acetic acid"
+    assert Chem.MolToSmiles(acetic_acid) == "CC(=O)[O-]"
+    assert acetic_acid.GetIntProp("nr_of_states") == 1
+    assert round(acetic_acid.GetDoubleProp("pKa_0"), 1) == 4.2
+    assert benzene.GetProp("_Name") == "benzene"
+    assert benzene.GetIntProp("nr_of_states") == 0
+
+
+def test_cache_messages(tmp_path, caplog):
+    import logging
+
+    from pkasolver.cache import ResultCache
+    from pkasolver.cli import main
+
+    cache_file = str(tmp_path / "cache.sqlite")
+    ResultCache(cache_file).close()
+    assert main(["cache", "evict", cache_file, "--max_entries", "0"]) == 0
+    assert "Removed 0 entries, 0 left." in caplog.messages
+    assert f"Compacted {cache_file}." in caplog.messages
+
+    caplog.clear()
+    assert main(["--quiet", "cache", "compact", cache_file]) == 0
+    assert logging.getLogger().level == logging.WARNING
+    assert caplog.messages == []
+    main(["--verbose", "cache", "compact", cache_file])
+    assert logging.getLogger().level == logging.DEBUG
+    logging.getLogger().setLevel(logging.INFO)
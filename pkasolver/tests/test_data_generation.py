@@ -547,6 +547,52 @@ def test_edges_generation():
     )
 
 
+def test_incremental_featurizer():
+    """Test that the incremental features are identical to mol_to_paired_mol_data"""
+    from pkasolver.chem import create_conjugate
+    from pkasolver.data import IncrementalFeaturizer, mol_to_paired_mol_data
+
+    n_feat = make_features_dicts(NODE_FEATURES, list(NODE_FEATURES))
+    e_feat = make_features_dicts(EDGE_FEATURES, list(EDGE_FEATURES))
+    featurizer = IncrementalFeaturizer(n_feat, e_feat)
+    pairs = []
+    # successive deprotonations of citric acid, glycine and sulfanilamide
+    for smi, reaction_centers in [
+        ("OC(=O)CC(O)(CC(=O)O)C(=O)O", [0, 9, 12, 5]),
+        ("[NH3+]CC(=O)O", [4, 0]),
+        ("Nc1ccc(S(N)(=O)=O)cc1", [6, 0]),
+    ]:
+        mol = Chem.MolFromSmiles(smi)
+        for idx in reaction_centers:
+            conj = create_conjugate(mol, idx, pka=10.0)
+            pairs.append((mol, conj, idx))
+            mol = conj
+    for prot, deprot, idx in pairs + pairs:
+        d1 = featurizer.mol_to_paired_mol_data(prot, deprot, idx)
+        d2 = mol_to_paired_mol_data(prot, deprot, idx, n_feat, e_feat)
+        for key in ["x", "edge_index", "edge_attr"]:
+            for state in ["p", "d"]:
+                t1, t2 = d1[f"{key}_{state}"], d2[f"{key}_{state}"]
+                assert t1.dtype == t2.dtype and torch.equal(t1, t2)
+        assert d1.charge_prot == d2.charge_prot
+        assert d1.charge_deprot == d2.charge_deprot
+    assert featurizer.nr_of_hits > len(pairs)
+    assert featurizer.nr_of_updates > 0
+
+    # only the most recently used states are kept
+    featurizer = IncrementalFeaturizer(n_feat, e_feat, max_states=2)
+    for prot, deprot, idx in pairs + pairs:
+        d1 = featurizer.mol_to_paired_mol_data(prot, deprot, idx)
+        d2 = mol_to_paired_mol_data(prot, deprot, idx, n_feat, e_feat)
+        for key in ["x_p", "x_d", "edge_attr_p", "edge_attr_d"]:
+            assert torch.equal(d1[key], d2[key])
+        assert len(featurizer._states) <= 2 and len(featurizer._last_state) <= 2
+    assert featurizer.nr_of_hits > 0
+
+    with pytest.raises(ValueError):
+        IncrementalFeaturizer({"element": lambda atom, marvin_atom: 1}, e_feat)
+
+
 def test_use_dataset_for_node_generation():
     """Test that the training dataset can be generated and that prot/deprot are different molecules"""
     import torch
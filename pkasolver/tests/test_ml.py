@@ -379,3 +379,244 @@ def test_count_nr_of_parameters_for_GIN():
         p.numel() for p in model.parameters() if p.requires_grad == True
     )
     print(f"Number of parameters: {nr_of_parameters=}")
+
+
+def _make_pair_data(list_n: list, list_e: list) -> list:
+    from pkasolver.constants import EDGE_FEATURES, NODE_FEATURES
+    from pkasolver.data import make_features_dicts, mol_to_paired_mol_data
+    from rdkit import Chem
+
+    selected_node_features = make_features_dicts(NODE_FEATURES, list_n)
+    selected_edge_features = make_features_dicts(EDGE_FEATURES, list_e)
+    pairs = [
+        ("CC(=O)O", "CC(=O)[O-]", 3),
+        ("c1cc[nH+]cc1", "c1ccncc1", 3),
+        ("C1CC[NH2+]CC1", "C1CCNCC1", 3),
+        ("Oc1ccc(CC[NH3+])cc1", "Oc1ccc(CCN)cc1", 9),
+    ]
+    return [
+        mol_to_paired_mol_data(
+            Chem.MolFromSmiles(prot),
+            Chem.MolFromSmiles(deprot),
+            idx,
+            selected_node_features,
+            selected_edge_features,
+        )
+        for prot, deprot, idx in pairs
+    ]
+
+
+def _make_random_GINPairV1_models(
+    num_node_features: int, num_edge_features: int, nr_of_models: int = 3
+) -> list:
+    # GCN.__init__ seeds torch, so every member has to be perturbed explicitly
+    models = []
+    for i in range(nr_of_models):
+        model = GINPairV1(num_node_features, num_edge_features, hidden_channels=16)
+        torch.manual_seed(i)
+        for p in model.parameters():
+            p.data.normal_(std=0.3)
+        for m in model.modules():
+            if isinstance(m, torch.nn.BatchNorm1d):
+                m.running_mean.normal_()
+                m.running_var.uniform_(0.5, 2.0)
+        model.eval()
+        model.to(device=DEVICE)
+        models.append(model)
+    return models
+
+
+def test_fused_GINPairV1_ensemble():
+    from pkasolver.ml import dataset_to_dataloader
+    from pkasolver.ml_architecture import GINPairV1Ensemble
+
+    list_n = ["element", "formal_charge", "total_num_Hs", "reaction_center"]
+    list_e = ["bond_type", "is_conjugated"]
+    models = _make_random_GINPairV1_models(
+        calculate_nr_of_features(list_n), calculate_nr_of_features(list_e)
+    )
+    ensemble = GINPairV1Ensemble(models).to(device=DEVICE)
+
+    dataset = _make_pair_data(list_n, list_e)
+    for data in dataset_to_dataloader(dataset, batch_size=len(dataset), shuffle=False):
+        data.to(device=DEVICE)
+        with torch.no_grad():
+            reference = torch.stack(
+                [
+                    model(
+                        x_p=data.x_p,
+                        x_d=data.x_d,
+                        edge_attr_p=data.edge_attr_p,
+                        edge_attr_d=data.edge_attr_d,
+                        data=data,
+                    ).reshape(-1)
+                    for model in models
+                ]
+            )
+            fused = ensemble(
+                x_p=data.x_p,
+                x_d=data.x_d,
+                edge_index_p=data.edge_index_p,
+                edge_index_d=data.edge_index_d,
+                x_p_batch=data.x_p_batch,
+                x_d_batch=data.x_d_batch,
+                num_graphs=data.num_graphs,
+            )
+            subset = ensemble(
+                x_p=data.x_p,
+                x_d=data.x_d,
+                edge_index_p=data.edge_index_p,
+                edge_index_d=data.edge_index_d,
+                x_p_batch=data.x_p_batch,
+                x_d_batch=data.x_d_batch,
+                num_graphs=data.num_graphs,
+                start=1,
+                end=3,
+            )
+        assert fused.shape == (len(models), len(dataset))
+        assert torch.allclose(reference, fused, atol=1e-4)
+        assert torch.allclose(reference[1:3], subset, atol=1e-4)
+
+
+def test_GINPairV1Student():
+    from pkasolver.ml import dataset_to_dataloader
+    from pkasolver.ml_architecture import GINPairV1Student, gcn_test, gcn_train
+
+    list_n = ["element", "formal_charge", "total_num_Hs", "reaction_center"]
+    list_e = ["bond_type", "is_conjugated"]
+    dataset = _make_pair_data(list_n, list_e)
+    # distillation targets: ensemble mean and std
+    for i, m in enumerate(dataset):
+        m.reference_value = torch.tensor([4.0 + i, 0.1 * (i + 1)])
+
+    model = GINPairV1Student(
+        calculate_nr_of_features(list_n),
+        calculate_nr_of_features(list_e),
+        hidden_channels=16,
+    ).to(device=DEVICE)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=0.01)
+    loader = dataset_to_dataloader(dataset, batch_size=len(dataset), shuffle=False)
+    loss = gcn_test(model, loader)
+    for _ in range(50):
+        gcn_train(model, loader, optimizer)
+    assert gcn_test(model, loader) < loss
+
+    model.eval()
+    for data in loader:
+        data.to(device=DEVICE)
+        out = model(
+            x_p=data.x_p,
+            x_d=data.x_d,
+            edge_attr_p=data.edge_attr_p,
+            edge_attr_d=data.edge_attr_d,
+            data=data,
+        )
+        assert out.shape == (len(dataset), 2)
+        assert bool((out[:, 1] > 0).all())
+
+
+def test_gcn_full_training(tmp_path):
+    from pkasolver.ml import dataset_to_dataloader
+    from pkasolver.ml_architecture import GINPairV1Student, gcn_full_training
+
+    list_n = ["element", "formal_charge", "total_num_Hs", "reaction_center"]
+    list_e = ["bond_type", "is_conjugated"]
+    dataset = _make_pair_data(list_n, list_e)
+    for i, m in enumerate(dataset):
+        m.reference_value = torch.tensor([4.0 + i, 0.1 * (i + 1)])
+
+    # as in scripts/distill_ensemble.py
+    model = GINPairV1Student(
+        calculate_nr_of_features(list_n),
+        calculate_nr_of_features(list_e),
+        hidden_channels=16,
+    ).to(device=DEVICE)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=0.01)
+    loader = dataset_to_dataloader(dataset, batch_size=len(dataset), shuffle=False)
+    results = gcn_full_training(
+        model,
+        loader,
+        loader,
+        optimizer,
+        path=str(tmp_path),
+        NUM_EPOCHS=5,
+        prefix="student_",
+    )
+    assert len(results["training-set"]) == len(results["validation-set"]) == 2
+    assert (tmp_path / "student_model_at_0.pt").exists()
+    assert (tmp_path / "student_model_at_5.pt").exists()
+
+
+def test_collate_pairs():
+    from pkasolver.ml import collate_pairs, dataset_to_dataloader
+
+    list_n = ["element", "formal_charge", "total_num_Hs", "reaction_center"]
+    list_e = ["bond_type", "is_conjugated"]
+    dataset = _make_pair_data(list_n, list_e)
+    reference = next(
+        iter(dataset_to_dataloader(dataset, batch_size=len(dataset), shuffle=False))
+    )
+    data = collate_pairs(dataset)
+    assert data.num_graphs == reference.num_graphs == len(dataset)
+    for name in [
+        "x_p",
+        "x_d",
+        "edge_index_p",
+        "edge_index_d",
+        "edge_attr_p",
+        "edge_attr_d",
+        "x_p_batch",
+        "x_d_batch",
+    ]:
+        assert getattr(data, name).dtype == getattr(reference, name).dtype
+        assert torch.equal(getattr(data, name), getattr(reference, name))
+
+    # the models accept it in place of a torch_geometric Batch
+    models = _make_random_GINPairV1_models(
+        calculate_nr_of_features(list_n), calculate_nr_of_features(list_e)
+    )
+    # to returns a new PairBatch, the original keeps its device
+    moved = data.to(device="meta")
+    assert moved.x_p.device.type == "meta" and moved.num_graphs == data.num_graphs
+    assert data.x_p.device.type == "cpu"
+    data = data.to(device=DEVICE)
+    reference.to(device=DEVICE)
+    with torch.no_grad():
+        for model in models:
+            assert torch.equal(
+                model(data.x_p, data.x_d, data.edge_attr_p, data.edge_attr_d, data),
+                model(
+                    reference.x_p,
+                    reference.x_d,
+                    reference.edge_attr_p,
+                    reference.edge_attr_d,
+                    reference,
+                ),
+            )
+
+
+def test_split_pair_batch():
+    from pkasolver.ml import collate_pairs
+    from pkasolver.query import _batches
+
+    list_n = ["element", "formal_charge", "total_num_Hs", "reaction_center"]
+    list_e = ["bond_type", "is_conjugated"]
+    dataset = _make_pair_data(list_n, list_e)
+    data = collate_pairs(dataset)
+    for start, end in [(0, 1), (1, 3), (2, 4)]:
+        reference = collate_pairs(dataset[start:end])
+        sliced = data.slice_graphs(start, end)
+        assert sliced.num_graphs == end - start
+        for name in ["x_p", "x_d", "edge_index_p", "edge_index_d", "x_p_batch"]:
+            assert torch.equal(getattr(sliced, name), getattr(reference, name))
+
+    # a PairBatch over the node budget is split like a list of pairs
+    node_budget = 30
+    batches = list(_batches(data, node_budget))
+    references = list(_batches(dataset, node_budget))
+    assert len(batches) == len(references) > 1
+    assert [b.num_graphs for b in batches] == [b.num_graphs for b in references]
+    for batch, reference in zip(batches, references):
+        assert torch.equal(batch.edge_index_d, reference.edge_index_d)
+        assert torch.equal(batch.edge_attr_d, reference.edge_attr_d)
+    assert next(_batches(data, 4096)) is data
@@ -2,6 +2,7 @@ import numpy as np
 from pkasolver.query import _get_ionization_indices, calculate_microstate_pka_values
 from rdkit import Chem
 import pytest, os
+import torch
 
 input = "pkasolver/tests/testdata/00_chembl_subset.sdf"
 mollist = []
@@ -1349,3 +1350,547 @@ def test_visualizing():
     protonation_states = calculate_microstate_pka_values(mol)
     draw_pka_reactions(protonation_states)
     draw_pka_map(protonation_states)
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_inference_bundle(tmp_path):
+    import torch
+    from pkasolver.query import MODEL_DIR, QueryModel, export_inference_bundle
+
+    bundle_path = export_inference_bundle(
+        bundle_path=str(tmp_path / "ensemble.pt"), nr_of_models=3
+    )
+    assert os.path.isfile(bundle_path)
+    query_model = QueryModel(model_dir=str(tmp_path))
+    assert len(query_model.models) == 3
+    for i, model in enumerate(query_model.models):
+        checkpoint = torch.load(
+            f"{MODEL_DIR}/best_model_{i}.pt", map_location=torch.device("cpu")
+        )
+        for name, value in checkpoint["model_state_dict"].items():
+            assert torch.equal(model.state_dict()[name].cpu(), value)
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_cached_inference_bundle(tmp_path):
+    from pkasolver.query import QueryModel
+
+    # the bundle is exported into cache_dir on first use and memory-mapped afterwards
+    query_model = QueryModel(cache_dir=str(tmp_path))
+    bundles = list(tmp_path.glob("bundle_*.pt"))
+    assert len(bundles) == 1
+    mtime = bundles[0].stat().st_mtime_ns
+    cached = QueryModel(cache_dir=str(tmp_path))
+    assert bundles[0].stat().st_mtime_ns == mtime
+    # the stored weights digest gives the same fingerprint as the checkpoints
+    checkpoints = QueryModel(cache_dir="")
+    assert query_model.fingerprint == cached.fingerprint == checkpoints.fingerprint
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_query_model_registry():
+    from concurrent.futures import ThreadPoolExecutor
+
+    from pkasolver.query import get_query_model, release_query_model
+
+    release_query_model()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        query_models = list(executor.map(lambda _: get_query_model(), range(8)))
+    assert all(q is query_models[0] for q in query_models)
+    assert get_query_model(device="cpu", precision="fp32") is get_query_model(
+        device="cpu"
+    )
+
+    assert release_query_model(precision="fp32") >= 1
+    assert get_query_model() is not query_models[0]
+    assert release_query_model() == 1
+
+
+def test_release_query_model_device_names(monkeypatch):
+    import torch
+
+    from pkasolver import query
+    from pkasolver.query import MODEL_DIR, _query_model_key, release_query_model
+
+    # all names of a device share a key
+    cuda = f"cuda:{torch.cuda.current_device() if torch.cuda.is_available() else 0}"
+    assert _query_model_key(MODEL_DIR, "cuda", "fp32") == _query_model_key(
+        MODEL_DIR, cuda, "fp32"
+    )
+    for registered, released in [("cuda", cuda), (cuda, "cuda"), ("cpu", "cpu:0")]:
+        monkeypatch.setattr(
+            query,
+            "_query_models",
+            {_query_model_key(MODEL_DIR, registered, "fp32"): object()},
+        )
+        assert release_query_model(device=released) == 1
+        assert query._query_models == {}
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_adaptive_ensemble():
+    from pkasolver.query import get_query_model
+
+    query_model = get_query_model()
+    mol = Chem.MolFromSmiles("NC(CC1=CC=C(O)C=C1)C(=O)O")
+    reference = calculate_microstate_pka_values(mol, query_model=query_model)
+    # a tolerance that can never be reached uses all members
+    states = calculate_microstate_pka_values(mol, query_model=query_model, tolerance=0.0)
+    assert [s.nr_of_models for s in states] == [25] * len(reference)
+    for state, ref in zip(states, reference):
+        assert np.isclose(state.pka, ref.pka)
+        assert np.isclose(state.pka_stddev, ref.pka_stddev)
+    # a very loose tolerance stops after the first min_models members
+    states = calculate_microstate_pka_values(
+        mol, query_model=query_model, tolerance=100.0
+    )
+    assert all(s.nr_of_models == 5 for s in states)
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_reduced_precision():
+    from pkasolver.query import QueryModel
+
+    with pytest.raises(ValueError):
+        QueryModel(precision="fp16")
+
+    mol = Chem.MolFromSmiles("O=C(O)CC(O)(CC(=O)O)C(=O)O")
+    reference = [
+        s.pka for s in calculate_microstate_pka_values(mol, query_model=QueryModel())
+    ]
+    for precision in ["bf16", "int8"]:
+        query_model = QueryModel(device="cpu", precision=precision)
+        states = calculate_microstate_pka_values(mol, query_model=query_model)
+        assert len(states) == len(reference)
+        assert np.allclose([s.pka for s in states], reference, atol=0.2)
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_compiled_ensemble(tmp_path):
+    from pkasolver.query import QueryModel
+
+    mol = Chem.MolFromSmiles("NC(CC1=CC=C(O)C=C1)C(=O)O")
+    reference = calculate_microstate_pka_values(mol, query_model=QueryModel())
+    for _ in range(2):  # compile and cache, then load from the cache
+        query_model = QueryModel(compiled=True, cache_dir=str(tmp_path))
+        assert isinstance(query_model.ensemble, torch.jit.ScriptModule)
+        assert len(list(tmp_path.glob("ensemble_*.pt"))) == 1
+        states = calculate_microstate_pka_values(mol, query_model=query_model)
+        assert [s.pka for s in states] == pytest.approx([s.pka for s in reference])
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_onnx_backend(tmp_path):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnxscript")
+    from pkasolver.data import mol_to_paired_mol_data
+    from pkasolver.ml import dataset_to_dataloader
+    from pkasolver.query import (
+        QueryModel,
+        export_onnx,
+        get_query_model,
+        selected_edge_features,
+        selected_node_features,
+    )
+
+    export_onnx(onnx_path=str(tmp_path / "ensemble.onnx"))
+    onnx_model = QueryModel(model_dir=str(tmp_path), backend="onnx")
+    torch_model = get_query_model()
+
+    # all protonation state pairs of the first molecules of the test set
+    dataset = []
+    for mol in mollist[:10]:
+        for state in calculate_microstate_pka_values(mol, query_model=torch_model):
+            dataset.append(
+                mol_to_paired_mol_data(
+                    state.protonated_mol,
+                    state.deprotonated_mol,
+                    state.reaction_center_idx,
+                    selected_node_features,
+                    selected_edge_features,
+                )
+            )
+    data = next(iter(dataset_to_dataloader(dataset, len(dataset), shuffle=False)))
+    for tolerance in [None, 0.1]:
+        pka, pka_std, nr_of_models = torch_model.predict(data, tolerance)
+        onnx_pka, onnx_pka_std, onnx_nr_of_models = onnx_model.predict(data, tolerance)
+        assert np.allclose(pka, onnx_pka, atol=1e-4)
+        assert np.allclose(pka_std, onnx_pka_std, atol=1e-4)
+        assert np.array_equal(nr_of_models, onnx_nr_of_models)
+
+
+def test_fast_query_model(tmp_path):
+    from pkasolver.ml_architecture import GINPairV1Student
+    from pkasolver.query import (
+        STUDENT_MODEL,
+        QueryModel,
+        num_edge_features,
+        num_node_features,
+    )
+
+    student = GINPairV1Student(num_node_features, num_edge_features, hidden_channels=16)
+    torch.save(
+        {"model_state_dict": student.state_dict()}, str(tmp_path / STUDENT_MODEL)
+    )
+    query_model = QueryModel(model_dir=str(tmp_path), fast=True)
+    assert query_model.nr_of_models == 1
+    assert not query_model.models
+
+    states = calculate_microstate_pka_values(
+        Chem.MolFromSmiles("O=C(O)CC(O)(CC(=O)O)C(=O)O"), query_model=query_model
+    )
+    for state in states:
+        assert state.nr_of_models == 1
+        assert state.pka_stddev > 0
+
+
+def _predict_acetic_acid_in_worker(_) -> tuple:
+    from pkasolver.data import mol_to_paired_mol_data
+    from pkasolver.ml import dataset_to_dataloader
+    from pkasolver.query import (
+        _query_models,
+        get_query_model,
+        selected_edge_features,
+        selected_node_features,
+    )
+
+    m = mol_to_paired_mol_data(
+        Chem.MolFromSmiles("CC(=O)O"),
+        Chem.MolFromSmiles("CC(=O)[O-]"),
+        3,
+        selected_node_features,
+        selected_edge_features,
+    )
+    query_model = get_query_model()
+    pka, _, _ = query_model.predict(next(iter(dataset_to_dataloader([m], 1))))
+    is_shared = all(p.is_shared() for p in query_model.ensemble.parameters())
+    return len(_query_models), is_shared, float(pka[0])
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_share_query_model_with_workers():
+    import multiprocessing
+
+    from pkasolver.query import get_query_model, init_worker, release_query_model
+
+    release_query_model()
+    query_model = get_query_model().share_memory()
+    reference = _predict_acetic_acid_in_worker(None)
+    with multiprocessing.get_context("fork").Pool(
+        2, initializer=init_worker, initargs=(query_model,)
+    ) as pool:
+        results = pool.map(_predict_acetic_acid_in_worker, range(4))
+    # the workers use the shared weights of the parent instead of loading their own
+    assert results == [reference] * 4
+    assert reference[:2] == (1, True)
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_predict_pka_values():
+    from pkasolver.ml import dataset_to_dataloader
+    from pkasolver.query import enumerate_protonation_pairs, get_query_model
+
+    query_model = get_query_model()
+    dataset = enumerate_protonation_pairs(mollist[:5], query_model)
+    reference = np.array(
+        [
+            query_model.predict_pka_value(dataset_to_dataloader([m], 1))
+            for m in dataset
+        ]
+    )
+    # a small node budget splits the pairs into several batches
+    for node_budget in [1, 100, 10_000]:
+        pka, pka_std = query_model.predict_pka_values(dataset, node_budget=node_budget)
+        assert np.allclose(pka, reference[:, 0], atol=1e-5)
+        assert np.allclose(pka_std, reference[:, 1], atol=1e-5)
+        # pre-collated batch
+        batch = next(iter(dataset_to_dataloader(dataset, len(dataset), shuffle=False)))
+        pka, _ = query_model.predict_pka_values(batch, node_budget=node_budget)
+        assert np.allclose(pka, reference[:, 0], atol=1e-5)
+
+    pka, pka_std = query_model.predict_pka_values([])
+    assert pka.shape == pka_std.shape == (0,)
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_calculate_microstate_pka_values_batch():
+    from pkasolver.query import calculate_microstate_pka_values_batch, get_query_model
+
+    query_model = get_query_model()
+    mols = mollist[:8] + [Chem.MolFromSmiles("CC(=O)O")]
+    results = calculate_microstate_pka_values_batch(
+        mols, query_model=query_model, node_budget=200
+    )
+    assert len(results) == len(mols)
+    for mol, states in zip(mols, results):
+        query_model.pair_cache.clear()
+        reference = calculate_microstate_pka_values(mol, query_model=query_model)
+        assert [s.reaction_center_idx for s in states] == [
+            s.reaction_center_idx for s in reference
+        ]
+        assert np.allclose([s.pka for s in states], [s.pka for s in reference])
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_pair_cache():
+    from pkasolver.query import PairCache, QueryModel
+
+    query_model = QueryModel()
+    mol = Chem.MolFromSmiles("OC(=O)CC(O)(CC(=O)O)C(=O)O")  # citric acid
+    reference = calculate_microstate_pka_values(
+        mol, query_model=QueryModel(pair_cache_size=0)
+    )
+    states = calculate_microstate_pka_values(mol, query_model=query_model)
+    assert query_model.pair_cache.hits == 0
+    misses = query_model.pair_cache.misses
+    # the symmetric carboxylic acids are predicted only once
+    assert misses > len(query_model.pair_cache) > 0
+    # a second query is answered from the cache
+    cached_states = calculate_microstate_pka_values(mol, query_model=query_model)
+    assert query_model.pair_cache.hits == misses
+    assert query_model.pair_cache.misses == misses
+    for s1, s2, s3 in zip(reference, states, cached_states):
+        assert s1.reaction_center_idx == s2.reaction_center_idx == s3.reaction_center_idx
+        assert np.isclose(s1.pka, s2.pka) and s2.pka == s3.pka
+        assert Chem.MolToSmiles(s2.protonated_mol) == Chem.MolToSmiles(s3.protonated_mol)
+
+    # symmetry-equivalent reaction centers share an entry
+    acetate = Chem.MolFromSmiles("CC(=O)[O-]")
+    acetic_acid_1 = Chem.MolFromSmiles("CC(=O)O")
+    acetic_acid_2 = Chem.MolFromSmiles("CC(O)=O")
+    assert PairCache.key(acetic_acid_1, acetate, 3) == PairCache.key(
+        acetic_acid_2, acetate, 2
+    )
+    assert PairCache.key(acetic_acid_1, acetate, 3) != PairCache.key(
+        acetic_acid_1, acetate, 3, tolerance=0.1
+    )
+
+    # least recently used entries are evicted
+    cache = PairCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert (cache.hits, cache.misses, len(cache)) == (3, 1, 2)
+
+
+def test_prescreen():
+    from pkasolver.query import PrescreenStatistics, _prescreen
+
+    statistics = PrescreenStatistics()
+    # acid pass: the third candidate can not beat the certainly valid first one
+    bounds = [(6.0, 8.0), (5.0, 9.0), (2.0, 4.0), (0.0, 0.4), (7.0, 7.0)]
+    selected = _prescreen(list("abcde"), bounds, True, None, statistics)
+    assert selected == ["a", "b", "e"]
+    # exact (cached) values are not counted
+    assert (statistics.nr_of_screened, statistics.nr_of_skipped) == (4, 2)
+    # the winner has to be below the pKa of the previous iteration
+    selected = _prescreen(list("abc"), bounds[:3], True, 5.5, statistics)
+    assert selected == ["b", "c"]
+    # base pass: the lowest pKa above the previous one and at most 13.5 wins
+    statistics = PrescreenStatistics()
+    bounds = [(8.0, 10.0), (11.0, 13.0), (13.6, 15.0)]
+    selected = _prescreen(list("abc"), bounds, False, 7.0, statistics)
+    assert selected == ["a"]
+    assert statistics.nr_of_skipped == 2
+
+
+def test_predict_first_predictions(monkeypatch):
+    import torch
+
+    from pkasolver.query import QueryModel
+
+    # the members 0..4 of 2 pairs, without the weights of the shipped models
+    all_predictions = torch.tensor(
+        [[1.0, 5.0], [2.0, 5.1], [3.0, 4.9], [4.0, 5.0], [5.0, 5.0]]
+    )
+    evaluated = []
+
+    def predict_members(data, start=0, end=-1):
+        evaluated.append((start, end))
+        return all_predictions[start:] if end < 0 else all_predictions[start:end]
+
+    query_model = QueryModel.__new__(QueryModel)
+    query_model.student, query_model.session = None, None
+    query_model.nr_of_models, query_model.device = 5, torch.device("cpu")
+    monkeypatch.setattr(query_model, "_predict_members", predict_members)
+    data = type("Data", (), {"num_graphs": 2, "to": lambda self, device: self})()
+
+    for tolerance in [None, 0.1]:
+        reference = query_model.predict(data, tolerance, min_models=2)
+        evaluated.clear()
+        results = query_model.predict(
+            data, tolerance, min_models=2, first_predictions=all_predictions[:2]
+        )
+        # the evaluation continues after the given members
+        assert evaluated[0][0] == 2
+        for result, expected in zip(results, reference):
+            assert np.allclose(result, expected)
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_calculate_microstate_pka_values_prescreen():
+    from pkasolver.query import QueryModel, calculate_microstate_pka_values_batch
+
+    mols = [
+        Chem.MolFromSmiles(smi)
+        for smi in [
+            "OC(=O)CC(O)(CC(=O)O)C(=O)O",
+            "NCC(=O)O",
+            "Nc1ccc(S(=O)(=O)Nc2ccccn2)cc1",
+        ]
+    ]
+    query_model = QueryModel(pair_cache_size=0)
+    references = calculate_microstate_pka_values_batch(mols, query_model=query_model)
+    results = calculate_microstate_pka_values_batch(
+        mols, query_model=query_model, prescreen=True
+    )
+    for reference, states in zip(references, results):
+        assert [s.reaction_center_idx for s in states] == [
+            s.reaction_center_idx for s in reference
+        ]
+        assert np.allclose([s.pka for s in states], [s.pka for s in reference])
+    assert query_model.prescreen_statistics.nr_of_screened > 0
+
+
+def test_protonator(monkeypatch):
+    import sys
+
+    from dimorphite_dl.dimorphite_dl import Protonator, main, run_with_mol_list
+
+    # main parses sys.argv
+    monkeypatch.setattr(sys, "argv", sys.argv[:1])
+    protonator = Protonator(min_ph=0.5, max_ph=13.5, cache_size=2)
+    for mol in mollist[:10]:
+        # the same states as the SMILES based command line version
+        reference = main(
+            {
+                "smiles": Chem.MolToSmiles(mol),
+                "min_ph": 0.5,
+                "max_ph": 13.5,
+                "return_as_list": True,
+            }
+        )
+        mols = protonator.protonate(mol)
+        assert sorted(Chem.MolToSmiles(m) for m in mols) == sorted(
+            s.split("\t")[0] for s in reference
+        )
+        # numbered as if they were parsed from their SMILES, with the properties of mol
+        for m in mols:
+            parsed = Chem.MolFromSmiles(Chem.MolToSmiles(m))
+            assert [a.GetSymbol() for a in m.GetAtoms()] == [
+                a.GetSymbol() for a in parsed.GetAtoms()
+            ]
+            assert m.GetPropsAsDict() == mol.GetPropsAsDict()
+        assert [Chem.MolToSmiles(m) for m in mols] == [
+            Chem.MolToSmiles(m)
+            for m in run_with_mol_list([mol], min_ph=0.5, max_ph=13.5)
+        ]
+    assert (protonator.hits, protonator.misses) == (0, 10)
+    assert len(protonator.cache) == 2
+
+    # repeated molecules are answered by the cache, with independent copies
+    mol = Chem.MolFromSmiles("OC(=O)CC(O)(CC(=O)O)C(=O)O")
+    mols = protonator.protonate(mol)
+    mols[0].SetProp("_Name", "modified")
+    assert not protonator.protonate(mol)[0].HasProp("_Name")
+    assert protonator.hits == 1
+    assert sorted(protonator.protonate_smiles("CC(=O)O")) == ["CC(=O)O", "CC(=O)[O-]"]
+    assert protonator.protonate_smiles("C1CC") == []
+
+    # the chiral tags of the neutralized ammonium nitrogens are dropped,
+    # like in the SMILES round trip of the command line version
+    protonator = Protonator(min_ph=0.5, max_ph=13.5, silent=True)
+    for smi in [
+        "OC(=O)C[N@H+](C)CC",
+        "C[N@@H+]1CCCC1C(=O)O",
+        "OC(=O)C[N@H+](CC(=O)O)CC[N@@H+](CC(=O)O)CC(=O)O",
+    ]:
+        reference = main(
+            {
+                "smiles": smi,
+                "min_ph": 0.5,
+                "max_ph": 13.5,
+                "silent": True,
+                "return_as_list": True,
+            }
+        )
+        mols = protonator.protonate(Chem.MolFromSmiles(smi))
+        assert sorted(Chem.MolToSmiles(m) for m in mols) == sorted(
+            s.split("\t")[0] for s in reference
+        )
+        assert all("@" not in Chem.MolToSmiles(m) for m in mols)
+
+    # all options are passed on to the protonator, unknown ones are rejected
+    smi = "OC(=O)CC(N)C(=O)O"
+    reference = main(
+        {
+            "smiles": smi,
+            "min_ph": 0.5,
+            "max_ph": 13.5,
+            "label_states": True,
+            "return_as_list": True,
+        }
+    )
+    mols = run_with_mol_list(
+        [Chem.MolFromSmiles(smi)], min_ph=0.5, max_ph=13.5, label_states=True
+    )
+    assert sorted(
+        f"{Chem.MolToSmiles(m)}\t\t{m.GetProp('target_states')}" for m in mols
+    ) == sorted(reference)
+    with pytest.raises(TypeError):
+        run_with_mol_list([Chem.MolFromSmiles(smi)], min_pH=0.5)
+
+
+def test_protonator_threads(monkeypatch):
+    import os
+
+    from dimorphite_dl.dimorphite_dl import Protonate, Protonator, ProtSubstructFuncs
+
+    # the configuration is kept per instance
+    assert not hasattr(ProtSubstructFuncs, "args")
+    Protonate({"smiles": "CC(=O)O", "silent": True})
+    assert not hasattr(ProtSubstructFuncs, "args")
+
+    mols = mollist[:40] * 2
+    reference = [
+        sorted(Chem.MolToSmiles(m) for m in Protonator(cache_size=0).protonate(mol))
+        for mol in mols
+    ]
+    protonator = Protonator(cache_size=8)
+    # RDKit's messages are not captured by redirecting stderr
+    redirections = []
+    with monkeypatch.context() as m:
+        m.setattr(os, "dup2", lambda *args: redirections.append(args))
+        results = protonator.protonate_many(mols, nr_of_threads=4)
+        assert protonator.protonate_smiles("C1CC") == []
+    assert redirections == []
+    assert [sorted(Chem.MolToSmiles(m) for m in r) for r in results] == reference
+    assert protonator.hits + protonator.misses == len(mols)
+    assert len(protonator.cache) == 8
@@ -0,0 +1,56 @@
+import multiprocessing
+import os
+
+import pytest
+from rdkit import Chem
+
+smiles = ["CC(=O)O", "not a smiles", "NCCS", "C1=CC=NC=C1", "OC(=O)CC(=O)O"]
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_run_microstate_pka_values():
+    from pkasolver.query import calculate_microstate_pka_values
+    from pkasolver.runner import run_microstate_pka_values
+
+    results = list(
+        run_microstate_pka_values(
+            iter(smiles),
+            nr_of_workers=2,
+            chunk_size=2,
+            mp_context=multiprocessing.get_context("fork"),
+        )
+    )
+    # results in input order, None for the invalid SMILES
+    assert len(results) == len(smiles)
+    assert results[1] is None
+    for smi, states in zip(smiles, results):
+        if states is None:
+            continue
+        reference = calculate_microstate_pka_values(Chem.MolFromSmiles(smi))
+        assert [s.pka for s in states] == pytest.approx([s.pka for s in reference])
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_run_microstate_pka_values_with_failing_molecule(monkeypatch):
+    import pkasolver.runner as runner
+
+    calculate_microstate_pka_values = runner.calculate_microstate_pka_values
+
+    def fail_for_thiols(mol, **kwargs):
+        if mol.HasSubstructMatch(Chem.MolFromSmarts("[SX2H]")):
+            raise RuntimeError("failing molecule")
+        return calculate_microstate_pka_values(mol, **kwargs)
+
+    def fail_batch(mols, **kwargs):
+        raise RuntimeError("failing batch")
+
+    monkeypatch.setattr(runner, "calculate_microstate_pka_values", fail_for_thiols)
+    monkeypatch.setattr(runner, "calculate_microstate_pka_values_batch", fail_batch)
+    results = list(
+        runner.run_microstate_pka_values(smiles, nr_of_workers=0, chunk_size=10)
+    )
+    assert [r is None for r in results] == [False, True, True, False, False]
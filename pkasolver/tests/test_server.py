@@ -0,0 +1,114 @@
+import asyncio
+import json
+import os
+import urllib.error
+import urllib.request
+
+import pytest
+from rdkit import Chem
+
+
+def _request(port: int, endpoint: str, data: dict = None) -> tuple:
+    """returns status and JSON response"""
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}{endpoint}",
+        data=json.dumps(data).encode() if data is not None else None,
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_inference_server():
+    from pkasolver.query import calculate_microstate_pka_values, get_query_model
+    from pkasolver.server import InferenceServer
+
+    smiles = ["CC(=O)O", "NCC(=O)O", "NCCS", "C1=CC=NC=C1", "OC(=O)CC(=O)O"]
+    query_model = get_query_model()
+
+    async def run():
+        inference_server = InferenceServer(query_model, batch_window=0.5)
+        server = await inference_server.start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        loop = asyncio.get_running_loop()
+        call = lambda *args: loop.run_in_executor(None, _request, port, *args)
+        async with server:
+            status, health = await call("/health")
+            assert status == 200 and health["status"] == "ok"
+            assert health["model"] == query_model.fingerprint
+
+            # concurrent requests are predicted in shared batches
+            responses = await asyncio.gather(
+                *(call("/microstates", {"smiles": smi}) for smi in smiles),
+                call(
+                    "/pairs",
+                    {
+                        "pairs": [
+                            {
+                                "protonated": "CC(=O)O",
+                                "deprotonated": "CC(=O)[O-]",
+                                "reaction_center_idx": 3,
+                            }
+                        ]
+                    },
+                ),
+            )
+            assert inference_server.nr_of_batches < len(responses)
+            for smi, (status, response) in zip(smiles, responses):
+                assert status == 200
+                reference = calculate_microstate_pka_values(
+                    Chem.MolFromSmiles(smi), query_model=query_model
+                )
+                states = response["results"][0]["states"]
+                assert [s["reaction_center_idx"] for s in states] == [
+                    s.reaction_center_idx for s in reference
+                ]
+                assert [round(s["pka"], 3) for s in states] == [
+                    round(s.pka, 3) for s in reference
+                ]
+            status, response = responses[-1]
+            assert status == 200
+            assert round(response["results"][0]["pka"], 3) == round(
+                responses[0][1]["results"][0]["states"][0]["pka"], 3
+            )
+
+            # invalid SMILES get an error, the valid ones are still predicted
+            status, response = await call(
+                "/microstates", {"smiles": ["not a smiles", smiles[0]]}
+            )
+            assert status == 200
+            assert [r["smiles"] for r in response["results"]] == [
+                "not a smiles",
+                smiles[0],
+            ]
+            assert "error" in response["results"][0]
+            assert response["results"][1]["states"] == responses[0][1]["results"][0][
+                "states"
+            ]
+
+            # invalid requests
+            assert (await call("/microstates", {"smiles": []}))[0] == 400
+            assert (await call("/pairs", {"pairs": [{"protonated": "C"}]}))[0] == 400
+            assert (await call("/unknown"))[0] == 404
+            assert (await call("/health", {}))[0] == 405
+        # the worker thread is shut down with the server
+        executor = inference_server.executor
+        await inference_server.stop()
+        with pytest.raises(RuntimeError):
+            executor.submit(print)
+
+        # backpressure
+        inference_server = InferenceServer(query_model, max_queue_size=1)
+        server = await inference_server.start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            assert (await call("/microstates", {"smiles": smiles[:2]}))[0] == 503
+            assert (await call("/microstates", {"smiles": smiles[:1]}))[0] == 200
+        await inference_server.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+
+import pytest
+import torch
+
+
+def test_import_keeps_torch_threads():
+    # importing pkasolver must not change the threads of the host application
+    code = (
+        "import torch; torch.set_num_threads(3); "
+        "import pkasolver.constants; print(torch.get_num_threads())"
+    )
+    env = {k: v for k, v in os.environ.items() if not k.startswith("PKASOLVER_NUM")}
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, env=env
+    )
+    assert out.stdout.strip() == "3", out.stderr
+    env["PKASOLVER_NUM_THREADS"] = "2"
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, env=env
+    )
+    assert out.stdout.strip() == "2", out.stderr
+
+
+def test_thread_policy(monkeypatch):
+    from pkasolver import threads
+    from pkasolver.threads import (
+        ThreadPolicy,
+        available_cpus,
+        get_thread_policy,
+        set_thread_policy,
+        set_thread_policy_from_environment,
+    )
+
+    monkeypatch.setattr(threads, "_thread_policy", ThreadPolicy())
+    nr_of_threads = torch.get_num_threads()
+    try:
+        policy = set_thread_policy(intra_op_threads=2, nr_of_workers=4)
+        assert torch.get_num_threads() == 2
+        assert policy == get_thread_policy()
+        assert policy.workers() == 4
+        assert policy.threads_per_worker() == max(1, available_cpus() // 4)
+        # None keeps the current values
+        policy = set_thread_policy(worker_threads=3)
+        assert (policy.intra_op_threads, policy.nr_of_workers) == (2, 4)
+        assert policy.threads_per_worker() == 3
+
+        monkeypatch.setenv("PKASOLVER_NUM_THREADS", "1")
+        monkeypatch.setenv("PKASOLVER_NUM_WORKERS", "0")
+        policy = set_thread_policy_from_environment()
+        assert torch.get_num_threads() == 1
+        assert (policy.intra_op_threads, policy.nr_of_workers) == (1, 0)
+        assert policy.worker_threads == 3
+    finally:
+        torch.set_num_threads(nr_of_threads)
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true", reason="Needs pretrained GNN models",
+)
+def test_autotune_thread_policy():
+    from pkasolver.threads import autotune_thread_policy
+
+    nr_of_threads = torch.get_num_threads()
+    policy, results = autotune_thread_policy(
+        ["CC(=O)O", "NCC(=O)O"], candidates=[(0, 1), (2, 1)]
+    )
+    assert [(p.nr_of_workers, p.worker_threads) for p, _ in results] == [
+        (0, 1),
+        (2, 1),
+    ]
+    assert policy in [p for p, _ in results]
+    assert all(molecules_per_second > 0 for _, molecules_per_second in results)
+    assert torch.get_num_threads() == nr_of_threads
@@ -0,0 +1,220 @@
+import logging
+import os
+import time
+from dataclasses import dataclass, replace
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# environment variables read by set_thread_policy_from_environment
+ENV_INTRA_OP_THREADS = "PKASOLVER_NUM_THREADS"
+ENV_INTER_OP_THREADS = "PKASOLVER_NUM_INTEROP_THREADS"
+ENV_WORKERS = "PKASOLVER_NUM_WORKERS"
+ENV_WORKER_THREADS = "PKASOLVER_NUM_WORKER_THREADS"
+
+# drug-like molecules used by autotune_thread_policy
+BENCHMARK_SMILES = [
+    "CC(=O)Oc1ccccc1C(=O)O",
+    "CN1CCC[C@H]1c1cccnc1",
+    "NC(Cc1ccc(O)cc1)C(=O)O",
+    "CC(C)Cc1ccc(C(C)C(=O)O)cc1",
+    "CN1C(=O)CN=C(c2ccccc2)c2cc(Cl)ccc21",
+    "OC(=O)CC(O)(CC(=O)O)C(=O)O",
+    "Nc1ccc(S(=O)(=O)Nc2ccccn2)cc1",
+    "CC(C)NCC(O)COc1ccc(CC(N)=O)cc1",
+    "COc1ccc2[nH]cc(CCNC(C)=O)c2c1",
+    "O=C(O)c1cc(O)c(O)c(O)c1",
+    "CN(C)CCCN1c2ccccc2CCc2ccccc21",
+    "NC(=O)c1cccnc1",
+    "CC1(C)SC2C(NC(=O)Cc3ccccc3)C(=O)N2C1C(=O)O",
+    "OCC(O)C(O)C(O)C(O)CO",
+    "CC(=O)Nc1ccc(O)cc1",
+    "NCCc1ccc(O)c(O)c1",
+]
+
+
+def available_cpus() -> int:
+    """number of cpus this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+@dataclass
+class ThreadPolicy:
+    """Parallelism of the pkasolver stages. None leaves the respective default.
+
+    Attributes
+    ----------
+    intra_op_threads
+        torch intra-op threads of this process (forward passes)
+    inter_op_threads
+        torch inter-op threads of this process, can only be set before torch runs
+        inter-op parallel work
+    nr_of_workers
+        worker processes of run_microstate_pka_values, which parallelize the
+        (single threaded) RDKit featurization and enumeration; 0 runs in this process;
+        defaults to the number of available cpus (0 if there is only one)
+    worker_threads
+        torch intra-op threads of each worker process,
+        defaults to the available cpus divided by the number of workers
+    """
+
+    intra_op_threads: int = None
+    inter_op_threads: int = None
+    nr_of_workers: int = None
+    worker_threads: int = None
+
+    def workers(self) -> int:
+        """the number of worker processes"""
+        if self.nr_of_workers is None:
+            # a single worker process has no advantage over running in this process
+            cpus = available_cpus()
+            return cpus if cpus > 1 else 0
+        return self.nr_of_workers
+
+    def threads_per_worker(self, nr_of_workers: int = None) -> int:
+        """the intra-op threads of each of nr_of_workers worker processes"""
+        if self.worker_threads is not None:
+            return self.worker_threads
+        nr_of_workers = self.workers() if nr_of_workers is None else nr_of_workers
+        return max(1, available_cpus() // max(1, nr_of_workers))
+
+
+_thread_policy = ThreadPolicy()
+
+
+def get_thread_policy() -> ThreadPolicy:
+    """Returns the current ThreadPolicy (see set_thread_policy)"""
+    return _thread_policy
+
+
+def set_thread_policy(
+    intra_op_threads: int = None,
+    inter_op_threads: int = None,
+    nr_of_workers: int = None,
+    worker_threads: int = None,
+) -> ThreadPolicy:
+    """Sets the parallelism of pkasolver, see ThreadPolicy for the arguments.
+    The torch thread settings of this process are applied immediately, arguments that
+    are None keep their current value. Importing pkasolver does not change any of them
+    unless the PKASOLVER_NUM_* environment variables are set.
+
+    Returns
+    -------
+    ThreadPolicy
+        the new policy
+    """
+    global _thread_policy
+    if intra_op_threads is not None:
+        torch.set_num_threads(intra_op_threads)
+    if (
+        inter_op_threads is not None
+        and inter_op_threads != torch.get_num_interop_threads()
+    ):
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            logger.warning(f"Could not set the inter-op threads: {e}")
+            inter_op_threads = None
+    changes = dict(
+        intra_op_threads=intra_op_threads,
+        inter_op_threads=inter_op_threads,
+        nr_of_workers=nr_of_workers,
+        worker_threads=worker_threads,
+    )
+    _thread_policy = replace(
+        _thread_policy, **{k: v for k, v in changes.items() if v is not None}
+    )
+    logger.debug(f"Thread policy: {_thread_policy}")
+    return _thread_policy
+
+
+def set_thread_policy_from_environment() -> ThreadPolicy:
+    """Applies the thread settings of the environment variables
+    PKASOLVER_NUM_THREADS, PKASOLVER_NUM_INTEROP_THREADS,
+    PKASOLVER_NUM_WORKERS and PKASOLVER_NUM_WORKER_THREADS (unset ones are left as they are)"""
+    values = {}
+    for name, variable in [
+        ("intra_op_threads", ENV_INTRA_OP_THREADS),
+        ("inter_op_threads", ENV_INTER_OP_THREADS),
+        ("nr_of_workers", ENV_WORKERS),
+        ("worker_threads", ENV_WORKER_THREADS),
+    ]:
+        if os.environ.get(variable):
+            values[name] = int(os.environ[variable])
+    return set_thread_policy(**values)
+
+
+def autotune_thread_policy(
+    smiles: list = None, repeats: int = 1, candidates: list = None
+) -> tuple:
+    """Benchmarks calculate_microstate_pka_values on smiles (default: BENCHMARK_SMILES)
+    with different combinations of worker processes and threads per process, that
+    together use at most the available cpus, and recommends the fastest.
+
+    Parameters
+    ----------
+    smiles
+        molecules of the benchmark, representative for the intended workload
+    repeats
+        the best of repeats runs is used for each setting
+    candidates
+        list of (nr_of_workers, threads per process) to compare,
+        defaults to powers of two that use all available cpus
+
+    Returns
+    -------
+    tuple
+        recommended ThreadPolicy and the list of (ThreadPolicy, molecules per second)
+    """
+    from pkasolver.query import get_query_model
+    from pkasolver.runner import run_microstate_pka_values
+
+    smiles = smiles or BENCHMARK_SMILES
+    cpus = available_cpus()
+    if candidates is None:
+        candidates, nr_of_threads = [], 1
+        while nr_of_threads <= cpus:
+            nr_of_workers = cpus // nr_of_threads
+            # a single worker process has no advantage over running in this process
+            candidates.append(
+                (0 if nr_of_workers == 1 else nr_of_workers, nr_of_threads)
+            )
+            nr_of_threads *= 2
+        if cpus > 1 and (0, cpus) not in candidates:
+            candidates.append((0, cpus))
+
+    intra_op_threads = torch.get_num_threads()
+    query_model = get_query_model()
+    # measure the predictions, not the cache
+    pair_cache_size, query_model.pair_cache.maxsize = query_model.pair_cache.maxsize, 0
+    results = []
+    try:
+        for nr_of_workers, nr_of_threads in candidates:
+            policy = ThreadPolicy(
+                intra_op_threads=nr_of_threads if nr_of_workers == 0 else 1,
+                nr_of_workers=nr_of_workers,
+                worker_threads=nr_of_threads,
+            )
+            torch.set_num_threads(policy.intra_op_threads)
+            chunk_size = max(1, len(smiles) // max(1, 2 * nr_of_workers))
+            run_time = float("inf")
+            for _ in range(repeats):
+                query_model.pair_cache.clear()
+                t = time.perf_counter()
+                for _ in run_microstate_pka_values(
+                    smiles,
+                    nr_of_workers=nr_of_workers,
+                    chunk_size=chunk_size,
+                    worker_threads=nr_of_threads,
+                ):
+                    pass
+                run_time = min(run_time, time.perf_counter() - t)
+            results.append((policy, len(smiles) / run_time))
+            logger.info(f"{policy}: {results[-1][1]:.2f} molecules/s")
+    finally:
+        torch.set_num_threads(intra_op_threads)
+        query_model.pair_cache.maxsize = pair_cache_size
+    return max(results, key=lambda result: result[1])[0], results